@@ -0,0 +1,331 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from tools_fake_dashscope import FakeDashScopeServer
+from tools_tts_backend import FakeTTSBackend, set_tts_backend
+
+BENCH_API_KEY = "sk-benchmark"
+
+
+def _max_rss_mb() -> Optional[float]:
+    """进程常驻内存峰值（MB）：Unix用resource，Windows用可选的psutil；都不可用时返回None"""
+    try:
+        import resource
+    except ImportError:  # Windows没有resource模块
+        try:
+            import psutil
+        except ImportError:
+            return None
+        memory = psutil.Process().memory_info()
+        return round(getattr(memory, "peak_wset", memory.rss) / 1024 / 1024, 1)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux上单位为KB，macOS上为字节
+    return round(max_rss / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+class TimedFakeTTSBackend(FakeTTSBackend):
+    """记录每次infer耗时的假TTS后端"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies: List[float] = []
+        self._lock = threading.Lock()
+
+    def infer(self, texts, **kwargs):
+        start = time.perf_counter()
+        wavs = super().infer(texts, **kwargs)
+        with self._lock:
+            self.latencies.append(time.perf_counter() - start)
+        return wavs
+
+
+def _timed(func: Callable, latencies: List[float]) -> Callable:
+    """包装任务函数，记录每次调用耗时（含客户端重试）"""
+    lock = threading.Lock()
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    return wrapper
+
+
+def _stage_report(name: str, items: int, unit: str, seconds: float, latencies: List[float],
+                  peak_bytes: int, **extra) -> Dict:
+    report = {
+        "stage": name,
+        "items": items,
+        "unit": unit,
+        "seconds": round(seconds, 3),
+        "throughput": round(items / seconds, 2) if seconds > 0 else 0.0,
+        "peak_mb": round(peak_bytes / 1024 / 1024, 1),
+    }
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        report.update(p50_ms=round(p50 * 1000, 1), p90_ms=round(p90 * 1000, 1),
+                      p99_ms=round(p99 * 1000, 1), max_ms=round(max(latencies) * 1000, 1))
+    report.update(extra)
+    return report
+
+
+def _measure(stage: Callable[[], Dict], server: FakeDashScopeServer, verbose: bool = False,
+             hedge_model: str = "") -> Dict:
+    """执行一个阶段，并补上耗时、Python堆内存峰值和发往替身服务的请求数（开启对冲时另计对冲次数与胜出次数）"""
+    from tools_metrics import metrics
+
+    def hedge_counts():
+        return (metrics.counter_value("llm_hedges_total", model=hedge_model),
+                metrics.counter_value("llm_hedge_wins_total", model=hedge_model, winner="hedge"))
+
+    requests_before = sum(server.status_counts.values())
+    hedges_before = hedge_counts()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+        report = stage()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    report["http_requests"] = sum(server.status_counts.values()) - requests_before
+    if hedge_model and report["http_requests"]:
+        hedges, hedge_wins = (int(after - before) for after, before in zip(hedge_counts(), hedges_before))
+        report.update(hedges=hedges, hedge_wins=hedge_wins)
+    return _stage_report(seconds=seconds, peak_bytes=peak, **report)
+
+
+@contextlib.contextmanager
+def _isolated_moderation_state(work_dir: str):
+    """
+    基准测试期间把内容审核的拒绝记录和跳过日志改到临时目录：
+    替身服务随机拒绝的句子不能写进真实的拒绝记录，否则之后的真实运行会直接剔除这些句子
+    """
+    import tools_moderation
+
+    with tools_moderation._default_verdicts_lock:
+        saved = (tools_moderation.SKIPPED_LOG_PATH, tools_moderation._default_verdicts)
+        tools_moderation.SKIPPED_LOG_PATH = os.path.join(work_dir, "skipped_chunks.log")
+        tools_moderation._default_verdicts = tools_moderation.ModerationVerdicts(
+            os.path.join(work_dir, "moderation_rejected.txt"))
+    try:
+        yield
+    finally:
+        with tools_moderation._default_verdicts_lock:
+            tools_moderation.SKIPPED_LOG_PATH, tools_moderation._default_verdicts = saved
+
+
+def run_benchmark(novel_path: str, workers: int = 8, latency: float = 0.3, jitter: float = 0.5,
+                  error_rate: float = 0.0, moderation_rate: float = 0.0, use_rules: bool = True,
+                  use_prefilter: bool = True,
+                  tts_delay_per_char: float = 0.0005, batch_size: int = 8, seed: int = 0,
+                  max_output_tokens: int = 0, slow_rate: float = 0.0, slow_factor: float = 10.0,
+                  hedge: bool = False, verbose: bool = False) -> Dict:
+    """
+    离线基准测试：本地DashScope替身 + 假TTS后端，依次跑 角色提取 -> 文本标注 -> 语音合成 三个阶段
+
+    Args:
+        novel_path: 小说TXT路径
+        workers: 大模型阶段的并发数
+        latency/jitter/error_rate/moderation_rate: 本地替身服务的模拟参数（见 FakeDashScopeServer）
+        use_rules: 标注阶段是否先用本地规则
+        use_prefilter: 角色提取阶段是否先做本地候选人名预筛
+        tts_delay_per_char: 假TTS每个字的模拟推理耗时（秒）
+        batch_size: 每次infer合成的片段数
+        seed: 替身服务的随机种子（相同参数结果可复现）
+        max_output_tokens: 替身服务的输出上限（0不限）；配合 use_rules=False 观察自适应块大小的收敛
+        slow_rate/slow_factor: 替身服务的长尾请求比例与变慢倍数
+        hedge: 客户端是否开启请求对冲（配合 slow_rate 观察p99延迟与额外请求数）
+        verbose: 是否输出各阶段自身的逐块/逐段日志
+
+    Returns:
+        {"stages": [各阶段统计], "http_status": {...}, "max_rss_mb": 进程常驻内存峰值（无法测量时为None）}
+    """
+    server = FakeDashScopeServer(latency=latency, jitter=jitter, error_rate=error_rate,
+                                 moderation_rate=moderation_rate, seed=seed,
+                                 max_output_tokens=max_output_tokens, slow_rate=slow_rate,
+                                 slow_factor=slow_factor).start()
+    # 客户端在导入时读取服务地址，必须先设置环境变量再导入各处理脚本
+    os.environ["DASHSCOPE_BASE_URL"] = server.url
+    import generate_role_by_llm as role_stage
+    import tools_call_qianwen
+    import generate_text_by_llm as text_stage
+    from generate_audio_by_chattts import generate_voice_from_json
+    from tools_chunker import estimate_tokens, iter_adaptive_chunks, iter_chunks
+    from tools_concurrent import RateLimiter, dispatch_in_order
+    from tools_segment_store import SegmentStore, open_segment_writer
+
+    # 不走响应缓存，保证每次测的都是真实请求路径
+    role_stage.USE_LLM_CACHE = False
+    tools_call_qianwen.HEDGING_ENABLED = hedge  # 共享客户端在首次调用时创建，此前设置即可生效
+    text_stage.USE_LLM_CACHE = False
+    tts = TimedFakeTTSBackend(infer_delay_per_char=tts_delay_per_char)
+    set_tts_backend(tts)
+
+    work_dir = tempfile.mkdtemp(prefix="novel_bench_")
+    roles_path = os.path.join(work_dir, "novel_roles.json")
+    processed_path = os.path.join(work_dir, "novel_processed.jsonl")
+    stages = []
+    tracemalloc.start()
+    try:
+        def dispatch(func, items, text_of=lambda item: item):
+            return dispatch_in_order(
+                func, items, max_workers=workers,
+                limiter=RateLimiter(rpm=0, tpm=0),
+                cost_fn=lambda item: estimate_tokens(text_of(item)) + role_stage.PROMPT_OVERHEAD_TOKENS,
+                should_abort=lambda e: not role_stage.is_moderation_error(str(e)),
+            )
+
+        def run_roles():
+            latencies = []
+            text = role_stage.read_novel_text(novel_path)
+            chunks = list(iter_chunks(text, max_tokens=role_stage.CHUNK_MAX_TOKENS,
+                                      overlap_tokens=role_stage.CHUNK_OVERLAP_TOKENS))
+            role_requests = role_stage.plan_requests(chunks, text, use_prefilter=use_prefilter)
+            results = dispatch(_timed(lambda request: role_stage.extract_roles_with_bisection(request.text,
+                                                                                             BENCH_API_KEY),
+                                      latencies),
+                               role_requests, text_of=lambda request: request.text)
+            _raise_fatal(results, role_stage.is_moderation_error)
+            roles = role_stage.merge_roles([r.value for r in results if r.ok])
+            with open(roles_path, "w", encoding="utf-8") as f:
+                json.dump({"roles": roles, "chattts_voice_map": role_stage.generate_chattts_voice_map(roles),
+                           "total_roles": len(roles)}, f, ensure_ascii=False, indent=4)
+            return dict(name="角色提取", items=len(chunks), unit="块", latencies=latencies,
+                        chars=len(text), llm_requests=len(role_requests), skipped=sum(not r.ok for r in results),
+                        roles=len(roles))
+
+        def run_annotation():
+            latencies = []
+            text = text_stage.read_novel_from_txt(novel_path)
+            annotate = _timed(
+                lambda pack: text_stage.annotate_pack(pack, BENCH_API_KEY, roles_path, use_rules=use_rules,
+                                                      sizer=sizer),
+                latencies,
+            )
+            # 规则标注时相邻块的待定对白合并请求；整段交给大模型时块大小自适应：按并发数分批切块，每批用上一批反馈后的预算
+            sizer = None if use_rules else text_stage.make_chunk_sizer()
+            if sizer is None:
+                packs = text_stage.iter_annotation_packs(iter_chunks(text, max_tokens=text_stage.CHUNK_MAX_TOKENS),
+                                                         roles_path, use_rules=use_rules)
+                waves = [packs]
+            else:
+                packs = text_stage.iter_annotation_packs(iter_adaptive_chunks(text, sizer), roles_path,
+                                                         use_rules=False)
+                waves = iter(lambda: list(itertools.islice(packs, workers)), [])
+            chunks, results = 0, []
+            with open_segment_writer(processed_path) as segment_writer:
+                for wave in waves:
+                    wave = list(wave)
+                    chunks += sum(len(pack) for pack in wave)
+                    wave_results = dispatch(annotate, wave, text_of=lambda pack: "".join(chunk for chunk, _ in pack))
+                    _raise_fatal(wave_results, role_stage.is_moderation_error)
+                    segment_writer.append(segment for r in wave_results if r.ok
+                                          for segments in r.value for segment in segments)
+                    results.extend(wave_results)
+                segments = len(segment_writer)
+            extra = {} if sizer is None else dict(chunk_tokens=sizer.tokens, truncations=sizer.truncations)
+            return dict(name="文本标注", items=chunks, unit="块", latencies=latencies, chars=len(text),
+                        packs=len(results), skipped=sum(not r.ok for r in results), segments=segments, **extra)
+
+        def run_audio():
+            with SegmentStore(processed_path) as store:
+                segments = len(store)
+            tts.latencies.clear()
+            generate_voice_from_json(processed_path, os.path.join(work_dir, "novel_voice.wav"),
+                                     batch_size=batch_size, cache_dir=None, roles_path=roles_path,
+                                     speaker_registry_path=os.path.join(work_dir, "speaker_embeddings"))
+            return dict(name="语音合成", items=segments, unit="段", latencies=list(tts.latencies),
+                        infer_calls=len(tts.latencies))
+
+        with _isolated_moderation_state(work_dir):
+            for stage in (run_roles, run_annotation, run_audio):
+                stages.append(_measure(stage, server, verbose, hedge_model=role_stage.MODEL_NAME if hedge else ""))
+    finally:
+        tracemalloc.stop()
+        server.stop()
+
+    return {
+        "stages": stages,
+        "http_status": dict(server.status_counts),
+        "max_rss_mb": _max_rss_mb(),
+        "work_dir": work_dir,
+    }
+
+
+def _raise_fatal(results, is_moderation_error: Callable[[str], bool]):
+    """内容审核拒绝按跳过统计，其余错误说明被测代码有问题，直接抛出"""
+    for result in results:
+        if not result.ok and not is_moderation_error(str(result.error)):
+            raise result.error
+
+
+def format_report(result: Dict) -> str:
+    lines = ["===== 离线基准测试结果 ====="]
+    for stage in result["stages"]:
+        lines.append(
+            f"[{stage['stage']}] {stage['items']} {stage['unit']} / {stage['seconds']:.2f} 秒"
+            f" = {stage['throughput']:.2f} {stage['unit']}/秒，Python堆峰值 {stage['peak_mb']} MB"
+        )
+        if "p50_ms" in stage:
+            lines.append(f"    延迟 p50 {stage['p50_ms']} ms / p90 {stage['p90_ms']} ms"
+                         f" / p99 {stage['p99_ms']} ms / max {stage['max_ms']} ms")
+        extra = {key: value for key, value in stage.items()
+                 if key not in ("stage", "items", "unit", "seconds", "throughput", "peak_mb",
+                                "p50_ms", "p90_ms", "p99_ms", "max_ms")}
+        if extra:
+            lines.append("    " + "，".join(f"{key}={value}" for key, value in extra.items()))
+    lines.append(f"HTTP状态码分布：{result['http_status']}")
+    max_rss = result["max_rss_mb"]
+    lines.append(f"进程常驻内存峰值：{'n/a' if max_rss is None else f'{max_rss} MB'}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线基准测试：本地DashScope替身 + 假TTS，不联网、不加载模型")
+    parser.add_argument("--novel", default="novel_10k.txt", help="小说TXT文件路径")
+    parser.add_argument("--workers", type=int, default=8, help="大模型阶段并发数")
+    parser.add_argument("--latency", type=float, default=0.3, help="替身服务每个请求的平均耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.5, help="耗时抖动比例")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="429/500错误比例")
+    parser.add_argument("--moderation-rate", type=float, default=0.0, help="内容审核拒绝比例")
+    parser.add_argument("--llm-only", action="store_true", help="标注阶段不用本地规则预标注")
+    parser.add_argument("--no-prefilter", action="store_true", help="角色提取阶段不做本地候选人名预筛")
+    parser.add_argument("--tts-delay", type=float, default=0.0005, help="假TTS每个字的推理耗时（秒）")
+    parser.add_argument("--batch-size", type=int, default=8, help="每次infer合成的片段数")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="长尾请求比例")
+    parser.add_argument("--slow-factor", type=float, default=10.0, help="长尾请求的变慢倍数")
+    parser.add_argument("--hedge", action="store_true", help="客户端开启请求对冲")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--max-output-tokens", type=int, default=0, help="替身服务的输出上限（0不限）")
+    parser.add_argument("--verbose", action="store_true", help="输出各阶段自身的逐块/逐段日志")
+    parser.add_argument("--output", default="bench_output.txt", help="结果文本保存路径")
+    parser.add_argument("--json", default=None, help="可选，结果JSON保存路径（便于对比回归）")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.novel, workers=args.workers, latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate, moderation_rate=args.moderation_rate,
+                           use_rules=not args.llm_only, use_prefilter=not args.no_prefilter,
+                           tts_delay_per_char=args.tts_delay,
+                           batch_size=args.batch_size, seed=args.seed,
+                           max_output_tokens=args.max_output_tokens, slow_rate=args.slow_rate,
+                           slow_factor=args.slow_factor, hedge=args.hedge, verbose=args.verbose)
+    report = format_report(result)
+    print(report)
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(report + "\n")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
@@ -1,20 +1,80 @@
+import argparse
 import json
+import hashlib
 import os
-import torch
-import ChatTTS
-from pydub import AudioSegment
-from typing import List, Dict
+import time
+import zlib
+import numpy as np
+from typing import List, Dict, Iterable, Iterator, Optional, Sequence, Tuple
 
-# 初始化ChatTTS模型
-chat = ChatTTS.Chat()
-chat.load_models()  # 自动下载并加载模型，首次运行需联网
+from tools_audio_cache import AudioClipCache, SynthesisManifest, make_segment_key
+from tools_metrics import metrics
+from tools_segment_store import SegmentStore, SegmentStoreView, load_segments, segment_range
+from tools_speaker_registry import DEFAULT_REGISTRY_PREFIX, SpeakerRegistry
+from tools_tts_backend import get_backend_factory, get_model_version, get_tts_backend, warm_up
+from tools_tts_pool import synthesize_in_pool
+from tools_wav_writer import StreamingWavWriter
 
+# ChatTTS模型不在导入时加载：首次合成时由 get_tts_backend() 懒加载，
+# 测试中可用 tools_tts_backend.set_tts_backend() 换成假后端
+SAMPLE_RATE = 24000  # ChatTTS输出采样率
 
-def get_chattts_speaker_params(emotion: str, speed: float) -> Dict:
+# 角色说话人向量表（由角色档案预先生成）；未登记的说话人在进程内按种子补生成
+_speaker_registry: Optional[SpeakerRegistry] = None
+_extra_speakers: Dict[str, np.ndarray] = {}
+
+
+def use_speaker_registry(roles_path: Optional[str] = None,
+                         path_prefix: str = DEFAULT_REGISTRY_PREFIX) -> Optional[SpeakerRegistry]:
+    """
+    加载（必要时根据角色档案生成）角色说话人向量表，供后续合成按说话人查表
+    :param roles_path: novel_roles.json路径；向量表缺失或过期时据此重建
+    :param path_prefix: 向量表文件前缀（<前缀>.npy / <前缀>.json）
+    """
+    global _speaker_registry
+    _speaker_registry = SpeakerRegistry.load_or_build(
+        roles_path,
+        lambda seed: get_tts_backend().sample_speaker(seed),  # 仅在需要重建时才加载模型
+        get_model_version(),
+        path_prefix,
+    )
+    _extra_speakers.clear()
+    if _speaker_registry is not None:
+        print(f"已加载 {len(_speaker_registry)} 个角色的说话人向量")
+    return _speaker_registry
+
+
+def speaker_voice_seed(speaker: str, registry: Optional[SpeakerRegistry] = None) -> int:
+    """
+    由说话人名称得到稳定的音色种子（同一角色每次运行都是同一音色）
+    :param registry: 指定的角色向量表（如合成服务按请求指定），默认使用 use_speaker_registry 加载的进程级向量表
+    """
+    registry = registry if registry is not None else _speaker_registry
+    if registry is not None and speaker in registry:
+        return registry.seed_for(speaker)
+    return zlib.crc32(speaker.encode("utf-8")) % 10000
+
+
+def get_speaker_embedding(speaker: str, registry: Optional[SpeakerRegistry] = None) -> np.ndarray:
+    """查询说话人向量：优先查角色向量表，未登记的说话人按种子生成一次后复用（种子只由名称决定，与向量表无关）"""
+    registry = registry if registry is not None else _speaker_registry
+    if registry is not None:
+        embedding = registry.get(speaker)
+        if embedding is not None:
+            return embedding
+    if speaker not in _extra_speakers:
+        _extra_speakers[speaker] = get_tts_backend().sample_speaker(speaker_voice_seed(speaker))
+    return _extra_speakers[speaker]
+
+
+def get_chattts_speaker_params(emotion: str, speed: float, voice_seed: Optional[int] = None,
+                               speaker_embedding: Optional[np.ndarray] = None) -> Dict:
     """
     根据情感和语速生成ChatTTS对应的参数
     :param emotion: 情感标签（neutral/happy/sad/angry/calm/surprised）
     :param speed: 语速（0.8~1.2）
+    :param voice_seed: 音色种子（为None时随机抽取音色）
+    :param speaker_embedding: 说话人向量（传入时固定使用该音色）
     :return: ChatTTS参数字典
     """
     # 情感对应的风格参数（可根据实际效果调整）
@@ -30,8 +90,12 @@ def get_chattts_speaker_params(emotion: str, speed: float) -> Dict:
     # 语速映射（ChatTTS的speed范围0.5~2.0，这里做线性转换）
     chat_speed = speed  # 直接复用配置的语速，也可调整：如 speed * 1.2
     
-    # 生成speaker_id（固定一个音色，也可根据角色切换）
-    speaker_id = torch.randint(0, 10000, (1,)).item()
+    # 生成speaker_id（传入音色种子时固定音色，否则随机）
+    if voice_seed is not None:
+        speaker_id = voice_seed
+    else:
+        import torch
+        speaker_id = torch.randint(0, 10000, (1,)).item()
     
     params = {
         "text": "",
@@ -47,95 +111,272 @@ def get_chattts_speaker_params(emotion: str, speed: float) -> Dict:
             "prompt": f"[{emotion}]"  # 给文本添加情感提示
         }
     }
+    if speaker_embedding is not None:
+        params["params_infer_code"]["spk_emb"] = speaker_embedding
     return params
 
 
-def generate_voice_from_json(json_path: str, output_path: str = "novel_voice.wav"):
+def _wav_to_numpy(wav) -> np.ndarray:
+    """把ChatTTS返回的单条音频（tensor或ndarray）转为一维float32数组"""
+    if hasattr(wav, "cpu"):
+        wav = wav.cpu().numpy()
+    return np.asarray(wav, dtype=np.float32).reshape(-1)
+
+
+def plan_synthesis_batches(segments: Sequence[Dict], batch_size: int,
+                           indices: Optional[Iterable[int]] = None) -> List[List[int]]:
+    """
+    规划批量合成：推理参数相同（说话人/情感/语速）的片段才能合入同一批，
+    组内按文本长度排序后切分，使同批文本长度接近、减少padding浪费
+    :param segments: novel_processed.json中的片段列表
+    :param batch_size: 每批最多的片段数
+    :param indices: 只规划这些下标的片段（默认全部）
+    :return: 批次列表，每个批次是片段下标列表（空文本已过滤）
+    """
+    groups: Dict[Tuple, List[int]] = {}
+    for idx in (range(len(segments)) if indices is None else indices):
+        segment = segments[idx]
+        if not segment["text"].strip():  # 跳过空文本
+            continue
+        key = (segment["speaker"], segment["emotion"], float(segment["speed"]))
+        groups.setdefault(key, []).append(idx)
+
+    batches = []
+    for indices in groups.values():
+        indices.sort(key=lambda i: len(segments[i]["text"].strip()))
+        for start in range(0, len(indices), max(1, batch_size)):
+            batches.append(indices[start:start + batch_size])
+    # 按批内最小下标排序，让进度大致沿原文推进
+    batches.sort(key=min)
+    return batches
+
+
+def segment_cache_key(segment: Dict, registry: Optional[SpeakerRegistry] = None) -> str:
+    """片段音频的缓存键（registry 同 speaker_voice_seed）"""
+    speaker = segment["speaker"]
+    return make_segment_key(segment["text"].strip(), speaker, segment["emotion"], segment["speed"],
+                            speaker_voice_seed(speaker, registry), get_model_version())
+
+
+def synthesize_batch(texts: List[str], emotion: str, speed: float,
+                     speaker: Optional[str] = None, registry: Optional[SpeakerRegistry] = None) -> List[np.ndarray]:
+    """
+    一次chat.infer合成一批参数相同的文本
+    :param speaker: 说话人名称（为None时随机抽取音色）
+    :param registry: 指定的角色向量表（默认使用进程级向量表）
+    :return: 与texts一一对应的float32波形（采样率24000）
     """
-    从novel_processed.json生成语音并合并为完整音频
-    :param json_path: novel_processed.json文件路径
+    if speaker is None:
+        tts_params = get_chattts_speaker_params(emotion, speed)
+    else:
+        tts_params = get_chattts_speaker_params(emotion, speed, speaker_voice_seed(speaker, registry),
+                                                get_speaker_embedding(speaker, registry))
+    with metrics.timer("tts_batch_seconds", batch_size=len(texts)):
+        wavs = get_tts_backend().infer(
+            texts,
+            skip_refine_text=tts_params["skip_refine_text"],
+            params_infer_code=tts_params["params_infer_code"],
+            params_refine_text=tts_params["params_refine_text"]
+        )
+    metrics.inc("tts_segments_total", len(texts))
+    return [_wav_to_numpy(wav) for wav in wavs]
+
+
+def synthesize_segments(segments: Sequence[Dict], batch_size: int = 8,
+                        indices: Optional[Iterable[int]] = None,
+                        cache: Optional[AudioClipCache] = None) -> Dict[int, np.ndarray]:
+    """
+    批量合成片段（默认全部，可用indices限定范围），返回 {片段下标: 波形}；
+    已缓存的片段直接读取，内容完全相同的片段只合成一次；
+    某批失败时退回逐条合成，只跳过真正出错的片段
+    """
+    results: Dict[int, np.ndarray] = {}
+    duplicates: Dict[str, List[int]] = {}  # 缓存键 -> 所有相同片段的下标
+    for idx in (range(len(segments)) if indices is None else indices):
+        segment = segments[idx]
+        if not segment["text"].strip():  # 跳过空文本
+            continue
+        key = segment_cache_key(segment)
+        if cache is not None and key not in duplicates:
+            wav = cache.load(key)
+            if wav is not None:
+                results[idx] = wav
+                continue
+        duplicates.setdefault(key, []).append(idx)
+
+    def store(idx: int, wav: np.ndarray):
+        key = segment_cache_key(segments[idx])
+        if cache is not None:
+            cache.save(key, wav)
+        for same_idx in duplicates[key]:
+            results[same_idx] = wav
+
+    representatives = [same[0] for same in duplicates.values()]
+    for batch in plan_synthesis_batches(segments, batch_size, representatives):
+        first = segments[batch[0]]
+        emotion, speed = first["emotion"], first["speed"]
+        speaker = first["speaker"]
+        texts = [segments[idx]["text"].strip() for idx in batch]
+        print(f"正在生成 [{min(batch)+1}/{len(segments)}] 等{len(batch)}段 - 说话人：{first['speaker']} - 情感：{emotion}")
+        try:
+            for idx, wav in zip(batch, synthesize_batch(texts, emotion, speed, speaker)):
+                store(idx, wav)
+        except Exception as e:
+            if len(batch) == 1:
+                print(f"生成第{batch[0]+1}段语音失败：{str(e)}")
+            else:
+                print(f"批量生成失败，改为逐段生成：{str(e)}")
+                for idx, text in zip(batch, texts):
+                    try:
+                        store(idx, synthesize_batch([text], emotion, speed, speaker)[0])
+                    except Exception as single_error:
+                        print(f"生成第{idx+1}段语音失败：{str(single_error)}")
+    return results
+
+
+def _synthesize_in_windows(segments: Sequence[Dict], batch_size: int, window_size: int,
+                           cache: Optional[AudioClipCache]) -> Iterator[Tuple[int, bytes]]:
+    """单进程合成：逐窗口批量合成，按原文顺序产出 (片段下标, 16bit PCM字节)"""
+    window_size = max(window_size, batch_size)
+    for window_start in range(0, len(segments), window_size):
+        window = range(window_start, min(window_start + window_size, len(segments)))
+        wav_by_index = synthesize_segments(segments, batch_size=batch_size, indices=window, cache=cache)
+        for idx in sorted(wav_by_index):
+            yield idx, StreamingWavWriter.to_pcm16(wav_by_index[idx])
+
+
+def _synthesize_via_server(segments: Sequence[Dict], server_url: str, window_size: int,
+                           roles_path: Optional[str] = None,
+                           speaker_registry_path: Optional[str] = None) -> Iterator[Tuple[int, bytes]]:
+    """交给常驻合成服务：逐窗口发送片段（附带本书的角色档案/向量表路径），按原文顺序产出 (片段下标, 16bit PCM字节)"""
+    from tools_tts_server import TTSServerClient  # 合成服务模块依赖本模块，这里延迟导入
+
+    client = TTSServerClient(server_url)
+    for window_start in range(0, len(segments), window_size):
+        window = segments[window_start:window_start + window_size]
+        for idx, pcm in client.synthesize(window, ordered=True, roles_path=roles_path,
+                                          speaker_registry_path=speaker_registry_path):
+            yield window_start + idx, pcm
+
+
+def generate_voice_from_json(json_path: str, output_path: str = "novel_voice.wav", batch_size: int = 8,
+                             window_size: int = 128, cache_dir: Optional[str] = ".audio_cache",
+                             num_workers: int = 1, roles_path: Optional[str] = None,
+                             speaker_registry_path: str = DEFAULT_REGISTRY_PREFIX,
+                             server_url: Optional[str] = None, start: int = 0, end: Optional[int] = None):
+    """
+    从novel_processed.json生成语音并流式写入完整音频
+    :param json_path: novel_processed.json文件路径；.jsonl片段库以内存映射按窗口读取，不整体载入内存
     :param output_path: 最终合并后的音频文件路径
+    :param batch_size: 每次chat.infer合成的片段数（1表示逐段合成）
+    :param window_size: 每个窗口的片段数；窗口内批量合成后按顺序写盘即释放，内存不随全书长度增长
+    :param cache_dir: 片段音频缓存目录（None表示不缓存）；重跑时只合成改动过的片段
+    :param num_workers: 合成进程数；大于1时启动多进程池，每个进程加载一次模型
+    :param roles_path: 角色档案路径；用于生成/校验角色说话人向量表，保证同一角色音色一致
+    :param speaker_registry_path: 说话人向量表文件前缀
+    :param server_url: 常驻合成服务地址（tools_tts_server.py）；指定时由服务端合成，本进程不加载模型，
+                       片段缓存由服务端管理；roles_path/speaker_registry_path 随请求发给服务端，
+                       服务端按本书的角色向量表合成（须为服务端可访问的路径）
+    :param start: 只合成 [start, end) 区间的片段（分布式任务按区间分片，各区间音频最后再拼接）
+    :param end: 区间终点（默认到最后一个片段）
     """
-    # 1. 读取JSON文件
-    if not os.path.exists(json_path):
-        raise FileNotFoundError(f"JSON文件不存在：{json_path}")
+    # 1. 读取标注结果（JSON数组整体载入；JSONL片段库只做内存映射）
+    novel_data: Sequence[Dict] = load_segments(json_path)
+    if start or end is not None:
+        novel_data = segment_range(novel_data, start, end)  # 片段库只记录区间，合成时按窗口读取
     
-    with open(json_path, "r", encoding="utf-8") as f:
-        novel_data: List[Dict] = json.load(f)
+    # 2. 角色说话人向量表（缓存键依赖其中的音色种子，需先于片段缓存加载）
+    registry = use_speaker_registry(roles_path, speaker_registry_path) if not server_url else None
     
-    # 2. 临时音频片段存储列表
-    temp_audio_segments = []
-    temp_dir = "temp_audio_segments"
-    os.makedirs(temp_dir, exist_ok=True)
+    # 3. 片段缓存与任务清单（中断后重跑从断点继续）
+    cache = AudioClipCache(cache_dir) if cache_dir and not server_url else None
+    manifest = None
+    resume_from, resume_frames = 0, 0
+    if cache is not None:
+        if isinstance(novel_data, (SegmentStore, SegmentStoreView)):
+            job_id = novel_data.content_hash()
+        else:
+            job_id = hashlib.sha256(json.dumps(novel_data, ensure_ascii=False).encode("utf-8")).hexdigest()
+        manifest = SynthesisManifest(f"{output_path}.manifest.jsonl", job_id)
+        resume_from, resume_frames = manifest.resume_point(
+            StreamingWavWriter.resumable_frames(output_path, sample_rate=SAMPLE_RATE))
+        if resume_from:
+            print(f"检测到未完成的任务，已写出 {resume_from} 段，从第 {resume_from + 1} 段继续...")
+    pending_data = segment_range(novel_data, resume_from) if resume_from else novel_data
     
-    # 3. 逐段生成语音
-    for idx, segment in enumerate(novel_data):
-        try:
-            text = segment["text"].strip()
-            speaker = segment["speaker"]
-            emotion = segment["emotion"]
-            speed = segment["speed"]
-            
-            if not text:  # 跳过空文本
-                continue
-            
-            print(f"正在生成 [{idx+1}/{len(novel_data)}] - 说话人：{speaker} - 情感：{emotion}")
-            
-            # 获取ChatTTS参数
-            tts_params = get_chattts_speaker_params(emotion, speed)
-            tts_params["text"] = text
-            
-            # 生成语音（返回音频数据，采样率24000）
-            wav = chat.infer(
-                [text],
-                skip_refine_text=tts_params["skip_refine_text"],
-                params_infer_code=tts_params["params_infer_code"],
-                params_refine_text=tts_params["params_refine_text"]
-            )
-            
-            # 将tensor转为音频片段并保存临时文件
-            wav_tensor = wav[0].cpu().numpy()
-            temp_file = os.path.join(temp_dir, f"segment_{idx}.wav")
-            
-            # 保存为WAV文件（使用pydub）
-            audio_segment = AudioSegment(
-                wav_tensor.tobytes(),
-                frame_rate=24000,
-                sample_width=wav_tensor.dtype.itemsize,
-                channels=1
-            )
-            audio_segment.export(temp_file, format="wav")
-            temp_audio_segments.append(audio_segment)
-            
-        except Exception as e:
-            print(f"生成第{idx+1}段语音失败：{str(e)}")
-            continue
+    # 4. 批量生成语音（合成服务 / 单进程按窗口 / 多进程池），按原文顺序直接追加到输出文件
+    start_time = time.perf_counter()
+    merge_seconds = 0.0
+    if server_url:
+        print(f"使用合成服务：{server_url}")
+        ordered_pcm = _synthesize_via_server(pending_data, server_url, window_size, roles_path, speaker_registry_path)
+    elif num_workers > 1:
+        print(f"启动 {num_workers} 个合成进程...")
+        ordered_pcm = synthesize_in_pool(pending_data, num_workers, batch_size=batch_size,
+                                         range_size=window_size, cache_dir=cache_dir,
+                                         backend_factory=get_backend_factory(),
+                                         speaker_registry_path=speaker_registry_path if registry else None)
+    else:
+        ordered_pcm = _synthesize_in_windows(pending_data, batch_size, window_size, cache)
+    with metrics.stage("synthesis"), \
+            StreamingWavWriter(output_path, sample_rate=SAMPLE_RATE, resume_frames=resume_frames) as writer:
+        next_idx = resume_from
+        for idx, pcm in ordered_pcm:
+            idx += resume_from
+            if manifest is not None:
+                # 中间没有产出的片段（空文本/合成失败）同样记为已处理，续写时不必停在它们之前
+                for skipped_idx in range(next_idx, idx):
+                    manifest.record(skipped_idx, None, frames=writer.frames_written)
+            next_idx = idx + 1
+            write_start = time.perf_counter()
+            writer.write_pcm(pcm)
+            merge_seconds += time.perf_counter() - write_start
+            if manifest is not None:
+                manifest.record(idx, segment_cache_key(novel_data[idx]), frames=writer.frames_written)
+        total_seconds = writer.duration_seconds
+    wall_seconds = time.perf_counter() - start_time
+    metrics.set_gauge("tts_audio_seconds", total_seconds)
+    metrics.set_gauge("tts_audio_seconds_per_wall_second", total_seconds / wall_seconds if wall_seconds else 0.0)
+    metrics.set_gauge("audio_merge_seconds", merge_seconds)
+    if cache is not None and num_workers <= 1:
+        metrics.set_gauge("tts_cache_hits", cache.hits)
+        metrics.set_gauge("tts_cache_misses", cache.misses)
     
-    # 4. 合并所有音频片段
-    if not temp_audio_segments:
+    # 5. 检查是否生成了音频
+    if total_seconds <= 0:
+        os.remove(output_path)
         raise ValueError("未生成任何音频片段")
+    if manifest is not None:
+        manifest.remove()  # 任务完成，下次运行全部走缓存
+        if num_workers <= 1:
+            print(f"片段缓存：命中 {cache.hits} 段，新合成 {cache.misses} 段")
     
-    merged_audio = AudioSegment.empty()
-    for seg in temp_audio_segments:
-        merged_audio += seg
-    
-    # 5. 保存最终音频文件
-    merged_audio.export(output_path, format="wav")
-    print(f"\n音频生成完成！文件保存至：{os.path.abspath(output_path)}")
-    
-    # 6. 清理临时文件（可选）
-    for file in os.listdir(temp_dir):
-        os.remove(os.path.join(temp_dir, file))
-    os.rmdir(temp_dir)
+    print(f"\n音频生成完成（时长 {total_seconds:.1f} 秒）！文件保存至：{os.path.abspath(output_path)}")
 
 
 if __name__ == "__main__":
-    # 配置文件路径
-    JSON_FILE_PATH = "novel_processed.json"  # 你的JSON文件路径
-    OUTPUT_AUDIO_PATH = "novel_full_voice.wav"  # 输出音频路径
+    parser = argparse.ArgumentParser(description="从novel_processed.json生成有声书音频（ChatTTS）")
+    parser.add_argument("--input", default="novel_processed.json", help="预处理后的JSON文件或.jsonl片段库路径")
+    parser.add_argument("--output", default="novel_full_voice.wav", help="输出音频路径")
+    parser.add_argument("--roles", default="novel_roles.json", help="角色档案路径（生成角色说话人向量表）")
+    parser.add_argument("--batch-size", type=int, default=8, help="每批合成的片段数（显存/内存不足时调小）")
+    parser.add_argument("--workers", type=int, default=1, help="合成进程数（多核CPU机器可设为核数/2左右）")
+    parser.add_argument("--no-cache", action="store_true", help="不使用片段音频缓存")
+    parser.add_argument("--warm-up", action="store_true", help="正式合成前先加载模型并预热")
+    parser.add_argument("--server", default=None,
+                        help="常驻合成服务地址（如 http://127.0.0.1:8765 或 unix:///tmp/tts.sock），指定时不在本进程加载模型")
+    args = parser.parse_args()
     
     try:
+        if args.warm_up and args.workers <= 1 and not args.server:
+            print(f"模型预热完成，耗时 {warm_up():.1f} 秒")
         # 生成语音
-        generate_voice_from_json(JSON_FILE_PATH, OUTPUT_AUDIO_PATH)
+        generate_voice_from_json(args.input, args.output, batch_size=args.batch_size,
+                                 cache_dir=None if args.no_cache else ".audio_cache",
+                                 num_workers=args.workers, roles_path=args.roles, server_url=args.server)
     except Exception as e:
-        print(f"程序执行失败：{str(e)}")
\ No newline at end of file
+        print(f"程序执行失败：{str(e)}")
+    finally:
+        report_path = metrics.export("synthesis")
+        if report_path:
+            print(f"运行指标已保存至：{report_path}")
@@ -1,9 +1,17 @@
+import argparse
 import os
-import requests
 import json
 import re
 from typing import List, Dict, Any
+from tools_batch_api import BatchRequestWriter, default_request_path, default_results_path, load_batch_units
 from tools_call_qianwen import call_qianwen_api_via_requests
+from tools_chunker import estimate_tokens, iter_chunks
+from tools_concurrent import RateLimiter, dispatch_in_order
+from tools_json_repair import MAX_CONTINUATIONS, parse_json_array
+from tools_metrics import metrics
+from tools_moderation import (is_moderation_error, log_skipped_fragment, run_with_bisection,
+                             skipped_fragment_logger)
+from tools_role_prefilter import RolePrefilter, RoleRequest, plan_role_requests
 
 # ===================== 配置项 =====================
 # 替换为你的通义千问API Key（获取地址：https://dashscope.aliyun.com/）
@@ -16,6 +24,18 @@ NOVEL_TXT_PATH = r"D:\Python\code\generate_voice_by_llm\novel_10k.txt"  # window
 OUTPUT_JSON_PATH = "./novel_roles.json"
 
 MODEL_NAME = "qwen-turbo"  # 或 'qwen-plus', 'qwen-max' 等
+USE_LLM_CACHE = True  # 复用本地缓存的相同请求结果；设为False强制重新请求
+
+# 并发与限流配置（按账号的模型限额调整）
+MAX_CONCURRENCY = 8        # 同时在途的API请求数
+RPM_LIMIT = 300            # 每分钟请求数上限（0表示不限制）
+TPM_LIMIT = 500000         # 每分钟token数上限（0表示不限制）
+PROMPT_OVERHEAD_TOKENS = 500  # 角色提取Prompt模板本身的token开销估算
+
+# 切块配置（按估算token数装箱，在句子边界切分）
+CHUNK_MAX_TOKENS = 1600     # 每块token预算（约2000个汉字）
+CHUNK_OVERLAP_TOKENS = 0    # 相邻块重叠的token数（角色跨块出场时可适当调大，重复角色由merge_roles去重）
+USE_NAME_PREFILTER = True   # 本地预筛候选人名：没有新角色的块不调用大模型，有新角色的块只摘取相关句子合并请求
 
 # ===================== 核心函数 =====================
 def read_novel_text(file_path: str, encoding: str = "utf-8") -> str:
@@ -36,32 +56,26 @@ def read_novel_text(file_path: str, encoding: str = "utf-8") -> str:
     except Exception as e:
         raise Exception(f"读取小说文件失败：{str(e)}")
 
-def split_long_text(text: str, chunk_size: int = 2000) -> List[str]:
-    """拆分长文本为若干段（适配大模型输入上限）"""
-    chunks = []
-    start = 0
-    text_length = len(text)
-    while start < text_length:
-        end = start + chunk_size
-        # 按句子断句，避免拆分到中间
-        if end < text_length:
-            # 找最近的句号/换行拆分
-            split_pos = text.rfind("。", start, end) + 1
-            if split_pos <= start:
-                split_pos = text.rfind("\n", start, end) + 1
-            if split_pos <= start:
-                split_pos = end
-            end = split_pos
-        chunks.append(text[start:end].strip())
-        start = end
-    return chunks
-
-
-
 def extract_roles_from_chunk(chunk_text: str, api_key: str) -> List[Dict[str, Any]]:
-    """从单段文本中提取角色信息"""
+    """从单段文本中提取角色信息（输出被截断时，排除已提取的角色补请求剩余部分）"""
+    valid_roles = []
+    exclude_line = ""
+    for _ in range(MAX_CONTINUATIONS + 1):
+        roles, complete = _request_roles(chunk_text, exclude_line)
+        known_names = {role["name"] for role in valid_roles}
+        new_roles = [role for role in roles if role["name"] not in known_names]
+        valid_roles.extend(new_roles)
+        if complete or not new_roles:
+            break
+        names = "、".join(role["name"] for role in valid_roles)
+        print(f"    ↪️  角色输出被截断，已保留 {len(valid_roles)} 个，补请求其余角色")
+        exclude_line = f"\n    5. 以下角色已经提取过，不要重复输出：{names}"
+    return valid_roles
+
+def _role_prompt(chunk_text: str, exclude_line: str = "") -> str:
+    """角色提取的提示词（实时调用与Batch请求文件共用）"""
     # 核心Prompt：引导大模型输出结构化角色信息（适配ChatTTS）
-    prompt = f"""
+    return f"""
     请分析以下小说文本，提取所有出场角色的信息，严格按照JSON格式输出（仅输出JSON，无其他解释）：
     要求：
     1. 角色信息包含：
@@ -83,32 +97,66 @@ def extract_roles_from_chunk(chunk_text: str, api_key: str) -> List[Dict[str, An
             "voice_style": "沉稳女声",
             "description": "女主角，咖啡馆店员，性格细腻，对感情执着"
         }}
-    ]
+    ]{exclude_line}
 
     小说文本：
     {chunk_text}
     """
-    # 调用API
-    raw_output = call_qianwen_api_via_requests(QWEN_API_KEY, MODEL_NAME, prompt)
-    # 清洗输出（去除可能的markdown代码块、多余文字）
-    raw_output = raw_output.strip().replace("```json", "").replace("```", "").replace("\\n", "")
-    # 解析JSON
-    try:
-        roles = json.loads(raw_output)
-        # 校验格式（过滤无效角色）
-        valid_roles = []
-        for role in roles:
-            if isinstance(role, dict) and "name" in role and role["name"] != "未知":
-                # 补全缺失字段
-                role.setdefault("gender", "未知")
-                role.setdefault("age", "未知")
-                role.setdefault("personality", "未知")
-                role.setdefault("voice_style", "中性声线")
-                role.setdefault("description", "未知")
-                valid_roles.append(role)
-        return valid_roles
-    except json.JSONDecodeError:
+
+def _request_roles(chunk_text: str, exclude_line: str = ""):
+    """请求一次角色提取，返回 (有效角色列表, 输出是否完整)"""
+    raw_output = call_qianwen_api_via_requests(QWEN_API_KEY, MODEL_NAME, _role_prompt(chunk_text, exclude_line),
+                                               use_cache=USE_LLM_CACHE)
+    return _parse_roles(raw_output)
+
+def _parse_roles(raw_output: str):
+    """解析角色提取的输出，返回 (有效角色列表, 输出是否完整)"""
+    # 容错解析：去除markdown代码块/多余文字，保留全部完整的角色，过滤无效角色
+    parsed = parse_json_array(
+        raw_output,
+        validate=lambda role: isinstance(role, dict) and "name" in role and role["name"] != "未知",
+    )
+    if not parsed.found:
         raise Exception(f"大模型输出格式错误，原始输出：{raw_output}")
+    if parsed.repairs or parsed.dropped:
+        print(f"    🔧 角色输出{parsed.summary()}")
+    for role in parsed.items:
+        # 补全缺失字段
+        role.setdefault("gender", "未知")
+        role.setdefault("age", "未知")
+        role.setdefault("personality", "未知")
+        role.setdefault("voice_style", "中性声线")
+        role.setdefault("description", "未知")
+    return parsed.items, parsed.complete
+
+def extract_roles_with_bisection(chunk_text: str, api_key: str, label: str = "") -> List[Dict[str, Any]]:
+    """
+    提取角色；整段触发内容审核时按句子二分重试，只丢弃被拒绝的句子
+    （被拒绝的句子记录在本地，之后不再发送）
+    """
+    result = run_with_bisection(chunk_text, lambda fragment: extract_roles_from_chunk(fragment, api_key),
+                                on_rejected=skipped_fragment_logger(label, "role_extraction"))
+    return [role for roles in result.values for role in roles]
+
+def plan_requests(text_chunks: List[str], book_text: str, known_roles: List[Dict] = None,
+                  use_prefilter: bool = USE_NAME_PREFILTER) -> List[RoleRequest]:
+    """
+    规划角色提取请求：开启预筛时跳过没有新候选人名的块，并把各块的相关句子装箱成更少的请求；
+    否则每块一个请求（与逐块提取相同）
+
+    Args:
+        text_chunks: 待提取的文本块
+        book_text: 全书文本（统计候选人名的出现次数）
+        known_roles: 已有角色档案（增量更新时传入，其中的角色视为已覆盖）
+        use_prefilter: 是否启用本地预筛
+    """
+    if not use_prefilter:
+        return [RoleRequest(chunk, [idx]) for idx, chunk in enumerate(text_chunks)]
+    role_requests = plan_role_requests(text_chunks, RolePrefilter(known_roles or [], book_text), CHUNK_MAX_TOKENS)
+    skipped = len(text_chunks) - len({idx for request in role_requests for idx in request.chunk_indices})
+    metrics.inc("role_prefilter_skipped_chunks_total", skipped)
+    print(f"本地预筛：{len(text_chunks)} 段中 {skipped} 段没有新角色，其余合并为 {len(role_requests)} 次请求")
+    return role_requests
 
 def merge_roles(role_chunks: List[List[Dict]]) -> List[Dict]:
     """合并多段文本的角色信息（去重，保留最全信息）"""
@@ -151,6 +199,73 @@ def generate_chattts_voice_map(roles: List[Dict]) -> Dict[str, str]:
         role_voice_map[role["name"]] = matched_voice
     return role_voice_map
 
+def save_roles(merged_roles: List[Dict]):
+    """生成ChatTTS音色映射，把角色档案写入 OUTPUT_JSON_PATH 并打印结果"""
+    # 生成ChatTTS音色映射
+    voice_map = generate_chattts_voice_map(merged_roles)
+    result = {
+        "roles": merged_roles,
+        "chattts_voice_map": voice_map,  # 直接适配ChatTTS的音色映射
+        "total_roles": len(merged_roles)
+    }
+    with open(OUTPUT_JSON_PATH, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=4)
+
+    # 打印结果
+    print("\n===== 角色提取结果 =====")
+    print(f"共提取 {len(merged_roles)} 个角色：")
+    for role in merged_roles:
+        print(f"- {role['name']} | 性别：{role['gender']} | 年龄：{role['age']} | 语音风格：{role['voice_style']}")
+    print(f"\n角色档案已保存至：{OUTPUT_JSON_PATH}")
+    print(f"\nChatTTS音色映射表：\n{json.dumps(voice_map, ensure_ascii=False, indent=4)}")
+
+# ===================== Batch模式 =====================
+def emit_batch_requests(request_path: str, use_prefilter: bool = USE_NAME_PREFILTER) -> int:
+    """
+    不实时调用，把每次角色提取请求写成DashScope Batch请求文件（JSONL），提交后离线等待结果
+    （切块与本地预筛同实时模式，custom_id由序号和提示词哈希生成，重新生成时保持不变）
+
+    Returns:
+        请求条数
+    """
+    novel_text = read_novel_text(NOVEL_TXT_PATH)
+    text_chunks = list(iter_chunks(novel_text, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS))
+    role_requests = plan_requests(text_chunks, novel_text, use_prefilter=use_prefilter)
+    with BatchRequestWriter(request_path, "roles", MODEL_NAME) as writer:
+        for request in role_requests:
+            writer.add(_role_prompt(request.text), {"label": request.label, "text": request.text})
+    print(f"已写出 {writer.requests} 条Batch请求：{request_path}")
+    return writer.requests
+
+def ingest_batch_results(request_path: str, result_paths: List[str]) -> List[Dict]:
+    """
+    读取Batch结果文件，按请求顺序解析角色并合并，写出角色档案（与实时模式的输出相同）
+
+    - 输出被截断时无法补请求，保留已完整输出的角色（同一角色通常在多段中出现，合并后影响很小）
+    - 触发内容审核的段落在本地实时二分重试，只丢弃被拒绝的句子
+    - 其余失败的请求写入重试文件后报错，不写出角色档案
+
+    Args:
+        request_path: emit_batch_requests 写出的请求文件
+        result_paths: Batch结果文件（可多个，如原结果 + 重试结果）
+    """
+    all_role_chunks = []
+    for meta, outcome in load_batch_units(request_path, result_paths):
+        label = meta["label"]
+        if not outcome.ok:
+            print(f"    ⚠️  第{label}段触发内容安全审核，实时二分重试")
+            all_role_chunks.append(extract_roles_with_bisection(meta["text"], QWEN_API_KEY, label=label))
+            continue
+        roles, complete = _parse_roles(outcome.result.text)
+        if outcome.result.truncated or not complete:
+            print(f"    ✂️  第{label}段输出被截断，保留已完整输出的 {len(roles)} 个角色")
+        print(f"    ✅ 第{label}段提取 {len(roles)} 个角色")
+        all_role_chunks.append(roles)
+    merged_roles = merge_roles(all_role_chunks)
+    metrics.set_gauge("roles", len(merged_roles))
+    save_roles(merged_roles)
+    return merged_roles
+
 # ===================== 主函数 =====================
 def main():
     try:
@@ -160,76 +275,95 @@ def main():
         print(f"小说总长度：{len(novel_text)} 字符")
         
         print("Step 2: 拆分长文本...")
-        text_chunks = split_long_text(novel_text, chunk_size=2000)
+        text_chunks = list(iter_chunks(novel_text, max_tokens=CHUNK_MAX_TOKENS,
+                                       overlap_tokens=CHUNK_OVERLAP_TOKENS))
         print(f"拆分为 {len(text_chunks)} 段处理")
 
-        # 2. 逐段提取角色信息
-        print("Step 3: 调用千问API提取角色信息...")
+        role_requests = plan_requests(text_chunks, novel_text)
+
+        # 2. 并发提取角色信息（结果按段落顺序返回，保证合并结果稳定）
+        print(f"Step 3: 调用千问API提取角色信息（{len(role_requests)} 次请求，并发数 {MAX_CONCURRENCY}）...")
         all_role_chunks = []
         successful_chunks = 0
         failed_chunks = 0
 
-        for i, chunk in enumerate(text_chunks, 1):
-            print(f"  处理第 {i}/{len(text_chunks)} 段...")
-            try:
-                roles = extract_roles_from_chunk(chunk, QWEN_API_KEY)
+        limiter = RateLimiter(rpm=RPM_LIMIT, tpm=TPM_LIMIT)
+
+        def extract_timed(request: RoleRequest):
+            with metrics.timer("chunk_seconds", stage="role_extraction"):
+                return extract_roles_with_bisection(request.text, QWEN_API_KEY, label=request.label)
+
+        with metrics.stage("role_extraction"):
+            results = dispatch_in_order(
+                extract_timed,
+                role_requests,
+                max_workers=MAX_CONCURRENCY,
+                limiter=limiter,
+                cost_fn=lambda request: estimate_tokens(request.text) + PROMPT_OVERHEAD_TOKENS,
+                on_done=lambda r: print(f"  第 {r.index + 1}/{len(role_requests)} 次请求完成"),
+                should_abort=lambda e: not is_moderation_error(str(e)),
+            )
+
+        for request, result in zip(role_requests, results):
+            i = request.label
+            if result.ok:
+                roles = result.value
                 if roles:  # 如果有提取到角色
                     all_role_chunks.append(roles)
                     successful_chunks += 1
-                    print(f"    ✅ 成功提取 {len(roles)} 个角色")
+                    print(f"    ✅ 第{i}段成功提取 {len(roles)} 个角色")
                 else:
                     all_role_chunks.append([])
-                    print(f"    ⚠️  未提取到角色")
-                    
-            except Exception as e:
-                error_msg = str(e)
-                
-                # 检查是否是内容审核错误
-                if "inappropriate content" in error_msg or "For details, see: https://help.aliyun.com/zh/model-studio/error-code#inappropriate-content" in error_msg:
-                    print(f"    ⚠️  第{i}段触发内容安全审核，已跳过")
-                    all_role_chunks.append([])  # 添加空列表保持索引一致
-                    failed_chunks += 1
-                    
-                    # 可选：记录被跳过的段落信息到日志文件
-                    with open("skipped_chunks.log", "a", encoding="utf-8") as log_file:
-                        log_file.write(f"=== 跳过的段落 {i} ===\n")
-                        log_file.write(f"字符数: {len(chunk)}\n")
-                        log_file.write(f"前200字符: {chunk[:200]}...\n")
-                        log_file.write(f"错误信息: {error_msg}\n")
-                        log_file.write("="*50 + "\n")
-                        
-                else:
-                    # 如果是其他错误，重新抛出
-                    print(f"    ❌ 第{i}段处理失败（非内容审核错误）: {error_msg}")
-                    raise e  # 重新抛出其他异常
+                    print(f"    ⚠️  第{i}段未提取到角色")
+                continue
+
+            error_msg = str(result.error)
+            # 检查是否是内容审核错误
+            if is_moderation_error(error_msg):
+                print(f"    ⚠️  第{i}段触发内容安全审核，已跳过")
+                all_role_chunks.append([])  # 添加空列表保持索引一致
+                failed_chunks += 1
+                metrics.inc("moderation_skips_total", stage="role_extraction")
+
+                # 可选：记录被跳过的段落信息到日志文件
+                log_skipped_fragment(i, request.text, error_msg)
+            else:
+                # 如果是其他错误，重新抛出（其余未开始的段落已被取消）
+                print(f"    ❌ 第{i}段处理失败（非内容审核错误）: {error_msg}")
+                raise result.error
 
         print(f"\n段落处理完成：成功 {successful_chunks} 段，跳过 {failed_chunks} 段（因内容审核）")
 
         # 3. 合并角色信息
         print("Step 4: 合并角色信息（去重）...")
-        merged_roles = merge_roles(all_role_chunks)
-        # 生成ChatTTS音色映射
-        voice_map = generate_chattts_voice_map(merged_roles)
-
+        with metrics.stage("role_merge"):
+            merged_roles = merge_roles(all_role_chunks)
+        metrics.set_gauge("roles", len(merged_roles))
         # 4. 保存结果
-        result = {
-            "roles": merged_roles,
-            "chattts_voice_map": voice_map,  # 直接适配ChatTTS的音色映射
-            "total_roles": len(merged_roles)
-        }
-        with open(OUTPUT_JSON_PATH, "w", encoding="utf-8") as f:
-            json.dump(result, f, ensure_ascii=False, indent=4)
-        
-        # 打印结果
-        print("\n===== 角色提取结果 =====")
-        print(f"共提取 {len(merged_roles)} 个角色：")
-        for role in merged_roles:
-            print(f"- {role['name']} | 性别：{role['gender']} | 年龄：{role['age']} | 语音风格：{role['voice_style']}")
-        print(f"\n角色档案已保存至：{OUTPUT_JSON_PATH}")
-        print(f"\nChatTTS音色映射表：\n{json.dumps(voice_map, ensure_ascii=False, indent=4)}")
+        save_roles(merged_roles)
 
     except Exception as e:
         print(f"\n处理失败：{str(e)}")
+    finally:
+        report_path = metrics.export("role_extraction")
+        if report_path:
+            print(f"运行指标已保存至：{report_path}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="调用大模型提取小说角色档案")
+    parser.add_argument("mode", nargs="?", default="run", choices=["run", "batch-emit", "batch-ingest"],
+                        help="run：实时调用；batch-emit：写出Batch请求文件；batch-ingest：读取Batch结果文件并写出角色档案")
+    parser.add_argument("--requests", default=default_request_path("roles"), help="Batch请求文件路径")
+    parser.add_argument("--results", nargs="+", default=None, help="Batch结果文件路径（可多个，默认与请求文件同目录）")
+    parser.add_argument("--no-prefilter", action="store_true", help="batch-emit时不做本地人名预筛（每段一个请求）")
+    args = parser.parse_args()
+
+    if args.mode == "run":
+        main()
+    elif args.mode == "batch-emit":
+        emit_batch_requests(args.requests, use_prefilter=not args.no_prefilter)
+    else:
+        try:
+            ingest_batch_results(args.requests, args.results or [default_results_path(args.requests)])
+        except Exception as e:
+            print(f"\n处理失败：{str(e)}")
\ No newline at end of file
@@ -1,33 +1,44 @@
-import requests
-import json
+import argparse
 import os
-from typing import List, Dict
+from dataclasses import asdict
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 
-from tools_call_qianwen import call_qianwen_api_via_requests
+from tools_batch_api import BatchRequestWriter, default_request_path, default_results_path, load_batch_units
+from tools_call_qianwen import call_qianwen_api_via_requests, call_qianwen_api_with_result
+from tools_chunker import AdaptiveChunkSizer, estimate_tokens, iter_adaptive_chunks, iter_chunks
+from tools_json_repair import MAX_CONTINUATIONS, parse_json_array, remaining_tail
+from tools_metrics import metrics
+from tools_moderation import get_default_verdicts, is_moderation_error, run_with_bisection, skipped_fragment_logger
+from tools_role_index import load_role_index
+from tools_rule_annotator import NARRATOR, AnnotatedSpan, annotate_by_rules, mark_pending_spans
+from tools_segment_store import open_segment_writer
 
 
 
 MODEL_NAME = "qwen-turbo"  # 或 'qwen-plus', 'qwen-max' 等
+USE_LLM_CACHE = True  # 复用本地缓存的相同请求结果；设为False强制重新请求
+CHUNK_MAX_TOKENS = 1600  # 每个文本块的token预算（约2000个汉字）
+ROLE_CONTEXT_CHARS = 200  # 挑选角色时额外参考的上文字数
+USE_RULE_ANNOTATOR = True  # 先用本地规则标注，只把说话人不确定的对白交给大模型
+OUTPUT_TOKEN_LIMIT = 1500  # 模型单次输出的token上限（qwen-turbo默认值；实际截断时会按usage自动修正）
+BATCH_LLM_CHUNK_TOKENS = 500  # Batch模式整段交给大模型时的块大小（没有截断反馈可供自适应，取保守值）
+ATTRIBUTION_PACK_TOKENS = 6000  # 规则标注后，相邻多块的待定对白合并为一次请求时的文本token预算
+ATTRIBUTION_PACK_SPANS = OUTPUT_TOKEN_LIMIT // 30  # 每次请求最多判断的对白条数（每条判断约输出30 token）
 
 
-def preprocess_novel_text(raw_text: str, api_key: str,novel_roles_path: str) -> List[Dict]:
-    """
-    调用大模型预处理小说文本，返回结构化的角色/情感/语速标注数据
-    
-    Args:
-        raw_text: 原始小说文本
-        api_key: 通义千问API Key（需自行申请：https://dashscope.aliyun.com/）
-    
-    Returns:
-        结构化列表，每个元素包含text/speaker/emotion/speed
-    """
-    with open(novel_roles_path, "r", encoding="utf-8") as f:
-        role_data = json.load(f)
-    # role_prompt = role_data["roles"]
+def make_chunk_sizer(initial_tokens: int = CHUNK_MAX_TOKENS) -> AdaptiveChunkSizer:
+    """整段交给大模型标注时使用的自适应块大小（输出JSON比原文长数倍，块过大会被截断）"""
+    return AdaptiveChunkSizer(initial_tokens=initial_tokens, output_limit=OUTPUT_TOKEN_LIMIT)
 
-    # 1. 构造大模型提示词
-    prompt = f"""
-    {role_data}
+
+def _is_valid_segment(item) -> bool:
+    """标注片段必须是包含 text/speaker/emotion/speed 的字典"""
+    return isinstance(item, dict) and all(field in item for field in ("text", "speaker", "emotion", "speed"))
+
+def _annotation_prompt(role_block: str, raw_text: str) -> str:
+    """整段标注的提示词"""
+    return f"""
+    {role_block}
     请严格按照以下要求处理小说文本，仅输出JSON格式结果（不要额外解释）：
     1. 文本清洗：去除无关空格/重复标点，保留完整语义；
     2. 分段断句：按自然语义拆分，每段不超过200字；
@@ -54,29 +65,62 @@ def preprocess_novel_text(raw_text: str, api_key: str,novel_roles_path: str) ->
         }}
     ]
     """
-    # 2. 调用通义千问API
-    raw_output = call_qianwen_api_via_requests(api_key, MODEL_NAME, prompt)
-    # 清洗输出（去除可能的markdown代码块、多余文字）
-    raw_output = raw_output.strip().replace("```json", "").replace("```", "").replace("\\n", "")
-    # return raw_output
 
-    # ========== 关键修复：把JSON字符串解析成字典列表 ==========
-    try:
-        processed_data = json.loads(raw_output)  # 解析为列表/字典
-        # 校验解析结果是否为列表（确保格式符合要求）
-        if not isinstance(processed_data, list):
-            raise ValueError(f"大模型输出不是列表格式，原始输出：{raw_output}")
-        # 校验每个元素是否为字典，且包含必要字段
-        required_fields = ["text", "speaker", "emotion", "speed"]
-        for item in processed_data:
-            if not isinstance(item, dict):
-                raise ValueError(f"片段不是字典：{item}")
-            for field in required_fields:
-                if field not in item:
-                    raise ValueError(f"缺失必要字段{field}：{item}")
-        return processed_data  # 返回解析后的字典列表
-    except json.JSONDecodeError as e:
-        raise Exception(f"大模型输出不是合法JSON，原始输出：{raw_output}，错误：{e}")
+def preprocess_novel_text(raw_text: str, api_key: str,novel_roles_path: str, context: str = "",
+                          sizer: Optional[AdaptiveChunkSizer] = None) -> List[Dict]:
+    """
+    调用大模型预处理小说文本，返回结构化的角色/情感/语速标注数据
+    
+    Args:
+        raw_text: 原始小说文本
+        api_key: 通义千问API Key（需自行申请：https://dashscope.aliyun.com/）
+        novel_roles_path: 角色档案路径（只把本段及上下文中出现的角色注入提示词）
+        context: 可选，紧邻本段的上文（只用于挑选角色，不参与标注）
+        sizer: 可选，把每次调用的输入/输出token数和是否截断反馈给自适应块大小
+    
+    Returns:
+        结构化列表，每个元素包含text/speaker/emotion/speed
+    """
+    # 角色索引只构建一次；提示词中只放本段出现的角色，而不是整份角色档案
+    role_block = load_role_index(novel_roles_path).prompt_block(raw_text, context)
+
+    segments: List[Dict] = []
+    pending_text = raw_text
+    use_cache = USE_LLM_CACHE
+    for _ in range(MAX_CONTINUATIONS + 1):
+        # 1. 构造大模型提示词（输出被截断时只对剩余文本补请求）
+        prompt = _annotation_prompt(role_block, pending_text)
+        # 2. 调用通义千问API
+        result = call_qianwen_api_with_result(api_key, MODEL_NAME, prompt, use_cache=use_cache)
+        raw_output = result.text
+
+        # 3. 容错解析：保留全部完整片段，丢弃个别损坏片段，截断时记下剩余文本
+        parsed = parse_json_array(raw_output, validate=_is_valid_segment)
+        if not parsed.found:
+            raise Exception(f"大模型输出不是合法JSON，原始输出：{raw_output}")
+        if result.truncated:
+            print(f"    ✂️  输出达到token上限被截断（{len(pending_text)} 字，usage={result.usage}）")
+        if sizer is not None:
+            sizer.record(estimate_tokens(pending_text),
+                         result.usage.get("output_tokens") or estimate_tokens(raw_output),
+                         truncated=result.truncated or not parsed.complete)
+        if parsed.repairs or parsed.dropped or not parsed.complete:
+            print(f"    🔧 标注输出{parsed.summary()}")
+        if parsed.complete:
+            return segments + parsed.items
+
+        tail = remaining_tail(pending_text, [item["text"] for item in parsed.items]) if parsed.items else None
+        if tail is None:
+            # 定位不到已完成的位置：整段重新请求（跳过缓存，避免拿回同一个截断结果）
+            print(f"    ↪️  无法定位截断位置，重新请求整段（{len(pending_text)} 字）")
+            use_cache = False
+            continue
+        segments.extend(parsed.items)
+        if not tail:
+            return segments
+        print(f"    ↪️  补请求剩余 {len(tail)} 字")
+        pending_text = tail
+    raise Exception(f"大模型输出多次被截断，剩余 {len(pending_text)} 字未完成标注")
     # # 2. 调用通义千问API
     # url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
     # headers = {
@@ -140,6 +184,230 @@ def preprocess_novel_text(raw_text: str, api_key: str,novel_roles_path: str) ->
     # except KeyError as e:
     #     raise Exception(f"API返回字段缺失：{str(e)}，原始返回：{result}")
 
+def attribute_speakers_by_llm(spans: List[AnnotatedSpan], api_key: str, role_block: str,
+                              known: Optional[Dict[int, Dict]] = None) -> Dict[int, Dict]:
+    """
+    只把规则无法确定说话人的对白交给大模型判断
+
+    Args:
+        spans: annotate_by_rules 的结果（待定对白已编号）
+        api_key: 通义千问API Key
+        role_block: 本段角色清单（RoleIndex.prompt_block）
+        known: 可选，已得到的判断（如被截断的Batch结果），只对缺少的编号补请求
+
+    Returns:
+        {对白编号: {"speaker", "emotion", "speed"}}
+    """
+    marked_text = mark_pending_spans(spans)
+    all_ids = {span.span_id for span in spans if not span.resolved}
+    verdicts: Dict[int, Dict] = dict(known or {})
+    missing = sorted(all_ids - verdicts.keys())
+    only_line = _only_ids_line(missing) if verdicts else ""
+    for _ in range(MAX_CONTINUATIONS + 1):
+        if not missing:
+            break
+        prompt = _attribution_prompt(role_block, marked_text, only_line)
+        raw_output = call_qianwen_api_via_requests(api_key, MODEL_NAME, prompt, use_cache=USE_LLM_CACHE)
+        parsed = _parse_verdicts(raw_output)
+        verdicts.update((int(item["id"]), item) for item in parsed.items)
+        missing = sorted(all_ids - verdicts.keys())
+        # 输出完整时缺的编号按旁白处理；被截断时只补请求缺少的编号
+        if parsed.complete or not missing or not parsed.items:
+            break
+        print(f"    🔧 对白判断输出{parsed.summary()}，补请求 {len(missing)} 条")
+        only_line = _only_ids_line(missing)
+    return verdicts
+
+def _only_ids_line(span_ids: List[int]) -> str:
+    """补请求时限定输出编号的提示行"""
+    return f"\n    4. 只需输出以下编号：{'、'.join(str(span_id) for span_id in span_ids)}。"
+
+def _attribution_prompt(role_block: str, marked_text: str, only_line: str = "") -> str:
+    """待定对白判断说话人的提示词"""
+    return f"""
+    {role_block}
+    下面的小说文本中，用【编号】标出了说话人不确定的对白（与其无关的部分以「……」省略）。请结合上下文判断每条编号对白的说话人、情感和语速，
+    仅输出JSON数组（不要额外解释）：
+    1. speaker：角色名（尽量使用上面角色清单中的名称），无法判断时填「旁白」；
+    2. emotion：仅用 neutral/happy/sad/angry/calm/surprised 标注；
+    3. speed：0.8~1.2之间的浮点数（默认1.0）。{only_line}
+
+    小说文本：
+    {marked_text}
+
+    输出格式示例：
+    [
+        {{"id": 1, "speaker": "侯大利", "emotion": "calm", "speed": 1.0}}
+    ]
+    """
+
+def _parse_verdicts(raw_output: str):
+    """解析对白判断的输出（保留全部完整的条目）"""
+    parsed = parse_json_array(
+        raw_output,
+        validate=lambda item: isinstance(item, dict) and str(item.get("id", "")).isdigit() and item.get("speaker"),
+    )
+    if not parsed.found:
+        raise Exception(f"大模型输出不是合法JSON，原始输出：{raw_output}")
+    return parsed
+
+def _apply_verdicts(spans: List[AnnotatedSpan], verdicts: Dict[int, Dict]) -> List[Dict]:
+    """把大模型的判断填回待定对白，返回标注结果（未得到判断的对白按旁白处理）"""
+    for span in spans:
+        if span.resolved:
+            continue
+        verdict = verdicts.get(span.span_id)
+        if verdict is None:
+            print(f"    ⚠️  对白【{span.span_id}】未得到大模型判断，按旁白处理")
+            verdict = {"speaker": NARRATOR}
+        span.speaker = verdict["speaker"]
+        span.emotion = verdict.get("emotion", "neutral")
+        span.speed = float(verdict.get("speed", 1.0))
+    return [span.to_record() for span in spans]
+
+def annotate_novel_text(raw_text: str, api_key: str, novel_roles_path: str, context: str = "") -> List[Dict]:
+    """
+    先用本地规则标注（旁白、说明语无歧义的对白），只把说话人不确定的对白交给大模型；
+    整段都能确定时不发任何请求。返回格式与 preprocess_novel_text 相同
+
+    Args:
+        raw_text: 原始小说文本
+        api_key: 通义千问API Key
+        novel_roles_path: 角色档案路径
+        context: 可选，紧邻本段的上文（只用于挑选角色）
+    """
+    return annotate_novel_texts([raw_text], api_key, novel_roles_path, context)[0]
+
+def annotate_novel_texts(raw_texts: List[str], api_key: str, novel_roles_path: str,
+                         context: str = "") -> List[List[Dict]]:
+    """
+    与 annotate_novel_text 相同，但一次处理多个相邻文本块：各块的待定对白接续编号，合并为一次大模型请求
+
+    Args:
+        raw_texts: 按原文顺序相邻的文本块
+        api_key: 通义千问API Key
+        novel_roles_path: 角色档案路径
+        context: 可选，第一块的上文（只用于挑选角色）
+
+    Returns:
+        各块的标注结果
+    """
+    role_index = load_role_index(novel_roles_path)
+    chunk_spans = []
+    last_id = 0
+    for raw_text in raw_texts:
+        spans = annotate_by_rules(raw_text, role_index)
+        for span in spans:
+            if not span.resolved:
+                span.span_id += last_id
+        last_id = max([last_id] + [span.span_id for span in spans])
+        chunk_spans.append(spans)
+    all_spans = [span for spans in chunk_spans for span in spans]
+    verdicts = {}
+    if any(not span.resolved for span in all_spans):
+        verdicts = attribute_speakers_by_llm(all_spans, api_key, role_index.prompt_block("".join(raw_texts), context))
+    _apply_verdicts(all_spans, verdicts)
+    return [[span.to_record() for span in spans] for spans in chunk_spans]
+
+def annotate_with_bisection(raw_text: str, api_key: str, novel_roles_path: str, context: str = "",
+                            use_rules: bool = USE_RULE_ANNOTATOR, label: str = "",
+                            sizer: Optional[AdaptiveChunkSizer] = None) -> List[Dict]:
+    """
+    标注一个文本块；触发内容审核时按句子二分重试，只丢弃被拒绝的句子（而不是整块失败）
+
+    Args:
+        raw_text: 原始小说文本
+        api_key: 通义千问API Key
+        novel_roles_path: 角色档案路径
+        context: 可选，紧邻本段的上文（只用于挑选角色）
+        use_rules: 是否先用本地规则标注（annotate_novel_text），否则整段交给大模型（preprocess_novel_text）
+        label: 日志中的段落标识
+        sizer: 可选，整段交给大模型时的自适应块大小（规则标注的输出很短，不需要）
+    """
+    if use_rules:
+        annotate = lambda fragment: annotate_novel_text(fragment, api_key, novel_roles_path, context)
+    else:
+        annotate = lambda fragment: preprocess_novel_text(fragment, api_key, novel_roles_path, context, sizer=sizer)
+    result = run_with_bisection(raw_text, annotate, on_rejected=skipped_fragment_logger(label, "annotation"))
+    return [segment for segments in result.values for segment in segments]
+
+def iter_annotation_packs(chunks: Iterable[str], novel_roles_path: str, use_rules: bool = USE_RULE_ANNOTATOR,
+                          context: str = "", max_tokens: int = ATTRIBUTION_PACK_TOKENS,
+                          max_spans: int = ATTRIBUTION_PACK_SPANS) -> Iterator[List[Tuple[str, str]]]:
+    """
+    把相邻文本块分组，每组的待定对白合并成一次大模型请求（规则能确定大部分对白时，逐块请求的次数远多于必要）
+
+    Args:
+        chunks: 按原文顺序的文本块（可以是生成器，按需读取）
+        novel_roles_path: 角色档案路径（先做规则标注，按待定对白的条数和提示词长度分组）
+        use_rules: 是否先用本地规则标注；否则整段交给大模型，每组只有一块
+        context: 第一块的上文
+        max_tokens: 每组待定对白文本（mark_pending_spans）的token预算
+        max_spans: 每组待定对白的条数上限
+
+    Returns:
+        逐组产出 [(文本块, 上文)]
+    """
+    role_index = load_role_index(novel_roles_path) if use_rules else None
+    pack = []
+    tokens = spans_count = 0
+    for chunk in chunks:
+        item = (chunk, context[-ROLE_CONTEXT_CHARS:])
+        context = chunk
+        if role_index is None:
+            yield [item]
+            continue
+        spans = annotate_by_rules(chunk, role_index)
+        pending = len({span.span_id for span in spans if not span.resolved})
+        cost = estimate_tokens(mark_pending_spans(spans)) if pending else 0
+        if pack and (tokens + cost > max_tokens or spans_count + pending > max_spans):
+            yield pack
+            pack = []
+            tokens = spans_count = 0
+        pack.append(item)
+        tokens += cost
+        spans_count += pending
+    if pack:
+        yield pack
+
+def annotate_pack(pack: List[Tuple[str, str]], api_key: str, novel_roles_path: str,
+                  use_rules: bool = USE_RULE_ANNOTATOR, labels: Optional[List[str]] = None,
+                  sizer: Optional[AdaptiveChunkSizer] = None) -> List[List[Dict]]:
+    """
+    标注一组相邻文本块（iter_annotation_packs 产出的一组），返回各块的标注结果
+    多块时各块的待定对白合并为一次请求；含已知被拒绝的句子或触发内容审核时，改为逐块二分重试
+
+    Args:
+        pack: [(文本块, 上文)]
+        api_key: 通义千问API Key
+        novel_roles_path: 角色档案路径
+        use_rules: 是否先用本地规则标注
+        labels: 各块在日志中的标识（默认按组内序号）
+        sizer: 可选，整段交给大模型时的自适应块大小
+    """
+    labels = labels or [str(i) for i in range(1, len(pack) + 1)]
+    chunks = [chunk for chunk, _ in pack]
+    if use_rules and len(pack) > 1 and not any(get_default_verdicts().has_rejected(chunk) for chunk in chunks):
+        try:
+            return annotate_novel_texts(chunks, api_key, novel_roles_path, pack[0][1])
+        except Exception as e:
+            if not is_moderation_error(str(e)):
+                raise
+            print(f"    ⚠️  第{labels[0]}~{labels[-1]}段合并请求触发内容安全审核，逐段二分重试")
+    return [annotate_with_bisection(chunk, api_key, novel_roles_path, context, use_rules=use_rules,
+                                    label=label, sizer=sizer)
+            for (chunk, context), label in zip(pack, labels)]
+
+def annotate_chunks(chunks: List[str], api_key: str, novel_roles_path: str, context: str = "",
+                    use_rules: bool = USE_RULE_ANNOTATOR, labels: Optional[List[str]] = None) -> List[List[Dict]]:
+    """顺序标注一串相邻文本块（按 iter_annotation_packs 分组请求），返回各块的标注结果"""
+    labels = labels or [str(i) for i in range(1, len(chunks) + 1)]
+    results = []
+    for pack in iter_annotation_packs(chunks, novel_roles_path, use_rules=use_rules, context=context):
+        results.extend(annotate_pack(pack, api_key, novel_roles_path, use_rules=use_rules,
+                                     labels=labels[len(results):len(results) + len(pack)]))
+    return results
+
 def read_novel_from_txt(file_path: str, encoding: str = "utf-8") -> str:
     """
     从TXT文件读取小说文本
@@ -169,58 +437,164 @@ def read_novel_from_txt(file_path: str, encoding: str = "utf-8") -> str:
     except Exception as e:
         raise Exception(f"读取文件失败：{str(e)}")
 
+# ===================== Batch模式 =====================
+def emit_batch_requests(novel_path: str, novel_roles_path: str, request_path: str,
+                        use_rules: bool = USE_RULE_ANNOTATOR) -> int:
+    """
+    不实时调用，把每个文本块的标注请求写成DashScope Batch请求文件（JSONL），提交后离线等待结果
+
+    Args:
+        novel_path: 小说TXT路径
+        novel_roles_path: 角色档案路径
+        request_path: 输出的请求文件路径（旁边另写一份 .meta.jsonl，记录块文本和规则标注结果，入库时使用）
+        use_rules: 是否先用本地规则标注；是则只为有待定对白的块写请求，否则整段交给大模型
+
+    Returns:
+        请求条数
+    """
+    novel_raw_text = read_novel_from_txt(novel_path, encoding="utf-8")
+    role_index = load_role_index(novel_roles_path)
+    chunk_tokens = CHUNK_MAX_TOKENS if use_rules else BATCH_LLM_CHUNK_TOKENS
+    previous_chunk = ""
+    with BatchRequestWriter(request_path, "annotation", MODEL_NAME) as writer:
+        for i, chunk in enumerate(iter_chunks(novel_raw_text, max_tokens=chunk_tokens), 1):
+            context = previous_chunk[-ROLE_CONTEXT_CHARS:]
+            role_block = role_index.prompt_block(chunk, context)
+            meta = {"label": str(i), "text": chunk, "context": context, "use_rules": use_rules}
+            if use_rules:
+                spans = annotate_by_rules(chunk, role_index)
+                meta["spans"] = [asdict(span) for span in spans]
+                prompt = None
+                if any(not span.resolved for span in spans):
+                    prompt = _attribution_prompt(role_block, mark_pending_spans(spans))
+            else:
+                prompt = _annotation_prompt(role_block, chunk)
+            writer.add(prompt, meta)
+            previous_chunk = chunk
+    print(f"已写出 {writer.requests} 条Batch请求（共 {writer.units} 个文本块）：{request_path}")
+    return writer.requests
+
+def _ingest_unit(meta: Dict, outcome, api_key: str, novel_roles_path: str) -> List[Dict]:
+    """把一个文本块的Batch结果还原为标注片段（必要时实时补请求）"""
+    label = meta["label"]
+    if outcome is not None and not outcome.ok:
+        print(f"    ⚠️  第{label}段触发内容安全审核，实时二分重试")
+        return annotate_with_bisection(meta["text"], api_key, novel_roles_path, meta["context"],
+                                       use_rules=meta["use_rules"], label=label)
+    if meta["use_rules"]:
+        spans = [AnnotatedSpan(**span) for span in meta["spans"]]
+        verdicts = {}
+        if outcome is not None:
+            parsed = _parse_verdicts(outcome.result.text)
+            verdicts = {int(item["id"]): item for item in parsed.items}
+            missing = {span.span_id for span in spans if not span.resolved} - verdicts.keys()
+            if not parsed.complete and missing:
+                # 输出被截断：与实时模式相同，对缺少的编号实时补请求
+                print(f"    🔧 第{label}段对白判断输出{parsed.summary()}，实时补请求 {len(missing)} 条")
+                role_block = load_role_index(novel_roles_path).prompt_block(meta["text"], meta["context"])
+                verdicts = attribute_speakers_by_llm(spans, api_key, role_block, known=verdicts)
+        return _apply_verdicts(spans, verdicts)
+
+    parsed = parse_json_array(outcome.result.text, validate=_is_valid_segment)
+    if not parsed.found:
+        raise Exception(f"第{label}段大模型输出不是合法JSON，原始输出：{outcome.result.text}")
+    if parsed.complete:
+        return parsed.items
+    # 输出被截断：Batch结果无法续写，对剩余文本实时补请求
+    tail = remaining_tail(meta["text"], [item["text"] for item in parsed.items]) if parsed.items else None
+    if tail is None:
+        print(f"    ↪️  第{label}段输出被截断且无法定位截断位置，实时重新标注整段")
+        return preprocess_novel_text(meta["text"], api_key, novel_roles_path, meta["context"])
+    print(f"    ↪️  第{label}段输出被截断，实时补请求剩余 {len(tail)} 字")
+    return parsed.items + (preprocess_novel_text(tail, api_key, novel_roles_path, meta["context"]) if tail else [])
+
+def ingest_batch_results(request_path: str, result_paths: List[str], output_path: str, api_key: str,
+                         novel_roles_path: str) -> int:
+    """
+    读取Batch结果文件，按原文顺序还原每个文本块的标注，写入片段库/JSON（与实时模式的输出相同）
+
+    Args:
+        request_path: emit_batch_requests 写出的请求文件
+        result_paths: Batch结果文件（可多个，如原结果 + 重试结果）；除内容审核外有失败的请求时写出重试文件并报错
+        output_path: 标注结果路径（.jsonl 片段库 / .json）
+        api_key: 通义千问API Key（内容审核与输出截断的少数块需要实时补请求）
+        novel_roles_path: 角色档案路径
+
+    Returns:
+        写出的片段数
+    """
+    units = load_batch_units(request_path, result_paths)
+    with metrics.stage("annotation"), open_segment_writer(output_path) as segment_writer:
+        for meta, outcome in units:
+            processed_chunk = _ingest_unit(meta, outcome, api_key, novel_roles_path)
+            metrics.inc("segments_total", len(processed_chunk), stage="annotation")
+            segment_writer.append(processed_chunk)
+    print(f"预处理结果已保存至：{output_path}（{len(units)} 个文本块，共 {len(segment_writer)} 个片段）")
+    return len(segment_writer)
+
 # ===================== 调用示例 =====================
 if __name__ == "__main__":
     # 1. 配置参数
     MY_API_KEY = "sk-c9a4649744f246f0877675c62ec3b9f1"  # 替换为你的通义千问API Key
     NOVEL_TXT_PATH = "/Users/apple/Dev/Code/generate_voice_by_llm/novel_sample.txt"  # mac电脑的环境
     NOVEL_ROLES_PATH = "/Users/apple/Dev/Code/generate_voice_by_llm/novel_roles.json"  # mac电脑的环境
-    NOVEL_PROCESSED_PATH= "/Users/apple/Dev/Code/generate_voice_by_llm/novel_processed.json" # mac电脑的环境
+    NOVEL_PROCESSED_PATH= "/Users/apple/Dev/Code/generate_voice_by_llm/novel_processed.json" # mac电脑的环境（改为.jsonl即使用片段库）
+
+    parser = argparse.ArgumentParser(description="调用大模型标注小说文本（说话人/情感/语速）")
+    parser.add_argument("mode", nargs="?", default="run", choices=["run", "batch-emit", "batch-ingest"],
+                        help="run：实时调用；batch-emit：写出Batch请求文件；batch-ingest：读取Batch结果文件并写出标注结果")
+    parser.add_argument("--requests", default=default_request_path("annotation"), help="Batch请求文件路径")
+    parser.add_argument("--results", nargs="+", default=None, help="Batch结果文件路径（可多个，默认与请求文件同目录）")
+    args = parser.parse_args()
     
     try:
-        # 2. 从TXT文件读取小说文本
-        print(f"正在读取文件：{NOVEL_TXT_PATH}")
-        novel_raw_text = read_novel_from_txt(NOVEL_TXT_PATH, encoding="utf-8")
-        print(f"文件读取完成，文本长度：{len(novel_raw_text)} 字符")
-
-        # 3. （可选）长文本拆分：通义千问turbo单轮最大支持8k字符，超过则按章节拆分
-        max_text_length = 2000
-        if len(novel_raw_text) > max_text_length:
-            print("检测到长文本，自动拆分处理...")
-            # 按章节/换行拆分（简单拆分逻辑，可根据小说格式优化）
-            text_chunks = []
-            current_chunk = ""
-            for line in novel_raw_text.split("\n"):
-                if len(current_chunk + line) < max_text_length:
-                    current_chunk += line + "\n"
-                else:
-                    text_chunks.append(current_chunk.strip())
-                    current_chunk = line + "\n"
-            if current_chunk:
-                text_chunks.append(current_chunk.strip())
+        if args.mode == "batch-emit":
+            emit_batch_requests(NOVEL_TXT_PATH, NOVEL_ROLES_PATH, args.requests)
+        elif args.mode == "batch-ingest":
+            ingest_batch_results(args.requests, args.results or [default_results_path(args.requests)],
+                                 NOVEL_PROCESSED_PATH, MY_API_KEY, NOVEL_ROLES_PATH)
         else:
-            text_chunks = [novel_raw_text]
-
-        # 4. 批量预处理每个文本块
-        all_processed_segments = []
-        for i, chunk in enumerate(text_chunks, 1):
-            print(f"\n正在预处理第{i}个文本块...")
-            processed_chunk = preprocess_novel_text(chunk, MY_API_KEY,NOVEL_ROLES_PATH)
-            all_processed_segments.extend(processed_chunk)
-
-        # 5. 打印预处理结果
-        print("\n===== 小说文本预处理结果 =====")
-        for i, seg in enumerate(all_processed_segments, 1):
-            print(f"\n【片段{i}】")
-            print(f"文本：{seg['text']}")
-            print(f"说话人：{seg['speaker']}")
-            print(f"情感：{seg['emotion']}")
-            print(f"语速：{seg['speed']}")
-
-        # （可选）将预处理结果保存为JSON文件
-        with open(NOVEL_PROCESSED_PATH, "w", encoding="utf-8") as f:
-            json.dump(all_processed_segments, f, ensure_ascii=False, indent=4)
-        print(f"\n预处理结果已保存至：{NOVEL_PROCESSED_PATH}")
+            # 2. 从TXT文件读取小说文本
+            print(f"正在读取文件：{NOVEL_TXT_PATH}")
+            novel_raw_text = read_novel_from_txt(NOVEL_TXT_PATH, encoding="utf-8")
+            print(f"文件读取完成，文本长度：{len(novel_raw_text)} 字符")
+
+            # 3. 长文本拆分：按token预算在句子边界装箱（标注不能重叠，否则片段会重复）
+            #    整段交给大模型时按输出是否被截断自适应调整块大小
+            chunk_sizer = None if USE_RULE_ANNOTATOR else make_chunk_sizer()
+            if chunk_sizer is None:
+                text_chunks = iter_chunks(novel_raw_text, max_tokens=CHUNK_MAX_TOKENS)
+            else:
+                text_chunks = iter_adaptive_chunks(novel_raw_text, chunk_sizer)
+
+            # 4. 批量预处理每组文本块（相邻块的待定对白合并为一次请求）；每块完成即写出
+            #    （.jsonl片段库边处理边追加，.json在结束时写出整个数组）
+            chunk_count = 0
+            with metrics.stage("annotation"), open_segment_writer(NOVEL_PROCESSED_PATH) as segment_writer:
+                for pack in iter_annotation_packs(text_chunks, NOVEL_ROLES_PATH):
+                    labels = [str(i) for i in range(chunk_count + 1, chunk_count + len(pack) + 1)]
+                    print(f"\n正在预处理第{labels[0]}{'~' + labels[-1] if len(pack) > 1 else ''}个文本块...")
+                    with metrics.timer("chunk_seconds", stage="annotation"):
+                        processed_chunks = annotate_pack(pack, MY_API_KEY, NOVEL_ROLES_PATH,
+                                                         labels=labels, sizer=chunk_sizer)
+                    chunk_count += len(pack)
+                    for processed_chunk in processed_chunks:
+                        metrics.inc("segments_total", len(processed_chunk), stage="annotation")
+                        segment_range = segment_writer.append(processed_chunk)
+
+                        # 5. 打印本块的预处理结果
+                        for seg_idx, seg in zip(segment_range, processed_chunk):
+                            print(f"\n【片段{seg_idx + 1}】")
+                            print(f"文本：{seg['text']}")
+                            print(f"说话人：{seg['speaker']}")
+                            print(f"情感：{seg['emotion']}")
+                            print(f"语速：{seg['speed']}")
+
+            print(f"\n预处理结果已保存至：{NOVEL_PROCESSED_PATH}（共 {len(segment_writer)} 个片段）")
 
     except Exception as e:
-        print(f"处理失败：{str(e)}")
\ No newline at end of file
+        print(f"处理失败：{str(e)}")
+    finally:
+        report_path = metrics.export("annotation")
+        if report_path:
+            print(f"运行指标已保存至：{report_path}")
\ No newline at end of file
@@ -0,0 +1,314 @@
+import argparse
+import os
+import socket
+import threading
+import time
+import wave
+from typing import Callable, Dict, List, Optional, Sequence
+
+from generate_audio_by_chattts import SAMPLE_RATE, generate_voice_from_json, use_speaker_registry
+from generate_role_by_llm import (QWEN_API_KEY, USE_NAME_PREFILTER, extract_roles_with_bisection,
+                                  generate_chattts_voice_map, merge_roles, plan_requests)
+from generate_text_by_llm import CHUNK_MAX_TOKENS, ROLE_CONTEXT_CHARS, annotate_chunks, read_novel_from_txt
+from tools_chunker import iter_chunks
+from tools_incremental import write_json_atomic
+from tools_metrics import metrics
+from tools_segment_store import load_segments, write_segments
+from tools_wav_writer import StreamingWavWriter
+from tools_work_queue import DEFAULT_LEASE_SECONDS, DEFAULT_MAX_ATTEMPTS, LeaseKeeper, Task, WorkQueue
+
+# 每本书按以下阶段推进；同一本书前一阶段的任务全部完成后，下一阶段的任务才会被领取
+STAGE_ROLES = 0      # 逐块（预筛后的请求）提取角色
+STAGE_MERGE = 1      # 合并角色档案
+STAGE_ANNOTATE = 2   # 按相邻块分组标注
+STAGE_COLLECT = 3    # 按块顺序拼出片段库，生成合成任务
+STAGE_SPEAKERS = 4   # 生成角色说话人向量表（只生成一次，避免多个合成任务并发重建）
+STAGE_SYNTH = 5      # 按片段区间合成
+STAGE_STITCH = 6     # 按区间顺序拼接整本书的音频
+
+LLM_KINDS = ("roles", "merge_roles", "annotate", "collect")
+TTS_KINDS = ("speakers", "synthesize", "stitch")
+# 每个标注任务的块数（任务内相邻块的待定对白合并请求，块数太少则合并不起来）
+ANNOTATE_TASK_CHUNKS = 8
+# 每个合成任务的片段数
+SYNTH_RANGE_SIZE = 256
+# 没有可领取的任务时的轮询间隔（秒）
+POLL_INTERVAL = 5.0
+# 合成相关任务共用进程级的说话人向量表和TTS模型，同一进程内多个线程时须逐个执行（否则可能用另一本书的音色合成）
+_tts_lock = threading.Lock()
+
+
+def _book_paths(config: Dict) -> Dict[str, str]:
+    """一本书在共享目录中的产物路径"""
+    book_dir = config["book_dir"]
+    return {
+        "roles": os.path.join(book_dir, "novel_roles.json"),
+        "processed": os.path.join(book_dir, "novel_processed.jsonl"),
+        "speakers": os.path.join(book_dir, "speaker_registry"),
+        "parts": os.path.join(book_dir, "parts"),
+        "audio": os.path.join(book_dir, f"{os.path.basename(book_dir)}.wav"),
+        "audio_cache": os.path.join(book_dir, ".audio_cache"),
+    }
+
+
+def enqueue_book(queue: WorkQueue, novel_path: str, store_dir: str, chunk_tokens: int = CHUNK_MAX_TOKENS,
+                 use_rules: bool = True, use_prefilter: bool = USE_NAME_PREFILTER) -> bool:
+    """
+    把一本书加入队列（作业名为文件名，不含扩展名）：切块并生成角色提取、合并、标注、汇总任务，
+    合成任务在汇总时按片段数生成
+
+    Args:
+        queue: 共享任务队列
+        novel_path: 小说TXT路径（只在入队时读取，块文本随任务保存）
+        store_dir: 共享结果目录（各节点都能访问），每本书的产物放在 <store_dir>/<作业名>/ 下
+        chunk_tokens: 每块的token预算
+        use_rules: 标注时先用本地规则，只把说话人不确定的对白交给大模型
+        use_prefilter: 角色提取前本地预筛候选人名，减少请求次数
+
+    Returns:
+        同名作业已存在时返回False
+    """
+    job = os.path.splitext(os.path.basename(novel_path))[0]
+    book_dir = os.path.abspath(os.path.join(store_dir, job))
+    novel_text = read_novel_from_txt(novel_path)
+    chunks = list(iter_chunks(novel_text, max_tokens=chunk_tokens))
+    role_requests = plan_requests(chunks, novel_text, use_prefilter=use_prefilter)
+
+    tasks = [(STAGE_ROLES, "roles", f"roles:{i}", {"text": request.text, "label": request.label})
+             for i, request in enumerate(role_requests)]
+    tasks.append((STAGE_MERGE, "merge_roles", "merge_roles", {}))
+    tasks.extend(
+        (STAGE_ANNOTATE, "annotate", f"annotate:{start}",
+         {"chunk": start, "texts": chunks[start:start + ANNOTATE_TASK_CHUNKS],
+          "context": chunks[start - 1][-ROLE_CONTEXT_CHARS:] if start else ""})
+        for start in range(0, len(chunks), ANNOTATE_TASK_CHUNKS)
+    )
+    tasks.append((STAGE_COLLECT, "collect", "collect", {"chunks": len(chunks)}))
+    config = {"book_dir": book_dir, "novel_path": os.path.abspath(novel_path), "use_rules": use_rules}
+    added = queue.add_job(job, config, tasks)
+    if added:
+        os.makedirs(book_dir, exist_ok=True)
+        print(f"📚 已入队：{job}（{len(chunks)} 块，角色提取 {len(role_requests)} 次请求）")
+    else:
+        print(f"⚠️  作业已存在，跳过：{job}")
+    return added
+
+
+# ===================== 任务实现 =====================
+def _run_roles(queue: WorkQueue, task: Task, config: Dict, api_key: str):
+    return extract_roles_with_bisection(task.payload["text"], api_key, label=f"{task.job}#{task.payload['label']}")
+
+
+def _run_merge_roles(queue: WorkQueue, task: Task, config: Dict, api_key: str):
+    merged_roles = merge_roles(queue.results(task.job, "roles"))
+    write_json_atomic(_book_paths(config)["roles"], {
+        "roles": merged_roles,
+        "chattts_voice_map": generate_chattts_voice_map(merged_roles),
+        "total_roles": len(merged_roles),
+    })
+    return {"roles": len(merged_roles)}
+
+
+def _run_annotate(queue: WorkQueue, task: Task, config: Dict, api_key: str):
+    payload = task.payload
+    first = payload["chunk"] + 1
+    return annotate_chunks(payload["texts"], api_key, _book_paths(config)["roles"], context=payload["context"],
+                           use_rules=config["use_rules"],
+                           labels=[f"{task.job}#{first + i}" for i in range(len(payload["texts"]))])
+
+
+def _run_collect(queue: WorkQueue, task: Task, config: Dict, api_key: str):
+    paths = _book_paths(config)
+    per_chunk = [chunk_segments for per_task in queue.results(task.job, "annotate") for chunk_segments in per_task]
+    if len(per_chunk) != task.payload["chunks"]:
+        raise RuntimeError(f"标注结果不完整：{len(per_chunk)}/{task.payload['chunks']} 块")
+    segments = [segment for chunk_segments in per_chunk for segment in chunk_segments]
+    write_segments(paths["processed"], segments)
+    ranges = [(start, min(start + SYNTH_RANGE_SIZE, len(segments)))
+              for start in range(0, len(segments), SYNTH_RANGE_SIZE)]
+    # 与片段库写出放在同一个任务里：中途崩溃重跑时同名任务不会重复添加
+    queue.add_tasks(task.job, [(STAGE_SPEAKERS, "speakers", "speakers", {})]
+                    + [(STAGE_SYNTH, "synthesize", f"synthesize:{start}", {"start": start, "end": end})
+                       for start, end in ranges]
+                    + [(STAGE_STITCH, "stitch", "stitch", {"starts": [start for start, _ in ranges]})])
+    return {"segments": len(segments), "ranges": len(ranges)}
+
+
+def _run_speakers(queue: WorkQueue, task: Task, config: Dict, api_key: str):
+    paths = _book_paths(config)
+    registry = use_speaker_registry(paths["roles"], paths["speakers"])
+    return {"speakers": len(registry) if registry is not None else 0}
+
+
+def _part_path(config: Dict, start: int) -> str:
+    return os.path.join(_book_paths(config)["parts"], f"{start:08d}.wav")
+
+
+def _run_synthesize(queue: WorkQueue, task: Task, config: Dict, api_key: str):
+    paths = _book_paths(config)
+    start, end = task.payload["start"], task.payload["end"]
+    segments = load_segments(paths["processed"])
+    if not any(segments[idx]["text"].strip() for idx in range(start, end)):
+        return {"seconds": 0.0}  # 整个区间都是空文本，不生成分段音频
+    part_path = _part_path(config, start)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    # 未完成的分段音频用固定路径（租约保证同一时间只有一个执行者）：失败重试或被重新领取时，
+    # 从上次写到的位置续写（连同旁边的 .manifest.jsonl），不会在 parts/ 下留下孤立的临时文件
+    tmp_path = f"{part_path}.partial.wav"
+    generate_voice_from_json(paths["processed"], tmp_path, cache_dir=paths["audio_cache"],
+                             roles_path=paths["roles"], speaker_registry_path=paths["speakers"],
+                             start=start, end=end)
+    os.replace(tmp_path, part_path)
+    with wave.open(part_path, "rb") as part:
+        return {"seconds": part.getnframes() / part.getframerate()}
+
+
+def _run_stitch(queue: WorkQueue, task: Task, config: Dict, api_key: str):
+    paths = _book_paths(config)
+    starts = task.payload["starts"]
+    parts = queue.results(task.job, "synthesize")
+    if len(parts) != len(starts):
+        raise RuntimeError(f"分段音频不完整：{len(parts)}/{len(starts)} 段")
+    tmp_path = f"{paths['audio']}.{os.getpid()}.tmp"
+    with StreamingWavWriter(tmp_path, sample_rate=SAMPLE_RATE) as writer:
+        for start in starts:
+            part_path = _part_path(config, start)
+            if not os.path.exists(part_path):
+                continue
+            with wave.open(part_path, "rb") as part:
+                while True:
+                    frames = part.readframes(SAMPLE_RATE * 60)
+                    if not frames:
+                        break
+                    writer.write_pcm(frames)
+        seconds = writer.duration_seconds
+    os.replace(tmp_path, paths["audio"])
+    print(f"🎧 {task.job} 音频拼接完成（时长 {seconds:.1f} 秒）：{paths['audio']}")
+    return {"seconds": seconds, "path": paths["audio"]}
+
+
+TASK_HANDLERS: Dict[str, Callable[[WorkQueue, Task, Dict, str], object]] = {
+    "roles": _run_roles,
+    "merge_roles": _run_merge_roles,
+    "annotate": _run_annotate,
+    "collect": _run_collect,
+    "speakers": _run_speakers,
+    "synthesize": _run_synthesize,
+    "stitch": _run_stitch,
+}
+
+
+# ===================== 工作节点 =====================
+def run_worker(queue: WorkQueue, owner: str, api_key: str = QWEN_API_KEY,
+               kinds: Optional[Sequence[str]] = None, exit_when_idle: bool = False,
+               poll_interval: float = POLL_INTERVAL) -> int:
+    """
+    工作循环：领取任务 -> 执行（期间后台续约）-> 提交结果；出错的任务重新排队，重试次数用完后标记失败
+    （同一进程的多个工作线程中，合成相关任务逐个执行，大模型任务可并行）
+
+    Args:
+        queue: 共享任务队列
+        owner: 本工作者标识（租约持有者）
+        api_key: 通义千问API Key
+        kinds: 只领取这些类型的任务（如没有GPU的节点只做 LLM_KINDS）
+        exit_when_idle: 队列中没有可做的任务时退出（否则持续轮询新入队的书）
+        poll_interval: 空闲时的轮询间隔（秒）
+
+    Returns:
+        成功完成的任务数
+    """
+    completed = 0
+    while True:
+        task = queue.claim(owner, kinds)
+        if task is None:
+            if exit_when_idle and not queue.has_work(kinds):
+                return completed
+            time.sleep(poll_interval)
+            continue
+        print(f"▶️  [{owner}] {task.job} / {task.name}（第 {task.attempts} 次尝试）")
+        config = queue.job_config(task.job)
+        try:
+            with LeaseKeeper(queue, task, owner) as keeper, \
+                    metrics.timer("work_queue_task_seconds", kind=task.kind):
+                if task.kind in TTS_KINDS:
+                    with _tts_lock:
+                        result = TASK_HANDLERS[task.kind](queue, task, config, api_key)
+                else:
+                    result = TASK_HANDLERS[task.kind](queue, task, config, api_key)
+        except Exception as e:
+            status = queue.fail(task, owner, f"{type(e).__name__}: {str(e)}")
+            print(f"❌ [{owner}] {task.job} / {task.name} 失败（{'将重试' if status == 'pending' else '已放弃'}）：{str(e)}")
+            continue
+        if keeper.lost or not queue.complete(task, owner, result):
+            print(f"⚠️  [{owner}] {task.job} / {task.name} 租约已过期，结果作废（任务已由其他节点重新领取）")
+            continue
+        completed += 1
+        print(f"✅ [{owner}] {task.job} / {task.name} 完成")
+
+
+def print_status(queue: WorkQueue):
+    for job, kinds in queue.status().items():
+        print(f"【{job}】")
+        for kind, counts in kinds.items():
+            print(f"  {kind}: " + "，".join(f"{status} {count}" for status, count in sorted(counts.items())))
+    for job, name, error in queue.errors():
+        print(f"❌ {job} / {name}：{error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="多机批量处理小说：共享SQLite任务队列 + 租约")
+    parser.add_argument("--queue", default="catalog/queue.sqlite3", help="任务队列数据库路径（放在各节点共享的目录中）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="把小说加入队列")
+    enqueue_parser.add_argument("novels", nargs="+", help="小说TXT文件路径")
+    enqueue_parser.add_argument("--store", default="catalog", help="共享结果目录")
+    enqueue_parser.add_argument("--llm-only", action="store_true", help="不用本地规则预标注，整段交给大模型")
+    enqueue_parser.add_argument("--no-prefilter", action="store_true", help="角色提取不做本地预筛")
+
+    worker_parser = subparsers.add_parser("worker", help="启动工作节点")
+    worker_parser.add_argument("--api-key", default=os.environ.get("DASHSCOPE_API_KEY", QWEN_API_KEY))
+    worker_parser.add_argument("--kinds", choices=["all", "llm", "tts"], default="all",
+                               help="领取的任务类型：llm（角色提取/标注）、tts（合成/拼接）或全部")
+    worker_parser.add_argument("--threads", type=int, default=1,
+                               help="本进程的工作线程数（大模型任务以等待网络为主，可开多个；合成相关任务在进程内始终逐个执行）")
+    worker_parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS, help="租约时长（秒）")
+    worker_parser.add_argument("--exit-when-idle", action="store_true", help="没有可做的任务时退出")
+
+    subparsers.add_parser("status", help="查看各书进度")
+    retry_parser = subparsers.add_parser("retry", help="把失败的任务重新排队")
+    retry_parser.add_argument("--job", default=None, help="只重试这本书（默认全部）")
+    args = parser.parse_args()
+
+    lease_seconds = getattr(args, "lease", DEFAULT_LEASE_SECONDS)
+    work_queue = WorkQueue(args.queue, lease_seconds=lease_seconds, max_attempts=DEFAULT_MAX_ATTEMPTS)
+    if args.command == "enqueue":
+        for novel in args.novels:
+            enqueue_book(work_queue, novel, args.store, use_rules=not args.llm_only,
+                         use_prefilter=not args.no_prefilter)
+    elif args.command == "worker":
+        kinds = {"all": None, "llm": LLM_KINDS, "tts": TTS_KINDS}[args.kinds]
+        node = f"{socket.gethostname()}:{os.getpid()}"
+        threads: List[threading.Thread] = [
+            threading.Thread(target=run_worker,
+                             args=(work_queue, f"{node}:{i}", args.api_key, kinds, args.exit_when_idle))
+            for i in range(max(1, args.threads))
+        ]
+        print(f"🛠️  工作节点 {node} 已启动（{len(threads)} 个线程），队列：{args.queue}")
+        try:
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            print("\n工作节点退出（进行中的任务租约到期后会由其他节点重新领取）")
+        finally:
+            report_path = metrics.export(f"worker_{socket.gethostname()}_{os.getpid()}")
+            if report_path:
+                print(f"运行指标已保存至：{report_path}")
+    elif args.command == "status":
+        print_status(work_queue)
+    else:
+        print(f"已重新排队 {work_queue.retry_failed(args.job)} 个失败任务")
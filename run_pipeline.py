@@ -0,0 +1,180 @@
+import argparse
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from generate_audio_by_chattts import SAMPLE_RATE, synthesize_segments, use_speaker_registry
+from generate_role_by_llm import QWEN_API_KEY, is_moderation_error
+from generate_text_by_llm import annotate_pack, iter_annotation_packs, make_chunk_sizer, read_novel_from_txt
+from tools_audio_cache import AudioClipCache
+from tools_chunker import AdaptiveChunkSizer, iter_adaptive_chunks, iter_chunks
+from tools_metrics import metrics
+from tools_segment_store import open_segment_writer
+from tools_wav_writer import StreamingWavWriter
+
+# 阶段之间传递的结束标记
+_STOP = object()
+
+
+class _StageError:
+    """上游阶段异常，沿队列传给下游后重新抛出"""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _annotation_stage(chunks: Iterable[str], out_queue: "queue.Queue", api_key: str,
+                      roles_path: str, workers: int, use_rules: bool = True,
+                      sizer: Optional[AdaptiveChunkSizer] = None):
+    """
+    标注阶段：最多workers组块同时调用大模型（相邻块的待定对白合并为一次请求），结果按块顺序放入队列
+    队列有界，TTS跟不上时这里自然阻塞，不会无限预取
+    """
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            in_flight = deque()
+
+            def emit_oldest():
+                first_idx, pack_size, future = in_flight.popleft()
+                try:
+                    per_chunk = future.result()
+                except Exception as e:
+                    if not is_moderation_error(str(e)):
+                        raise
+                    print(f"  ⚠️  第{first_idx + 1}~{first_idx + pack_size}块触发内容安全审核，已跳过")
+                    metrics.inc("moderation_skips_total", stage="annotation")
+                    per_chunk = [[] for _ in range(pack_size)]
+                for offset, segments in enumerate(per_chunk):
+                    out_queue.put((first_idx + offset, segments))
+
+            chunk_idx = 0
+            for pack in iter_annotation_packs(chunks, roles_path, use_rules=use_rules):
+                labels = [str(i) for i in range(chunk_idx + 1, chunk_idx + len(pack) + 1)]
+                future = executor.submit(annotate_pack, pack, api_key, roles_path, use_rules=use_rules,
+                                         labels=labels, sizer=sizer)
+                in_flight.append((chunk_idx, len(pack), future))
+                chunk_idx += len(pack)
+                if len(in_flight) >= max(1, workers):
+                    emit_oldest()
+            while in_flight:
+                emit_oldest()
+        out_queue.put(_STOP)
+    except Exception as e:
+        out_queue.put(_StageError(e))
+
+
+def run_pipeline(novel_path: str, roles_path: str, output_audio_path: str,
+                 processed_path: Optional[str] = None, api_key: str = QWEN_API_KEY,
+                 chunk_tokens: int = 1600, annotate_workers: int = 2, queue_size: int = 4,
+                 batch_size: int = 8, cache_dir: Optional[str] = ".audio_cache",
+                 use_rules: bool = True) -> List[Dict]:
+    """
+    端到端流式流水线：切块 -> 大模型标注 -> TTS合成 三个阶段用有界队列串联，
+    第N块在合成时第N+1块已在标注，首段音频在第一块标注完成后即可写出
+
+    Args:
+        novel_path: 小说TXT路径
+        roles_path: 角色档案JSON路径（generate_role_by_llm.py 的输出）
+        output_audio_path: 输出音频路径（边合成边写入）
+        processed_path: 可选，保存全部标注结果的路径（.json与 novel_processed.json 格式一致；.jsonl为片段库，每块标注完成即追加）
+        api_key: 通义千问API Key
+        chunk_tokens: 每块的token预算（use_rules=False时为初始值，之后按输出是否被截断自适应调整）
+        annotate_workers: 同时标注的组数（每组为待定对白合并请求的相邻块）
+        queue_size: 标注结果队列容量（块数）
+        batch_size: 每次chat.infer合成的片段数
+        cache_dir: 片段音频缓存目录（None表示不缓存）
+        use_rules: 先用本地规则标注，只把说话人不确定的对白交给大模型
+
+    Returns:
+        按原文顺序的全部标注片段
+    """
+    start_time = time.perf_counter()
+    novel_text = read_novel_from_txt(novel_path)
+    # 生成器：按需切块，不预先切完全书；整段交给大模型时块大小随输出截断情况自适应
+    sizer = None
+    if use_rules:
+        chunks = iter_chunks(novel_text, max_tokens=chunk_tokens)
+    else:
+        sizer = make_chunk_sizer(chunk_tokens)
+        chunks = iter_adaptive_chunks(novel_text, sizer)
+    print(f"小说共 {len(novel_text)} 字符，开始流式处理...")
+
+    segment_queue: "queue.Queue" = queue.Queue(maxsize=max(1, queue_size))
+    annotator = threading.Thread(
+        target=_annotation_stage,
+        args=(chunks, segment_queue, api_key, roles_path, annotate_workers, use_rules, sizer),
+        daemon=True,
+    )
+    annotator.start()
+
+    use_speaker_registry(roles_path)  # 每个角色固定音色
+    cache = AudioClipCache(cache_dir) if cache_dir else None
+    all_segments: List[Dict] = []
+    segment_writer = open_segment_writer(processed_path) if processed_path else None
+    first_audio_at = None
+    completed = False
+    try:
+        with StreamingWavWriter(output_audio_path, sample_rate=SAMPLE_RATE) as writer:
+            while True:
+                item = segment_queue.get()
+                if item is _STOP:
+                    break
+                if isinstance(item, _StageError):
+                    raise item.error
+                chunk_idx, segments = item
+                print(f"第 {chunk_idx + 1} 块标注完成（{len(segments)} 段），开始合成...")
+                all_segments.extend(segments)
+                if segment_writer is not None:
+                    segment_writer.append(segments)
+                wav_by_index = synthesize_segments(segments, batch_size=batch_size, cache=cache)
+                for idx in sorted(wav_by_index):
+                    writer.write(wav_by_index[idx])
+                if first_audio_at is None and wav_by_index:
+                    first_audio_at = time.perf_counter() - start_time
+                    print(f"首段音频已写出，耗时 {first_audio_at:.1f} 秒")
+            total_seconds = writer.duration_seconds
+        annotator.join()
+        completed = True
+    finally:
+        # 中途失败时不用部分结果覆盖已有的标注文件（.json）；.jsonl片段库保留已追加的片段
+        if segment_writer is not None:
+            if completed:
+                segment_writer.close()
+            else:
+                segment_writer.abort()
+    if segment_writer is not None:
+        print(f"标注结果已保存至：{processed_path}")
+    print(f"\n流水线完成：音频时长 {total_seconds:.1f} 秒，总耗时 {time.perf_counter() - start_time:.1f} 秒，"
+          f"文件保存至：{os.path.abspath(output_audio_path)}")
+    return all_segments
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="小说 -> 标注 -> 语音 端到端流式流水线")
+    parser.add_argument("--novel", default="novel_sample.txt", help="小说TXT文件路径")
+    parser.add_argument("--roles", default="novel_roles.json", help="角色档案JSON路径")
+    parser.add_argument("--output", default="novel_full_voice.wav", help="输出音频路径")
+    parser.add_argument("--processed", default="novel_processed.json", help="标注结果保存路径（.json 或 .jsonl片段库）")
+    parser.add_argument("--api-key", default=os.environ.get("DASHSCOPE_API_KEY", QWEN_API_KEY))
+    parser.add_argument("--annotate-workers", type=int, default=2, help="同时标注的组数（每组为待定对白合并请求的相邻块）")
+    parser.add_argument("--batch-size", type=int, default=8, help="每批合成的片段数")
+    parser.add_argument("--no-cache", action="store_true", help="不使用片段音频缓存")
+    parser.add_argument("--llm-only", action="store_true", help="不用本地规则预标注，整段交给大模型")
+    args = parser.parse_args()
+
+    try:
+        run_pipeline(args.novel, args.roles, args.output, processed_path=args.processed,
+                     api_key=args.api_key, annotate_workers=args.annotate_workers,
+                     batch_size=args.batch_size,
+                     cache_dir=None if args.no_cache else ".audio_cache",
+                     use_rules=not args.llm_only)
+    except Exception as e:
+        print(f"流水线执行失败：{str(e)}")
+    finally:
+        report_path = metrics.export("pipeline")
+        if report_path:
+            print(f"运行指标已保存至：{report_path}")
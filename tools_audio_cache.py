@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_AUDIO_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", "./.audio_cache")
+
+
+def make_segment_key(text: str, speaker: str, emotion: str, speed: float,
+                     voice_seed: int, model_version: str) -> str:
+    """按 文本+说话人+情感+语速+音色种子+模型版本 计算片段音频的内容寻址键（sha256）"""
+    material = json.dumps(
+        [text, speaker, emotion, round(float(speed), 4), voice_seed, model_version],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class AudioClipCache:
+    """
+    片段音频缓存：每个片段的float32波形存为 <目录>/<键前2位>/<键>.npy
+
+    写入先落临时文件再原子替换，进程中途崩溃不会留下半截文件。
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_AUDIO_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def has(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def load(self, key: str) -> Optional[np.ndarray]:
+        """读取缓存的波形，不存在返回None"""
+        try:
+            wav = np.load(self._path(key))
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return wav
+
+    def save(self, key: str, wav: np.ndarray):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(wav, dtype=np.float32))
+        os.replace(tmp_path, path)
+
+
+class SynthesisManifest:
+    """
+    合成任务清单（JSONL追加写）：首行记录任务标识，之后每行记录一个已处理的片段及处理后输出文件的总帧数
+    （空文本或合成失败、没有音频的片段也要记录，key为null，否则续写起点会卡在该片段）
+
+    任务标识与当前输入不一致时（换了书或改了参数）自动重新开始。
+    中断后重跑时，按 resume_point 保留输出文件中已完整写入的片段，只合成其后的片段并继续追加。
+    """
+
+    def __init__(self, path: str, job_id: str):
+        self.path = path
+        self.job_id = job_id
+        self.completed: Dict[int, Optional[str]] = {}
+        self.frames: Dict[int, int] = {}
+        self._load()
+        self._file = open(self.path, "a", encoding="utf-8")
+        if os.path.getsize(self.path) == 0:
+            self._append({"job_id": job_id})
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except ValueError:
+            header = {}
+        if header.get("job_id") != self.job_id:
+            os.remove(self.path)
+            return
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:  # 中断时可能留下半行
+                continue
+            self.completed[entry["idx"]] = entry["key"]
+            if "frames" in entry:
+                self.frames[entry["idx"]] = entry["frames"]
+
+    def _append(self, entry: Dict):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def record(self, idx: int, key: Optional[str], frames: Optional[int] = None):
+        """
+        记录片段idx已完成（对应缓存键key；没有音频的片段为None）
+        :param frames: 写完该片段后输出文件的总帧数（用于断点续写）
+        """
+        self.completed[idx] = key
+        entry = {"idx": idx, "key": key}
+        if frames is not None:
+            self.frames[idx] = frames
+            entry["frames"] = frames
+        self._append(entry)
+
+    def resume_point(self, available_frames: int) -> Tuple[int, int]:
+        """
+        可从哪里续写：从0开始连续处理完、且已确实写入输出文件（不超过 available_frames）的片段数
+        :return: (续写起点片段下标, 保留的帧数)
+        """
+        count, frames = 0, 0
+        while count in self.frames and self.frames[count] <= available_frames:
+            frames = self.frames[count]
+            count += 1
+        return count, frames
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        """任务全部完成后删除清单"""
+        self.close()
+        os.remove(self.path)
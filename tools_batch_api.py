@@ -0,0 +1,243 @@
+import argparse
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from tools_call_qianwen import GenerationResult
+from tools_moderation import is_moderation_error
+
+# DashScope Batch接口（OpenAI兼容）的请求行格式
+BATCH_ENDPOINT = "/v1/chat/completions"
+# 请求文件旁的元数据文件：每行对应一个待处理单元（文本块），记录custom_id与入库时需要的信息
+META_SUFFIX = ".meta.jsonl"
+# 离线批处理文件的默认目录
+DEFAULT_BATCH_DIR = "./batch"
+
+
+def make_custom_id(stage: str, index: int, prompt: str) -> str:
+    """稳定的请求ID：阶段 + 序号 + 提示词哈希（相同输入重新生成的请求文件ID不变，结果可复用）"""
+    digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+    return f"{stage}-{index:05d}-{digest}"
+
+
+def build_request_line(custom_id: str, model: str, prompt: str, **parameters) -> Dict[str, Any]:
+    """构造一行Batch请求（参数与实时调用的 QianwenClient.build_payload 保持一致）"""
+    body = {"model": model, "messages": [{"role": "user", "content": prompt}], "temperature": 0.1}
+    body.update(parameters)
+    return {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body}
+
+
+class BatchRequestWriter:
+    """
+    生成Batch请求文件（JSONL）与元数据文件
+
+    - add() 写一行请求，返回custom_id；同一单元可以不发请求（如规则已全部确定），只记元数据
+    - 元数据按单元顺序记录，入库时据此按原文顺序还原结果
+    """
+
+    def __init__(self, path: str, stage: str, model: str):
+        self.path = path
+        self.stage = stage
+        self.model = model
+        self.requests = 0
+        self.units = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._requests = open(path, "w", encoding="utf-8")
+        self._meta = open(path + META_SUFFIX, "w", encoding="utf-8")
+
+    def add(self, prompt: Optional[str], meta: Optional[Dict] = None) -> Optional[str]:
+        """
+        记录一个单元
+        :param prompt: 该单元的提示词（None表示不需要请求大模型）
+        :param meta: 入库时需要的信息（如块文本、规则标注结果）
+        :return: custom_id（不发请求时为None）
+        """
+        custom_id = None
+        if prompt is not None:
+            custom_id = make_custom_id(self.stage, self.units, prompt)
+            line = build_request_line(custom_id, self.model, prompt)
+            self._requests.write(json.dumps(line, ensure_ascii=False) + "\n")
+            self.requests += 1
+        self._meta.write(json.dumps({"index": self.units, "custom_id": custom_id, "meta": meta or {}},
+                                    ensure_ascii=False) + "\n")
+        self.units += 1
+        return custom_id
+
+    def close(self):
+        self._requests.close()
+        self._meta.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+@dataclass
+class BatchOutcome:
+    """Batch结果文件中的一条结果（result与error二选一）"""
+    custom_id: str
+    result: Optional[GenerationResult] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _parse_result_line(record: Dict) -> BatchOutcome:
+    """解析结果文件/错误文件中的一行（兼容OpenAI格式与DashScope原生格式的响应体）"""
+    custom_id = record.get("custom_id", "")
+    error = record.get("error")
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    if error or response.get("status_code", 200) != 200 or body.get("error"):
+        detail = error or body.get("error") or body
+        if isinstance(detail, dict):
+            detail = f"{detail.get('code', '')}: {detail.get('message', json.dumps(detail, ensure_ascii=False))}"
+        return BatchOutcome(custom_id, error=f"Batch请求失败 - {detail}")
+
+    usage = body.get("usage") or {}
+    usage = {
+        "input_tokens": usage.get("input_tokens", usage.get("prompt_tokens", 0)),
+        "output_tokens": usage.get("output_tokens", usage.get("completion_tokens", 0)),
+    }
+    if body.get("choices"):
+        choice = body["choices"][0]
+        text = (choice.get("message") or {}).get("content", "")
+        finish_reason = choice.get("finish_reason")
+    else:
+        output = body.get("output") or {}
+        text = output.get("text", "")
+        finish_reason = output.get("finish_reason")
+    return BatchOutcome(custom_id, result=GenerationResult(text, finish_reason=finish_reason, usage=usage))
+
+
+def read_batch_results(paths: Iterable[str]) -> Dict[str, BatchOutcome]:
+    """读取一个或多个结果文件/错误文件，返回 {custom_id: 结果}（同一ID以成功结果优先）"""
+    outcomes: Dict[str, BatchOutcome] = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                outcome = _parse_result_line(json.loads(line))
+                if outcome.ok or outcome.custom_id not in outcomes:
+                    outcomes[outcome.custom_id] = outcome
+    return outcomes
+
+
+def _stage_base(request_path: str) -> str:
+    base = os.path.splitext(request_path)[0]
+    return base[:-len("_requests")] if base.endswith("_requests") else base
+
+
+def retry_path_for(request_path: str) -> str:
+    """失败请求的重试文件路径（xxx_requests.jsonl -> xxx_retry_requests.jsonl）"""
+    return _stage_base(request_path) + "_retry_requests.jsonl"
+
+
+def write_retry_requests(request_path: str, custom_ids: Iterable[str], retry_path: str) -> int:
+    """从请求文件中摘出指定ID的请求行，写成重试文件（custom_id不变，重试结果可与原结果文件一起入库）"""
+    wanted = set(custom_ids)
+    count = 0
+    with open(request_path, "r", encoding="utf-8") as src, open(retry_path, "w", encoding="utf-8") as dst:
+        for line in src:
+            if line.strip() and json.loads(line)["custom_id"] in wanted:
+                dst.write(line if line.endswith("\n") else line + "\n")
+                count += 1
+    return count
+
+
+def load_batch_units(request_path: str, result_paths: Iterable[str]) -> List[Tuple[Dict, Optional[BatchOutcome]]]:
+    """
+    按单元顺序返回 (元数据, 结果)：不需要请求的单元结果为None；
+    需要请求却在结果文件中找不到的单元，结果为带错误信息的 BatchOutcome
+
+    除内容审核外还有失败的请求时，把它们写入重试文件并抛出异常（此时不应写出任何结果，避免片段缺失）
+    """
+    outcomes = read_batch_results(result_paths)
+    units = []
+    with open(request_path + META_SUFFIX, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            unit = json.loads(line)
+            custom_id = unit["custom_id"]
+            outcome = None
+            if custom_id is not None:
+                outcome = outcomes.get(custom_id) or BatchOutcome(custom_id, error="结果文件中缺少该请求的结果")
+            units.append((unit["meta"], outcome))
+
+    failed = [outcome for _, outcome in units
+              if outcome is not None and not outcome.ok and not is_moderation_error(outcome.error)]
+    if failed:
+        retry_path = retry_path_for(request_path)
+        write_retry_requests(request_path, (outcome.custom_id for outcome in failed), retry_path)
+        raise Exception(f"{len(failed)} 个请求没有可用结果（如 {failed[0].custom_id}：{failed[0].error}），"
+                        f"已写入重试文件：{retry_path}；提交后把新的结果文件与原结果文件一起入库")
+    return units
+
+
+def fabricate_results(request_path: str, result_path: str, respond: Optional[Callable[[str], str]] = None,
+                      fail: Optional[Callable[[str], Optional[str]]] = None) -> int:
+    """
+    本地伪造Batch结果文件（离线测试入库流程用，格式与DashScope Batch输出一致）
+    :param respond: 提示词 -> 模型输出，默认使用 FakeDashScopeServer.fake_output
+    :param fail: 提示词 -> 错误信息（返回None表示成功），用于模拟内容审核等失败
+    :return: 结果条数
+    """
+    if respond is None:
+        from tools_fake_dashscope import FakeDashScopeServer
+        respond = FakeDashScopeServer.fake_output
+    count = 0
+    with open(request_path, "r", encoding="utf-8") as src, open(result_path, "w", encoding="utf-8") as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            prompt = request["body"]["messages"][-1]["content"]
+            error = fail(prompt) if fail is not None else None
+            if error:
+                record = {"id": f"batch_req_{count}", "custom_id": request["custom_id"], "response": None,
+                          "error": {"code": "DataInspectionFailed", "message": error}}
+            else:
+                text = respond(prompt)
+                record = {
+                    "id": f"batch_req_{count}",
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "request_id": f"fake-{count}", "body": {
+                        "object": "chat.completion",
+                        "model": request["body"]["model"],
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                     "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": len(prompt), "completion_tokens": len(text),
+                                  "total_tokens": len(prompt) + len(text)},
+                    }},
+                    "error": None,
+                }
+            dst.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def default_request_path(stage: str, batch_dir: str = DEFAULT_BATCH_DIR) -> str:
+    """某阶段默认的请求文件路径"""
+    return os.path.join(batch_dir, f"{stage}_requests.jsonl")
+
+
+def default_results_path(request_path: str) -> str:
+    """请求文件对应的默认结果文件路径（xxx_requests.jsonl -> xxx_results.jsonl）"""
+    return _stage_base(request_path) + "_results.jsonl"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DashScope Batch文件工具：本地伪造结果文件（离线测试入库流程）")
+    parser.add_argument("requests", help="Batch请求文件路径")
+    parser.add_argument("results", nargs="?", default=None, help="输出的结果文件路径（默认与请求文件同目录）")
+    args = parser.parse_args()
+    results_path = args.results or default_results_path(args.requests)
+    print(f"已生成 {fabricate_results(args.requests, results_path)} 条伪造结果：{results_path}")
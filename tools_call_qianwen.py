@@ -1,93 +1,343 @@
-import requests
 import json
+import logging
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
 from http import HTTPStatus  # 用于状态码判断
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from tools_hedging import RequestHedger
+from tools_llm_cache import LLMResponseCache, get_default_cache, make_cache_key
+from tools_metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 标准API端点 (与你的generate_*.py文件一致)；可用环境变量指向本地替身服务做测试
+DEFAULT_BASE_URL = os.environ.get("DASHSCOPE_BASE_URL", "https://dashscope.aliyuncs.com")
+GENERATION_PATH = "/api/v1/services/aigc/text-generation/generation"
+# 设置 QWEN_HEDGE=1 为共享客户端开启请求对冲（慢请求超过近期延迟分位数时补发一份，先返回者胜出）
+HEDGING_ENABLED = os.environ.get("QWEN_HEDGE", "") not in ("", "0", "false", "False")
+
+# 需要重试的HTTP状态码：限流 + 服务端错误
+RETRY_STATUS_CODES = {
+    HTTPStatus.TOO_MANY_REQUESTS,
+    HTTPStatus.INTERNAL_SERVER_ERROR,
+    HTTPStatus.BAD_GATEWAY,
+    HTTPStatus.SERVICE_UNAVAILABLE,
+    HTTPStatus.GATEWAY_TIMEOUT,
+}
+
+
+@dataclass
+class GenerationResult:
+    """一次生成调用的结果：文本 + 结束原因 + token用量"""
+    text: str
+    finish_reason: Optional[str] = None  # "stop"正常结束 / "length"达到输出上限被截断；缓存命中时为None（截断的输出不入缓存）
+    usage: Dict[str, int] = field(default_factory=dict)  # input_tokens / output_tokens；缓存命中时为空
+    cached: bool = False
+
+    @property
+    def truncated(self) -> bool:
+        return self.finish_reason == "length"
+
 
-def call_qianwen_api_via_requests(api_key: str, model: str, prompt: str) -> str:
+class QianwenAPIError(Exception):
+    """千问API调用失败（已用尽重试或遇到不可重试的错误）"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, code: Optional[str] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析Retry-After响应头（秒数或HTTP日期），无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class QianwenClient:
+    """
+    可复用的通义千问客户端
+
+    - 持有带连接池的 requests.Session，多次调用复用keep-alive连接（线程安全，可被并发分发共享）
+    - 对429/5xx/超时/连接错误按带抖动的指数退避重试，优先遵循服务端的Retry-After
+    - 调用路径上只输出debug级日志
+    - base_url 可指向本地替身HTTP服务，便于离线测试
+    - 传入 hedger 时开启请求对冲：单次请求超过近期延迟分位数仍未返回就补发一份，压低长尾延迟
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = DEFAULT_BASE_URL,
+        timeout: float = 60,
+        max_retries: int = 4,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        pool_size: int = 16,
+        cache: Optional[LLMResponseCache] = None,
+        hedger: Optional[RequestHedger] = None,
+    ):
+        self.api_key = api_key
+        self.url = base_url.rstrip("/") + GENERATION_PATH
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cache = cache if cache is not None else get_default_cache()
+        self.hedger = hedger
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # 标准请求头 - 注意API密钥格式（不要尖括号！）
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        })
+
+    @staticmethod
+    def build_payload(model: str, prompt: str, **parameters) -> Dict[str, Any]:
+        """构造标准请求体 (通过messages调用，这是最新推荐方式)[citation:2]"""
+        params = {
+            "result_format": "text",  # 或 "message" 格式更完整[citation:10]
+            "temperature": 0.1,  # 低温度保证输出稳定
+        }
+        params.update(parameters)
+        return {
+            "model": model,
+            "input": {
+                "messages": [
+                    {"role": "user", "content": prompt}
+                ]
+            },
+            "parameters": params,
+        }
+
+    def generate(self, model: str, prompt: str, use_cache: bool = True, **parameters) -> str:
+        """
+        调用千问生成接口，返回文本内容
+
+        Args:
+            model: 模型名称，如 'qwen-turbo', 'qwen-plus', 'qwen-max'
+            prompt: 用户输入的文本提示
+            use_cache: 是否使用本地响应缓存
+            **parameters: 覆盖默认的 parameters 字段（如 temperature）
+
+        Returns:
+            模型输出文本
+        """
+        return self.generate_result(model, prompt, use_cache=use_cache, **parameters).text
+
+    def generate_result(self, model: str, prompt: str, use_cache: bool = True, **parameters) -> GenerationResult:
+        """
+        与 generate 相同，但同时返回响应中的 finish_reason 和 usage（用于判断输出是否被截断）
+
+        Returns:
+            GenerationResult
+        """
+        payload = self.build_payload(model, prompt, **parameters)
+
+        # 命中本地缓存则直接返回（缓存只保存文本，没有结束原因和用量）
+        cache = self.cache if use_cache else None
+        cache_key = make_cache_key(model, prompt, payload["parameters"]) if cache else None
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.debug("缓存命中：%s", cache_key)
+                metrics.inc("llm_cache_hits_total", model=model)
+                return GenerationResult(cached, cached=True)
+            metrics.inc("llm_cache_misses_total", model=model)
+
+        resp_json = self._post_with_retry(payload)
+        result = GenerationResult(
+            self.extract_text(resp_json),
+            finish_reason=self.extract_finish_reason(resp_json),
+            usage={key: value for key, value in (resp_json.get("usage") or {}).items() if isinstance(value, int)},
+        )
+        if result.finish_reason:
+            metrics.inc("llm_finish_reason_total", model=model, reason=result.finish_reason)
+        # 被截断的输出不缓存：缓存只存文本，重放时会丢失截断标记，调用方就不会补请求
+        if cache is not None and not result.truncated:
+            cache.put(cache_key, result.text)
+        return result
+
+    @staticmethod
+    def extract_text(resp_json: Dict[str, Any]) -> str:
+        """根据不同的result_format从响应中提取文本"""
+        output = resp_json.get("output") or {}
+        # 方式1: result_format为"text"时的解析
+        if output.get("text"):
+            return output["text"]
+        # 方式2: result_format为"message"时的解析 (推荐格式)[citation:10]
+        if output.get("choices"):
+            message = output["choices"][0].get("message", {})
+            if message and "content" in message:
+                return message["content"]
+        # 如果以上方式都没提取到，抛出异常
+        raise QianwenAPIError(f"无法从API响应中提取内容，响应结构异常：{resp_json}")
+
+    @staticmethod
+    def extract_finish_reason(resp_json: Dict[str, Any]) -> Optional[str]:
+        """提取结束原因（"stop"/"length"等），两种result_format都支持"""
+        output = resp_json.get("output") or {}
+        if output.get("finish_reason"):
+            return output["finish_reason"]
+        if output.get("choices"):
+            return output["choices"][0].get("finish_reason")
+        return None
+
+    def _backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """计算第attempt次重试前的等待时间（full jitter指数退避，Retry-After优先）"""
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _post_with_retry(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """发送请求，按需重试，返回解析后的JSON响应"""
+        model = payload["model"]
+        last_error: Optional[Exception] = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = self._send(payload)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                last_error = QianwenAPIError(f"调用千问API失败：{e}")
+                status = "timeout" if isinstance(e, requests.exceptions.Timeout) else "connection_error"
+            else:
+                status = str(response.status_code)
+                if response.status_code == HTTPStatus.OK:
+                    try:
+                        resp_json = response.json()
+                    except ValueError:
+                        raise QianwenAPIError(f"API返回的不是有效JSON: {response.text[:200]}")
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("API响应：%s", json.dumps(resp_json, ensure_ascii=False))
+                    usage = resp_json.get("usage") or {}
+                    metrics.inc("llm_input_tokens_total", usage.get("input_tokens", 0), model=model)
+                    metrics.inc("llm_output_tokens_total", usage.get("output_tokens", 0), model=model)
+                    return resp_json
+
+                last_error = self._http_error(response)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    raise last_error
+                retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+
+            if attempt < self.max_retries:
+                delay = self._backoff_delay(attempt, retry_after)
+                logger.debug("第%d次请求失败（%s），%.2f秒后重试", attempt + 1, last_error, delay)
+                metrics.inc("llm_retries_total", model=model, reason=status)
+                time.sleep(delay)
+        raise last_error
+
+    def _send(self, payload: Dict[str, Any]) -> requests.Response:
+        """发送一次请求；开启对冲时，慢请求会补发一份，采用先返回的可用响应"""
+        if self.hedger is None:
+            return self._post_once(payload)
+        return self.hedger.call(
+            payload["model"],
+            lambda: self._post_once(payload),
+            is_final=lambda response: response.status_code not in RETRY_STATUS_CODES,
+            discard=lambda response: response.close(),
+        )
+
+    def _post_once(self, payload: Dict[str, Any]) -> requests.Response:
+        """发送一次HTTP请求并记录耗时与结果（超时/连接错误原样抛出）"""
+        model = payload["model"]
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.url, json=payload, timeout=self.timeout)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            self._record_request(model, "timeout" if isinstance(e, requests.exceptions.Timeout)
+                                 else "connection_error", start)
+            raise
+        self._record_request(model, str(response.status_code), start)
+        if self.hedger is not None and response.status_code == HTTPStatus.OK:
+            self.hedger.observe(model, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def _record_request(model: str, status: str, start: float):
+        """记录单次HTTP请求的耗时与结果"""
+        metrics.observe("llm_request_seconds", time.perf_counter() - start, model=model, status=status)
+        metrics.inc("llm_requests_total", model=model, status=status)
+
+    @staticmethod
+    def _http_error(response: requests.Response) -> QianwenAPIError:
+        """把非200响应转换为QianwenAPIError（保留服务端的code/message）"""
+        error_msg = f"HTTP错误 ({response.status_code})"
+        code = None
+        if response.text:
+            try:
+                error_detail = json.loads(response.text)
+                code = error_detail.get("code")
+                error_msg += f": {error_detail.get('message', response.text)}"
+            except ValueError:
+                error_msg += f": {response.text}"
+        return QianwenAPIError(f"API调用失败 - {error_msg}", status_code=response.status_code, code=code)
+
+    def close(self):
+        self.session.close()
+        if self.hedger is not None:
+            self.hedger.close()
+
+
+_clients: Dict[str, QianwenClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key: str) -> QianwenClient:
+    """获取进程内共享的客户端（按API Key复用连接池）"""
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            client = _clients[api_key] = QianwenClient(api_key,
+                                                       hedger=RequestHedger() if HEDGING_ENABLED else None)
+        return client
+
+
+def call_qianwen_api_via_requests(api_key: str, model: str, prompt: str, use_cache: bool = True) -> str:
     """
     使用requests库直接调用通义千问API（推荐用于简单请求）
     
     标准请求方式参考官方文档：https://help.aliyun.com/document_detail/2712581.html[citation:2]
+    内部复用共享的 QianwenClient（连接池 + 重试退避 + 响应缓存）
     
     Args:
         api_key: 你的DashScope API Key (sk-开头)
         model: 模型名称，如 'qwen-turbo', 'qwen-plus', 'qwen-max'
         prompt: 用户输入的文本提示
+        use_cache: 是否使用本地响应缓存（相同 模型+提示词+参数 直接返回缓存结果，不发请求）
     
     Returns:
         API返回的文本内容
     """
-    # 标准API端点 (与你的generate_*.py文件一致)
-    url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
-    
-    # 标准请求头 - 注意API密钥格式（不要尖括号！）
-    headers = {
-        "Authorization": f"Bearer {api_key}",  # 关键修正：移除了尖括号
-        "Content-Type": "application/json"
-    }
-    
-    # 标准请求体 (通过messages调用，这是最新推荐方式)[citation:2]
-    payload = {
-        "model": model,
-        "input": {
-            "messages": [
-                {"role": "user", "content": prompt}
-            ]
-        },
-        "parameters": {
-            "result_format": "text",  # 或 "message" 格式更完整[citation:10]
-            "temperature": 0.1  # 低温度保证输出稳定
-        }
-    }
-    
-    try:
-        # 发送请求，设置合理超时
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()  # 检查HTTP状态码
-        
-        # 解析响应
-        resp_json = response.json()
-        
-        # 打印完整响应结构以便调试
-        print("完整的API响应结构：")
-        print(json.dumps(resp_json, ensure_ascii=False, indent=2))
-        # 打印接口的类型与内容
-        print("完打印接口的类型与内容1：")
-        print(f"resp_json类型：{type(resp_json)}，内容：{resp_json}")
-        
-        
-        # 关键：根据不同的result_format提取结果
-        if resp_json.get("output"):
-            output = resp_json["output"]
-            
-            # 打印接口的类型与内容
-            print("完打印接口的类型与内容1：")
-            print(f"output类型：{type(output)}，内容：{output}")
-            # 方式1: result_format为"text"时的解析 (你的代码原有方式)
-            if "text" in output and output["text"]:
-                return output["text"]
-            
-            # 方式2: result_format为"message"时的解析 (推荐格式)[citation:10]
-            if "choices" in output and output["choices"]:
-                message = output["choices"][0].get("message", {})
-                if message and "content" in message:
-                    return message["content"]
-        
-        # 如果以上方式都没提取到，抛出异常
-        raise ValueError(f"无法从API响应中提取内容，响应结构异常：{resp_json}")
-        
-    except requests.exceptions.HTTPError as e:
-        error_msg = f"HTTP错误 ({response.status_code})"
-        if response.text:
-            try:
-                error_detail = json.loads(response.text)
-                error_msg += f": {error_detail.get('message', response.text)}"
-            except:
-                error_msg += f": {response.text}"
-        raise Exception(f"API调用失败 - {error_msg}")
-    except json.JSONDecodeError as e:
-        raise Exception(f"API返回的不是有效JSON: {response.text[:200]}")
-    except Exception as e:
-        raise Exception(f"调用千问API失败：{str(e)}")
+    return call_qianwen_api_with_result(api_key, model, prompt, use_cache=use_cache).text
+
+
+def call_qianwen_api_with_result(api_key: str, model: str, prompt: str, use_cache: bool = True) -> GenerationResult:
+    """
+    与 call_qianwen_api_via_requests 相同，但返回 GenerationResult（含 finish_reason 和 usage），
+    调用方可据此识别输出是否因达到输出token上限而被截断
+    """
+    with metrics.timer("llm_call_seconds", model=model):
+        return get_client(api_key).generate_result(model, prompt, use_cache=use_cache)
 
 # 另一种选择：使用官方SDK的调用方式（更简洁，但需额外安装）
 # def call_qianwen_api_via_sdk(api_key: str, prompt: str):
@@ -0,0 +1,180 @@
+import re
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+from tools_metrics import metrics
+
+# 中文字符的token估算系数（通义千问分词器下常见汉字约0.6~0.8个token/字，取偏保守的值）
+CJK_TOKENS_PER_CHAR = 0.8
+# 非中文字符（英文、数字、空白）约4个字符一个token
+OTHER_CHARS_PER_TOKEN = 4
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+# 句末标点（可带后引号/括号）或换行视为句子边界
+_SENTENCE_END_RE = re.compile(r"[。！？!?…]+[”’」』）)]*|\n+")
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的token数（线性扫描，不依赖分词器）"""
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk
+    return int(cjk * CJK_TOKENS_PER_CHAR + other / OTHER_CHARS_PER_TOKEN) + 1
+
+
+def split_sentences(text: str) -> List[Tuple[int, int, int]]:
+    """
+    按句子边界切分文本
+    :return: [(起始下标, 结束下标, 估算token数), ...]，首尾相接覆盖全文
+    """
+    sentences = []
+    start = 0
+    for match in _SENTENCE_END_RE.finditer(text):
+        end = match.end()
+        sentences.append((start, end, estimate_tokens(text[start:end])))
+        start = end
+    if start < len(text):
+        sentences.append((start, len(text), estimate_tokens(text[start:])))
+    return sentences
+
+
+def _hard_split(text: str, start: int, end: int, max_tokens: int) -> Iterator[Tuple[int, int, int]]:
+    """超长句子（没有句末标点的大段文字）按token预算硬切"""
+    piece_start = start
+    tokens = 0.0
+    for pos in range(start, end):
+        cost = CJK_TOKENS_PER_CHAR if _CJK_RE.match(text[pos]) else 1 / OTHER_CHARS_PER_TOKEN
+        if tokens + cost > max_tokens and pos > piece_start:
+            yield piece_start, pos, int(tokens) + 1
+            piece_start, tokens = pos, 0.0
+        tokens += cost
+    if piece_start < end:
+        yield piece_start, end, int(tokens) + 1
+
+
+def pack_sentences(sentences: List[Tuple[int, int, int]], first: int, max_tokens: int) -> int:
+    """
+    从第first句开始贪心装箱，返回装入本块的最后一句之后的下标（至少装入一句）
+    """
+    total = 0
+    last = first
+    while last < len(sentences):
+        tokens = sentences[last][2]
+        if total + tokens > max_tokens and last > first:
+            break
+        total += tokens
+        last += 1
+    return last
+
+
+def iter_chunks(text: str, max_tokens: int = 1600, overlap_tokens: int = 0) -> Iterator[str]:
+    """
+    把长文本切成不超过token预算的块（生成器，整体线性时间）
+
+    - 优先在句子边界切分，单句超过预算时才在句中硬切
+    - overlap_tokens>0 时，相邻块之间重叠不超过该预算的整句（便于跨块上下文，如角色提取）
+    - 不会产出空块
+
+    Args:
+        text: 原文
+        max_tokens: 每块的token预算
+        overlap_tokens: 相邻块重叠的token预算（0表示不重叠；标注文本时必须为0，否则片段重复）
+    """
+    sentences = []
+    for start, end, tokens in split_sentences(text):
+        if tokens > max_tokens:
+            sentences.extend(_hard_split(text, start, end, max_tokens))
+        else:
+            sentences.append((start, end, tokens))
+
+    first = 0
+    while first < len(sentences):
+        last = pack_sentences(sentences, first, max_tokens)
+        chunk = text[sentences[first][0]:sentences[last - 1][1]].strip()
+        if chunk:
+            yield chunk
+        if last >= len(sentences):
+            break
+        # 回退若干整句作为下一块的开头，保证每轮至少前进一句
+        next_first = last
+        if overlap_tokens > 0:
+            overlap = 0
+            while next_first - 1 > first and overlap + sentences[next_first - 1][2] <= overlap_tokens:
+                next_first -= 1
+                overlap += sentences[next_first][2]
+        first = next_first
+
+
+class AdaptiveChunkSizer:
+    """
+    按大模型输出是否被截断自适应调整块的token预算（线程安全，可被并发标注共享）
+
+    - 记录 输出token/输入token 的比例，目标预算 = 输出上限 * safety / 比例，即一次调用能完整输出的最大块
+    - 输出被截断：立即缩小到该次输入的 shrink 倍，并以实际输出token数更新输出上限
+    - 有余量：每次最多放大 grow 倍，逐步逼近目标（不会一步放大到刚好截断的位置）
+    """
+
+    def __init__(self, initial_tokens: int = 1600, min_tokens: int = 300, max_tokens: int = 6000,
+                 output_limit: int = 1500, safety: float = 0.85, shrink: float = 0.6, grow: float = 1.25):
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.output_limit = output_limit
+        self.safety = safety
+        self.shrink = shrink
+        self.grow = grow
+        self.ratio: Optional[float] = None  # 输出token/输入token 的滑动估计
+        self.truncations = 0
+        self._tokens = min(max(initial_tokens, min_tokens), max_tokens)
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> int:
+        """当前的块token预算"""
+        with self._lock:
+            return self._tokens
+
+    def record(self, input_tokens: int, output_tokens: int, truncated: bool):
+        """
+        记录一次调用的结果
+        :param input_tokens: 本次发送的文本token数（不含提示词模板）
+        :param output_tokens: 本次输出token数（优先用响应中的usage）
+        :param truncated: 输出是否被截断（finish_reason为length或JSON未闭合）
+        """
+        if input_tokens <= 0 or output_tokens <= 0:
+            return
+        observed = output_tokens / input_tokens
+        with self._lock:
+            if truncated:
+                # 截断时实际比例只会更大；实际输出量就是模型的输出上限
+                self.truncations += 1
+                self.output_limit = min(self.output_limit, output_tokens)
+                self.ratio = max(self.ratio or 0.0, observed)
+                self._tokens = max(self.min_tokens, min(self._tokens, int(input_tokens * self.shrink)))
+                metrics.inc("adaptive_chunk_shrinks_total")
+            else:
+                self.ratio = observed if self.ratio is None else 0.7 * self.ratio + 0.3 * observed
+                target = int(self.output_limit * self.safety / self.ratio)
+                target = min(max(target, self.min_tokens), self.max_tokens)
+                if target < self._tokens:
+                    self._tokens = target
+                else:
+                    self._tokens = min(target, max(self._tokens + 1, int(self._tokens * self.grow)))
+            metrics.set_gauge("adaptive_chunk_tokens", self._tokens)
+
+
+def iter_adaptive_chunks(text: str, sizer: AdaptiveChunkSizer) -> Iterator[str]:
+    """
+    与 iter_chunks 相同（句子边界装箱、不重叠），但每一块的预算在产出前才从sizer读取，
+    调用方在处理完上一块后 sizer.record(...)，下一块即按新的预算切分
+    """
+    sentences = split_sentences(text)
+    first = 0
+    while first < len(sentences):
+        budget = sizer.tokens
+        start, end, tokens = sentences[first]
+        if tokens > budget:
+            sentences[first:first + 1] = list(_hard_split(text, start, end, budget))
+        last = pack_sentences(sentences, first, budget)
+        chunk = text[sentences[first][0]:sentences[last - 1][1]].strip()
+        if chunk:
+            yield chunk
+        first = last
@@ -0,0 +1,114 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional, Sequence
+
+
+class RateLimiter:
+    """
+    滑动窗口限流器：同时限制每分钟请求数(RPM)与每分钟token数(TPM)
+
+    多个线程共享同一个实例，acquire() 会阻塞直到窗口内有足够额度。
+    rpm/tpm 为 0 表示不限制该维度。
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._events = deque()  # (时间戳, token数)
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def _purge(self, now: float):
+        while self._events and now - self._events[0][0] >= self.window:
+            _, tokens = self._events.popleft()
+            self._tokens_in_window -= tokens
+
+    def acquire(self, tokens: int = 0):
+        """申请一次请求额度（tokens为本次请求预估消耗的token数）"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._purge(now)
+                rpm_ok = not self.rpm or len(self._events) < self.rpm
+                # 单个请求超过整个TPM额度时，只要窗口为空就放行，避免永久阻塞
+                tpm_ok = (not self.tpm or not self._events
+                          or self._tokens_in_window + tokens <= self.tpm)
+                if rpm_ok and tpm_ok:
+                    self._events.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    return
+                wait = self.window - (now - self._events[0][0])
+            time.sleep(max(wait, 0.01))
+
+
+@dataclass
+class TaskResult:
+    """单个任务的执行结果（value与error二选一）"""
+    index: int
+    value: Any = None
+    error: Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def dispatch_in_order(
+    func: Callable[[Any], Any],
+    items: Sequence[Any],
+    max_workers: int = 4,
+    limiter: Optional[RateLimiter] = None,
+    cost_fn: Optional[Callable[[Any], int]] = None,
+    on_done: Optional[Callable[[TaskResult], None]] = None,
+    should_abort: Optional[Callable[[BaseException], bool]] = None,
+) -> List[TaskResult]:
+    """
+    用有界线程池并发执行 func(item)，结果按输入顺序返回
+
+    Args:
+        func: 任务函数，接收单个item
+        items: 任务输入列表
+        max_workers: 最大并发数
+        limiter: 可选的限流器，每个任务开始前申请额度
+        cost_fn: 估算单个item消耗的token数（配合limiter的TPM限制）
+        on_done: 任务完成回调（按完成顺序调用，用于打印进度）
+        should_abort: 判断异常是否致命；返回True时取消所有尚未开始的任务
+
+    Returns:
+        与items一一对应的TaskResult列表
+    """
+    results: List[Optional[TaskResult]] = [None] * len(items)
+    aborted = threading.Event()
+    done_lock = threading.Lock()
+
+    def run(index: int, item: Any) -> TaskResult:
+        if aborted.is_set():
+            return TaskResult(index, error=CancelledError())
+        if limiter is not None:
+            limiter.acquire(cost_fn(item) if cost_fn else 0)
+        try:
+            return TaskResult(index, value=func(item))
+        except Exception as e:
+            if should_abort is not None and should_abort(e):
+                aborted.set()
+            return TaskResult(index, error=e)
+
+    def finish(future):
+        if future.cancelled():
+            return
+        result = future.result()
+        results[result.index] = result
+        if on_done is not None:
+            with done_lock:
+                on_done(result)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for index, item in enumerate(items):
+            executor.submit(run, index, item).add_done_callback(finish)
+
+    return [r if r is not None else TaskResult(i, error=CancelledError())
+            for i, r in enumerate(results)]
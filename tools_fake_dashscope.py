@@ -0,0 +1,166 @@
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+GENERATION_PATH = "/api/v1/services/aigc/text-generation/generation"
+
+_TEXT_RE = re.compile(r"小说文本：\s*(.*?)\s*(?:输出格式示例：|$)", re.S)
+_SENTENCE_RE = re.compile(r"[^。！？!?\n]+[。！？!?]*[”’」』]?")
+_SPEAKER_RE = re.compile(r"([\u4e00-\u9fff]{2,3})(?:说|道|问)")
+_PENDING_RE = re.compile(r"【(\d+)】")
+
+
+class FakeDashScopeServer:
+    """
+    本地DashScope文本生成接口替身（基准测试/离线调试用，协议与真实接口一致）
+
+    - latency/jitter：每个请求的模拟耗时（秒），实际耗时在 latency*(1±jitter) 间均匀分布
+    - slow_rate/slow_factor：按概率让请求变慢 slow_factor 倍，模拟长尾（每个请求独立抽样，重发的请求多半不慢）
+    - error_rate：按概率返回429/500（客户端会退避重试）
+    - moderation_rate：按句子哈希确定性地把这一比例的句子视为违规，提示词中含违规句子即返回内容审核拒绝
+      （同一句子无论放在哪个提示词里结果都不变，与真实行为一致）
+    - max_output_tokens：模拟模型的输出上限（按字符计），超出时截断输出并返回 finish_reason="length"（0表示不限）
+    - 根据提示词类型返回角色数组 / 标注片段数组 / 待定对白判断，格式与真实模型输出一致
+
+    用法：
+        with FakeDashScopeServer(latency=0.3) as server:
+            os.environ["DASHSCOPE_BASE_URL"] = server.url  # 需在导入 tools_call_qianwen 之前设置
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.5, error_rate: float = 0.0,
+                 moderation_rate: float = 0.0, seed: int = 0, host: str = "127.0.0.1", port: int = 0,
+                 max_output_tokens: int = 0, slow_rate: float = 0.0, slow_factor: float = 10.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.moderation_rate = moderation_rate
+        self.max_output_tokens = max_output_tokens
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.status_counts: Counter = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeDashScopeServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    # ---------- 响应生成 ----------
+    def is_banned_sentence(self, sentence: str) -> bool:
+        digest = int(hashlib.md5(sentence.strip().encode("utf-8")).hexdigest()[:8], 16)
+        return digest / 0xFFFFFFFF < self.moderation_rate
+
+    def _is_moderated(self, prompt: str) -> bool:
+        if not self.moderation_rate:
+            return False
+        match = _TEXT_RE.search(prompt)
+        text = match.group(1) if match else prompt
+        return any(self.is_banned_sentence(sentence) for sentence in _SENTENCE_RE.findall(text))
+
+    @staticmethod
+    def fake_output(prompt: str) -> str:
+        """按提示词类型构造与真实模型格式一致的输出"""
+        match = _TEXT_RE.search(prompt)
+        text = match.group(1) if match else prompt
+        if "提取所有出场角色" in prompt:
+            names = list(dict.fromkeys(_SPEAKER_RE.findall(text)))[:5]
+            result = [
+                {"name": name, "gender": "未知", "age": "未知", "personality": "未知",
+                 "voice_style": "中性声线", "description": "未知"}
+                for name in names
+            ]
+        elif "【编号】" in prompt:
+            result = [
+                {"id": int(span_id), "speaker": "旁白", "emotion": "neutral", "speed": 1.0}
+                for span_id in dict.fromkeys(_PENDING_RE.findall(text))
+            ]
+        else:
+            result = [
+                {"text": sentence.strip(), "speaker": "旁白", "emotion": "neutral", "speed": 1.0}
+                for sentence in _SENTENCE_RE.findall(text) if sentence.strip()
+            ]
+        return json.dumps(result, ensure_ascii=False)
+
+    def handle(self, body: Dict) -> Tuple[int, Dict]:
+        """处理一次生成请求，返回 (HTTP状态码, 响应体)"""
+        prompt = body["input"]["messages"][-1]["content"]
+        with self._lock:
+            delay = self.latency * (1 + self.jitter * (2 * self._rng.random() - 1))
+            if self._rng.random() < self.slow_rate:
+                delay *= self.slow_factor
+            failed = self._rng.random() < self.error_rate
+            status = self._rng.choice((429, 500)) if failed else 200
+        time.sleep(max(delay, 0.0))
+
+        request_id = str(uuid.uuid4())
+        if status != 200:
+            code = "Throttling.RateQuota" if status == 429 else "InternalError"
+            return status, {"code": code, "message": "Simulated failure.", "request_id": request_id}
+        if self._is_moderated(prompt):
+            return 400, {"code": "DataInspectionFailed",
+                         "message": "Input data may contain inappropriate content.", "request_id": request_id}
+        output = self.fake_output(prompt)
+        finish_reason = "stop"
+        if self.max_output_tokens and len(output) > self.max_output_tokens:
+            output = output[:self.max_output_tokens]
+            finish_reason = "length"
+        return 200, {
+            "output": {"text": output, "finish_reason": finish_reason},
+            "usage": {"input_tokens": len(prompt), "output_tokens": len(output)},
+            "request_id": request_id,
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # 支持keep-alive，与真实服务一致
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path != GENERATION_PATH:
+                    status, payload = 404, {"code": "NotFound", "message": self.path}
+                else:
+                    status, payload = server.handle(json.loads(body))
+                with server._lock:
+                    server.status_counts[status] += 1
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def summary(self) -> List[str]:
+        return [f"{status}: {count}" for status, count in sorted(self.status_counts.items())]
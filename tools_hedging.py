@@ -0,0 +1,145 @@
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, Iterable, Optional, TypeVar
+
+from tools_metrics import metrics
+
+T = TypeVar("T")
+
+# 超过近期延迟的该分位数仍未返回时，发送一份相同的对冲请求
+DEFAULT_HEDGE_PERCENTILE = 0.95
+# 对冲请求数上限：不超过普通请求数的这一比例（令牌桶，允许少量突发）
+DEFAULT_HEDGE_BUDGET = 0.05
+# 统计分位数用的近期延迟样本数；样本不足 MIN_SAMPLES 个时不对冲（避免冷启动时误判）
+LATENCY_WINDOW = 256
+MIN_SAMPLES = 20
+# 对冲等待时间的下限（秒），延迟本来就很短时不值得对冲
+MIN_HEDGE_DELAY = 0.2
+
+
+class LatencyTracker:
+    """按键（如模型名）统计近期请求延迟的滑动窗口，提供分位数查询（线程安全）"""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, key: str, q: float, min_samples: int = MIN_SAMPLES) -> Optional[float]:
+        """近期延迟的q分位数（0~1）；样本不足时返回None"""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class RequestHedger:
+    """
+    请求对冲：请求耗时超过近期延迟的 percentile 分位数仍未返回时，再发一份相同的请求，先返回者胜出
+
+    - 等待时间随近期延迟自适应（每个键单独统计），样本不足时不对冲
+    - 对冲预算为令牌桶：每个普通请求补充 budget 个令牌，每次对冲消耗1个，额外请求数不超过普通请求的 budget 比例
+    - 败者若尚未开始发送则直接取消；已发出的无法中途打断，返回后由 discard 释放（如关闭连接），结果丢弃
+    - 记录对冲次数、胜出方和因预算不足放弃对冲的次数（llm_hedge_*）
+    """
+
+    def __init__(self, percentile: float = DEFAULT_HEDGE_PERCENTILE, budget: float = DEFAULT_HEDGE_BUDGET,
+                 min_delay: float = MIN_HEDGE_DELAY, max_burst: float = 5.0, max_workers: int = 64,
+                 tracker: Optional[LatencyTracker] = None):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.max_burst = max_burst
+        self.tracker = tracker if tracker is not None else LatencyTracker()
+        self._tokens = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+
+    def observe(self, key: str, seconds: float):
+        """记录一次成功请求的耗时（含对冲中败者的耗时，保持分布无偏）"""
+        self.tracker.observe(key, seconds)
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """当前应等待多久再对冲；返回None表示样本不足、暂不对冲"""
+        delay = self.tracker.percentile(key, self.percentile)
+        return None if delay is None else max(delay, self.min_delay)
+
+    def _take_token(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+    def call(self, key: str, send: Callable[[], T], is_final: Callable[[T], bool] = lambda value: True,
+             discard: Optional[Callable[[T], None]] = None) -> T:
+        """
+        执行send()，必要时对冲一次
+
+        Args:
+            key: 延迟统计的分组键（如模型名）
+            send: 发送一次请求的函数（须可重复调用、无副作用）
+            is_final: 判断结果是否可直接采用；不可采用（如429/5xx）时若另一份请求仍在途，则继续等它
+            discard: 败者结果返回后的清理函数
+
+        Returns:
+            先返回的可采用结果；两份都不可采用时返回后完成的一份（或抛出其异常），交给调用方的重试逻辑
+        """
+        with self._lock:
+            self._tokens = min(self._tokens + self.budget, self.max_burst)
+        primary = self._executor.submit(send)
+        delay = self.hedge_delay(key)
+        if delay is not None:
+            metrics.set_gauge("llm_hedge_delay_seconds", delay, model=key)
+        if delay is None or wait([primary], timeout=delay).done:
+            return primary.result()
+        if not self._take_token():
+            metrics.inc("llm_hedge_skipped_total", model=key, reason="budget")
+            return primary.result()
+
+        metrics.inc("llm_hedges_total", model=key)
+        hedge = self._executor.submit(send)
+        names = {primary: "primary", hedge: "hedge"}
+        pending = {primary, hedge}
+        last: Optional[Future] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                last = future
+                if future.exception() is None and is_final(future.result()):
+                    metrics.inc("llm_hedge_wins_total", model=key, winner=names[future])
+                    self._abandon_others(names, future, discard)
+                    return future.result()
+        metrics.inc("llm_hedge_wins_total", model=key, winner="none")
+        self._abandon_others(names, last, discard)
+        return last.result()
+
+    @classmethod
+    def _abandon_others(cls, futures: Iterable[Future], winner: Future, discard: Optional[Callable]):
+        """释放返回值以外的每一份请求：包括同一次wait中同时完成的、以及先前已返回但不可采用的"""
+        for future in futures:
+            if future is not winner:
+                cls._abandon(future, discard)
+
+    @staticmethod
+    def _abandon(future: Future, discard: Optional[Callable]):
+        if future.cancel():
+            return
+
+        def release(done: Future):
+            if discard is not None and not done.cancelled() and done.exception() is None:
+                discard(done.result())
+
+        future.add_done_callback(release)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,61 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+STATE_VERSION = 1
+
+
+def chunk_fingerprint(chunk: str) -> str:
+    """文本块指纹（sha256），块内容不变则指纹不变"""
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
+
+
+def write_json_atomic(path: str, data):
+    """先写临时文件再原子替换，中途崩溃不会留下半截JSON"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+class ChunkState:
+    """
+    增量处理状态文件：按顺序记录上次处理过的每个文本块的指纹，以及它在标注结果中占的片段数
+
+    标注结果（novel_processed.json）是各块片段按顺序的拼接，借助片段数即可把它切回每块的片段，
+    指纹命中的块直接复用旧片段，只有新增/改动的块需要重新调用大模型。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks: List[Dict] = []  # [{"fingerprint": ..., "records": 片段数}, ...]
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("version") == STATE_VERSION:
+                self.chunks = state.get("chunks", [])
+
+    def known_records(self, processed: Optional[List[Dict]]) -> Dict[str, List[Dict]]:
+        """
+        把上次的标注结果按块切开
+        :return: {块指纹: 该块的片段列表}；状态与标注结果对不上时返回空字典（全部重新处理）
+        """
+        if processed is None or sum(item["records"] for item in self.chunks) != len(processed):
+            return {}
+        known = {}
+        offset = 0
+        for item in self.chunks:
+            known[item["fingerprint"]] = processed[offset:offset + item["records"]]
+            offset += item["records"]
+        return known
+
+    def replace(self, fingerprints: List[str], record_counts: List[int]):
+        """用本次的块列表替换状态"""
+        self.chunks = [
+            {"fingerprint": fingerprint, "records": count}
+            for fingerprint, count in zip(fingerprints, record_counts)
+        ]
+
+    def save(self):
+        write_json_atomic(self.path, {"version": STATE_VERSION, "chunks": self.chunks})
@@ -0,0 +1,169 @@
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional
+
+from tools_metrics import metrics
+
+# 输出被截断时最多补请求的次数
+MAX_CONTINUATIONS = 2
+
+_FENCE_RE = re.compile(r"```(?:json|JSON)?")
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+_decoder = json.JSONDecoder()
+
+
+@dataclass
+class ParsedArray:
+    """容错解析结果"""
+    items: List[Any] = field(default_factory=list)  # 完整且通过校验的元素（按原顺序）
+    found: bool = False      # 是否找到JSON数组/对象的起点
+    complete: bool = False   # 数组是否正常闭合（False表示输出被截断，缺少尾部元素）
+    repairs: List[str] = field(default_factory=list)  # 做过的修复
+    dropped: int = 0         # 无法修复而丢弃的元素数
+
+    def summary(self) -> str:
+        parts = [f"保留 {len(self.items)} 个元素"]
+        if self.dropped:
+            parts.append(f"丢弃 {self.dropped} 个损坏元素")
+        if self.repairs:
+            parts.append("修复：" + "、".join(dict.fromkeys(self.repairs)))
+        if not self.complete:
+            parts.append("输出被截断")
+        return "，".join(parts)
+
+
+def _value_end(text: str, pos: int) -> Optional[int]:
+    """从text[pos]（'{' 或 '['）开始做括号匹配（跳过字符串内容），返回结束位置之后的下标；被截断返回None"""
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(pos, len(text)):
+        char = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return None
+
+
+def _repair_element(raw: str, repairs: List[str]) -> Any:
+    """修复单个元素的常见问题后再解析，仍失败则抛出ValueError"""
+    fixed = _TRAILING_COMMA_RE.sub(r"\1", raw)
+    if fixed != raw:
+        repairs.append("多余逗号")
+    try:
+        return json.loads(fixed)
+    except ValueError:
+        pass
+    # 字符串中的裸换行（模型常见输出问题）
+    unescaped = fixed.replace("\r", "").replace("\n", "\\n")
+    value = json.loads(unescaped)
+    repairs.append("字符串内换行")
+    return value
+
+
+def parse_json_array(text: str, validate: Optional[Callable[[Any], bool]] = None) -> ParsedArray:
+    """
+    容错解析大模型输出的JSON数组：逐个元素解码，保留全部完整元素
+
+    - 去掉markdown代码块标记和数组前后的说明文字
+    - 元素间缺逗号、夹杂说明文字时跳过无关内容继续解析
+    - 单个元素有多余逗号/裸换行时修复，无法修复的元素丢弃，不影响其余元素
+    - 输出被截断时返回已完整的元素，complete=False（调用方只需补请求剩余部分）
+    - 输出是单个对象或若干并列对象（没有外层方括号）时同样按元素处理
+
+    Args:
+        text: 大模型原始输出
+        validate: 可选，元素校验函数，返回False的元素计入dropped
+    """
+    result = ParsedArray()
+    text = _FENCE_RE.sub("", text)
+    start = min((pos for pos in (text.find("["), text.find("{")) if pos >= 0), default=-1)
+    if start < 0:
+        return result
+    result.found = True
+    if text[start] == "[":
+        pos = start + 1
+        bracketed = True
+    else:
+        pos = start
+        bracketed = False
+        result.repairs.append("缺少外层方括号")
+
+    length = len(text)
+    while True:
+        while pos < length and text[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= length:
+            result.complete = not bracketed
+            break
+        char = text[pos]
+        if char == "]":
+            result.complete = True
+            break
+        if char not in "{[\"-0123456789tfn":
+            # 元素之间的说明文字：跳到下一个元素或数组结尾
+            next_pos = min((p for p in (text.find("{", pos), text.find("]", pos)) if p >= 0), default=-1)
+            if next_pos < 0:
+                result.complete = not bracketed
+                break
+            result.repairs.append("夹杂说明文字")
+            pos = next_pos
+            continue
+        try:
+            value, end = _decoder.raw_decode(text, pos)
+        except ValueError:
+            end = _value_end(text, pos) if char in "{[" else None
+            if end is None:
+                break  # 最后一个元素被截断
+            try:
+                value = _repair_element(text[pos:end], result.repairs)
+            except ValueError:
+                result.dropped += 1
+                pos = end
+                continue
+        pos = end
+        if validate is not None and not validate(value):
+            result.dropped += 1
+            continue
+        result.items.append(value)
+
+    for repair in dict.fromkeys(result.repairs):
+        metrics.inc("llm_json_repairs_total", kind=repair)
+    if result.dropped:
+        metrics.inc("llm_json_dropped_items_total", result.dropped)
+    if not result.complete:
+        metrics.inc("llm_json_truncated_total")
+    return result
+
+
+def remaining_tail(source: str, texts: List[str]) -> Optional[str]:
+    """
+    按顺序在原文中定位已解析片段的文本，返回最后一个片段之后尚未处理的原文
+    （模型可能清洗过文本，整段找不到时退而用片段末尾的若干字定位）
+    :return: 剩余原文；最后一个片段定位不到时返回None
+    """
+    cursor = 0
+    located = False
+    for text in texts:
+        text = text.strip()
+        located = False
+        for probe in (text, text[-20:], text[-8:]):
+            pos = source.find(probe, cursor) if probe else -1
+            if pos >= 0:
+                cursor = pos + len(probe)
+                located = True
+                break
+    return source[cursor:].strip() if located else None
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# 默认缓存位置与容量（可通过环境变量覆盖）
+DEFAULT_CACHE_PATH = os.environ.get("QWEN_CACHE_PATH", "./.llm_cache/qianwen_responses.sqlite3")
+DEFAULT_MAX_BYTES = int(os.environ.get("QWEN_CACHE_MAX_BYTES", 512 * 1024 * 1024))  # 512MB
+DEFAULT_MAX_AGE_SECONDS = int(os.environ.get("QWEN_CACHE_MAX_AGE", 30 * 24 * 3600))  # 30天
+# 设置 QWEN_CACHE_DISABLE=1 可全局跳过缓存
+CACHE_DISABLED = os.environ.get("QWEN_CACHE_DISABLE", "") not in ("", "0", "false", "False")
+
+
+def make_cache_key(model: str, prompt: str, params: Optional[Dict[str, Any]] = None) -> str:
+    """按 模型+提示词+请求参数 计算内容寻址的缓存键（sha256）"""
+    material = json.dumps(
+        {"model": model, "prompt": prompt, "params": params or {}},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    基于SQLite的大模型响应缓存
+
+    - 以 make_cache_key 的结果为主键，值为模型输出文本
+    - 按创建时间淘汰过期条目，按最近访问时间(LRU)淘汰超出容量的条目
+    - 记录命中/未命中次数，线程安全（单连接+锁），WAL模式允许多进程共享
+    """
+
+    # 每写入多少条检查一次容量
+    EVICT_EVERY = 50
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_age_seconds: int = DEFAULT_MAX_AGE_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        self._lock = threading.Lock()
+
+        cache_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存，未命中或已过期返回None"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.max_age_seconds and now - row[1] > self.max_age_seconds):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str):
+        """写入缓存（同键覆盖）"""
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._conn.commit()
+            self._puts_since_evict += 1
+            need_evict = self._puts_since_evict >= self.EVICT_EVERY
+        if need_evict:
+            self.evict()
+
+    def evict(self):
+        """淘汰过期条目，并按LRU把总大小压回 max_bytes 以内"""
+        with self._lock:
+            self._puts_since_evict = 0
+            if self.max_age_seconds:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE created_at < ?",
+                    (time.time() - self.max_age_seconds,),
+                )
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if self.max_bytes and total > self.max_bytes:
+                excess = total - self.max_bytes
+                freed = 0
+                stale_keys = []
+                for key, size in self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY last_access ASC"
+                ):
+                    stale_keys.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+            self._conn.commit()
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回命中统计与缓存占用"""
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": total}
+
+
+_default_cache: Optional[LLMResponseCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> Optional[LLMResponseCache]:
+    """获取进程内共享的默认缓存实例（全局禁用时返回None）"""
+    global _default_cache
+    if CACHE_DISABLED:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = LLMResponseCache()
+        return _default_cache
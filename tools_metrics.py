@@ -0,0 +1,266 @@
+import bisect
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# 指标导出目录（设为空字符串则不写文件）
+METRICS_DIR = os.environ.get("METRICS_DIR", "./metrics")
+# 分阶段性能剖析：""（关闭）/ "cprofile" / "torch"（cprofile 覆盖阶段内新建的线程，不含子进程）
+PROFILE_MODE = os.environ.get("METRICS_PROFILE", "")
+# Prometheus指标名前缀
+METRIC_PREFIX = "novel_"
+# 延迟直方图的默认分桶（秒）
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict) -> _LabelKey:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: _LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # 每个桶本身的计数（导出时再累加）
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        pos = bisect.bisect_left(self.buckets, value)
+        if pos < len(self.buckets):
+            self.counts[pos] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[int]:
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class MetricsRegistry:
+    """
+    进程内指标登记表：计数器、仪表、直方图（线程安全）
+
+    - 计数器名以 _total 结尾，直方图用于延迟（秒）
+    - to_dict() 导出JSON运行报告，to_prometheus() 导出Prometheus文本格式
+    - stage() 统计阶段耗时，并可按 PROFILE_MODE 对该阶段做cProfile/torch剖析
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[_LabelKey, float]] = {}
+        self._gauges: Dict[str, Dict[_LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[_LabelKey, _Histogram]] = {}
+        self.started_at = time.time()
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges.setdefault(name, {})[_label_key(labels)] = float(value)
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """把代码块耗时记入直方图name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def stage(self, name: str, profile: Optional[str] = None) -> Iterator[None]:
+        """
+        统计一个处理阶段的耗时（stage_seconds直方图）
+        :param profile: 剖析方式，默认取 PROFILE_MODE；结果写入 METRICS_DIR/<阶段名>.prof 或 .trace.json
+
+        cprofile 模式会把阶段内新建线程（线程池工作线程）的剖析结果合并进同一个 .prof；
+        阶段开始前已存在的线程和子进程（tools_tts_pool 的多进程合成）不在其中，
+        多进程合成时 .prof 里主要是等待结果的耗时。
+        """
+        profile = PROFILE_MODE if profile is None else profile
+        profiler = _start_profiler(profile)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=name)
+            if profiler is not None:
+                _stop_profiler(profile, profiler, name)
+
+    def counter_value(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_label_key(labels), 0.0)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self.started_at = time.time()
+
+    # ---------- 导出 ----------
+    def to_dict(self) -> Dict:
+        """JSON运行报告"""
+        with self._lock:
+            def series(table):
+                return [
+                    {"name": name, "labels": dict(key), "value": value}
+                    for name, values in sorted(table.items()) for key, value in values.items()
+                ]
+
+            histograms = []
+            for name, values in sorted(self._histograms.items()):
+                for key, histogram in values.items():
+                    histograms.append({
+                        "name": name,
+                        "labels": dict(key),
+                        "count": histogram.count,
+                        "sum": round(histogram.sum, 6),
+                        "mean": round(histogram.sum / histogram.count, 6) if histogram.count else 0.0,
+                        "buckets": {str(bound): count
+                                    for bound, count in zip(histogram.buckets, histogram.cumulative())},
+                    })
+            return {
+                "started_at": self.started_at,
+                "finished_at": time.time(),
+                "counters": series(self._counters),
+                "gauges": series(self._gauges),
+                "histograms": histograms,
+            }
+
+    def to_prometheus(self) -> str:
+        """Prometheus文本格式（exposition format 0.0.4）"""
+        lines = []
+        with self._lock:
+            for kind, table in (("counter", self._counters), ("gauge", self._gauges)):
+                for name, values in sorted(table.items()):
+                    metric = METRIC_PREFIX + name
+                    lines.append(f"# TYPE {metric} {kind}")
+                    for key, value in values.items():
+                        lines.append(f"{metric}{_format_labels(key)} {value:g}")
+            for name, values in sorted(self._histograms.items()):
+                metric = METRIC_PREFIX + name
+                lines.append(f"# TYPE {metric} histogram")
+                for key, histogram in values.items():
+                    for bound, count in zip(histogram.buckets, histogram.cumulative()):
+                        lines.append(f"{metric}_bucket{_format_labels(key, ('le', f'{bound:g}'))} {count}")
+                    lines.append(f"{metric}_bucket{_format_labels(key, ('le', '+Inf'))} {histogram.count}")
+                    lines.append(f"{metric}_sum{_format_labels(key)} {histogram.sum:g}")
+                    lines.append(f"{metric}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, run_name: str, directory: str = METRICS_DIR) -> Optional[str]:
+        """
+        写出 <directory>/<run_name>.json 与 <run_name>.prom
+        :return: JSON报告路径；directory为空时不写文件，返回None
+        """
+        if not directory:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        json_path = os.path.join(directory, f"{run_name}.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(dict(self.to_dict(), run=run_name), f, ensure_ascii=False, indent=4)
+        with open(os.path.join(directory, f"{run_name}.prom"), "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        return json_path
+
+
+class _ThreadedProfile:
+    """
+    cProfile 只剖析调用它的线程：这里给阶段内新启动的每个线程各挂一个 Profile，结束时合并
+    （Python 3.12+ 的 cProfile 基于 sys.monitoring，本身已覆盖所有线程，无需再挂）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._main = cProfile.Profile()
+        self._workers: List[cProfile.Profile] = []
+
+    def _hook(self, frame, event, arg):
+        # 新线程里的第一次调用事件：换成该线程自己的 Profile
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._workers.append(profiler)
+        profiler.enable()
+
+    def enable(self):
+        if sys.version_info < (3, 12):
+            threading.setprofile(self._hook)
+        self._main.enable()
+
+    def dump_stats(self, path: str):
+        threading.setprofile(None)
+        self._main.disable()
+        stats = pstats.Stats(self._main)
+        with self._lock:
+            workers = list(self._workers)
+        for profiler in workers:
+            stats.add(profiler)
+        stats.dump_stats(path)
+
+
+def _start_profiler(mode: str):
+    if mode == "cprofile":
+        profiler = _ThreadedProfile()
+        profiler.enable()
+        return profiler
+    if mode == "torch":
+        try:
+            import torch
+        except ImportError:
+            print("⚠️  未安装torch，跳过torch剖析")
+            return None
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+        profiler.__enter__()
+        return profiler
+    return None
+
+
+def _stop_profiler(mode: str, profiler, stage_name: str):
+    directory = METRICS_DIR or "."
+    os.makedirs(directory, exist_ok=True)
+    if mode == "cprofile":
+        profiler.dump_stats(os.path.join(directory, f"{stage_name}.prof"))
+    else:
+        profiler.__exit__(None, None, None)
+        profiler.export_chrome_trace(os.path.join(directory, f"{stage_name}.trace.json"))
+
+
+# 进程内共享的指标登记表
+metrics = MetricsRegistry()
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional
+
+from tools_chunker import split_sentences
+from tools_metrics import metrics
+
+# 被内容审核拒绝的句子指纹（每行一个sha256，只追加）
+DEFAULT_VERDICTS_PATH = os.environ.get("QWEN_MODERATION_VERDICTS", "./.llm_cache/moderation_rejected.txt")
+# 跳过片段的日志
+SKIPPED_LOG_PATH = "skipped_chunks.log"
+# 二分到不超过该字数的片段即整体丢弃（0表示一直拆到单句，丢失最少、请求稍多）
+MIN_FRAGMENT_CHARS = 0
+
+_log_lock = threading.Lock()
+
+
+def is_moderation_error(error_msg: str) -> bool:
+    """判断错误信息是否为千问的内容安全审核拒绝"""
+    return ("inappropriate content" in error_msg
+            or "error-code#inappropriate-content" in error_msg)
+
+
+def log_skipped_fragment(label: str, fragment: str, error_msg: str):
+    """把被跳过的文本记录到 skipped_chunks.log（多线程安全）"""
+    with _log_lock, open(SKIPPED_LOG_PATH, "a", encoding="utf-8") as log_file:
+        log_file.write(f"=== 跳过的段落 {label} ===\n")
+        log_file.write(f"字符数: {len(fragment)}\n")
+        log_file.write(f"前200字符: {fragment[:200]}...\n")
+        log_file.write(f"错误信息: {error_msg}\n")
+        log_file.write("=" * 50 + "\n")
+
+
+def skipped_fragment_logger(label: str, stage: str) -> Callable[[str, Exception], None]:
+    """生成 run_with_bisection 的 on_rejected 回调：打印提示、写日志、计数"""
+    def on_rejected(fragment: str, error: Exception):
+        print(f"    ⚠️  第{label}段中有 {len(fragment)} 字触发内容安全审核，已跳过：{fragment[:30]}...")
+        log_skipped_fragment(label, fragment, str(error))
+        metrics.inc("moderation_skips_total", stage=stage)
+
+    return on_rejected
+
+
+class ModerationVerdicts:
+    """被拒绝句子的本地记录：同一句子下次直接剔除，不再发送"""
+
+    def __init__(self, path: str = DEFAULT_VERDICTS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._rejected = set()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._rejected = {line.strip() for line in f if line.strip()}
+
+    @staticmethod
+    def _key(sentence: str) -> str:
+        return hashlib.sha256(sentence.strip().encode("utf-8")).hexdigest()
+
+    def is_rejected(self, sentence: str) -> bool:
+        return self._key(sentence) in self._rejected
+
+    def has_rejected(self, text: str) -> bool:
+        """文本中是否有已知被拒绝的句子"""
+        return any(self.is_rejected(text[start:end]) for start, end, _ in split_sentences(text)
+                   if text[start:end].strip())
+
+    def reject(self, sentences: List[str]):
+        keys = [self._key(sentence) for sentence in sentences if sentence.strip()]
+        with self._lock:
+            new_keys = [key for key in keys if key not in self._rejected]
+            if not new_keys:
+                return
+            self._rejected.update(new_keys)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(f"{key}\n" for key in new_keys))
+
+
+_default_verdicts: Optional[ModerationVerdicts] = None
+_default_verdicts_lock = threading.Lock()
+
+
+def get_default_verdicts() -> ModerationVerdicts:
+    global _default_verdicts
+    with _default_verdicts_lock:
+        if _default_verdicts is None:
+            _default_verdicts = ModerationVerdicts()
+        return _default_verdicts
+
+
+@dataclass
+class BisectionResult:
+    values: List[Any] = field(default_factory=list)  # 各通过片段的处理结果（按原文顺序）
+    dropped: List[str] = field(default_factory=list)  # 被丢弃的片段
+    requests: int = 0  # 实际调用func的次数
+
+
+def run_with_bisection(text: str, func: Callable[[str], Any],
+                       verdicts: Optional[ModerationVerdicts] = None,
+                       min_chars: int = MIN_FRAGMENT_CHARS,
+                       on_rejected: Optional[Callable[[str, Exception], None]] = None) -> BisectionResult:
+    """
+    调用 func(文本)；遇到内容审核拒绝时按句子边界二分，分别重试两半，直到定位出被拒绝的句子
+
+    - 已知被拒绝的句子先剔除，不再发送
+    - 不触发审核时只调用一次func，与直接调用相同；每个问题句子额外约 2*log2(句数) 次请求
+    - 非审核错误直接抛出
+
+    Args:
+        text: 原文（一个文本块）
+        func: 处理函数，参数为文本片段
+        verdicts: 拒绝记录，默认使用进程内共享的实例
+        min_chars: 不超过该字数的被拒片段不再拆分，整体丢弃（其中的句子均记为拒绝）
+        on_rejected: 片段被丢弃时的回调 (片段, 异常)
+
+    Returns:
+        BisectionResult
+    """
+    verdicts = verdicts or get_default_verdicts()
+    result = BisectionResult()
+    sentences = []
+    for start, end, _ in split_sentences(text):
+        sentence = text[start:end]
+        if sentence.strip() and verdicts.is_rejected(sentence):
+            result.dropped.append(sentence.strip())
+        else:
+            sentences.append(sentence)
+
+    def solve(part: List[str]):
+        fragment = "".join(part).strip()
+        if not fragment:
+            return
+        result.requests += 1
+        try:
+            result.values.append(func(fragment))
+            return
+        except Exception as e:
+            if not is_moderation_error(str(e)):
+                raise
+            error = e
+        if len(part) == 1 or len(fragment) <= min_chars:
+            verdicts.reject(part)
+            result.dropped.append(fragment)
+            metrics.inc("moderation_dropped_chars_total", len(fragment))
+            if on_rejected is not None:
+                on_rejected(fragment, error)
+            return
+        # 按字数对半切，保证两半都非空
+        half = len(fragment) / 2
+        total = 0
+        mid = 1
+        for i, sentence in enumerate(part[:-1], 1):
+            total += len(sentence)
+            mid = i
+            if total >= half:
+                break
+        solve(part[:mid])
+        solve(part[mid:])
+
+    solve(sentences)
+    if result.requests > 1:
+        metrics.inc("moderation_bisect_requests_total", result.requests - 1)
+    return result
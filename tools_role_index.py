@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+from collections import deque
+from typing import Dict, Hashable, Iterator, List, Set, Tuple
+
+# 常见复姓：三字以上姓名去掉复姓后才是名字
+_COMPOUND_SURNAMES = {"欧阳", "司马", "上官", "诸葛", "东方", "皇甫", "尉迟", "公孙", "慕容", "令狐", "夏侯", "长孙"}
+# 泛称/亲属称谓类"角色名"不生成别名（如"中年女人"去掉首字后是"年女人"）
+_GENERIC_HINTS = set("男女人员长主者队警生孩子奶爷婆公叔姨哥姐妹弟娘爸妈夫头")
+# "姓+称谓"类角色名（如"李主任""陈老师"）去掉姓后只剩称谓，不能作为别名
+_TITLE_SUFFIXES = {"主任", "老师", "公安", "小伙", "师傅", "经理", "老板", "医生", "大夫", "同学", "警官",
+                   "大爷", "大妈", "阿姨", "大哥", "大姐", "老大", "老二", "老三", "老四", "老五"}
+
+
+def role_aliases(role: Dict) -> List[str]:
+    """
+    角色的全部称呼：名称本身 + 档案中的aliases字段 + 由姓名推出的名字（如"侯大利"->"大利"）
+    只保留不少于2个字的称呼，避免单字误匹配
+    """
+    name = role["name"]
+    aliases = [name] + list(role.get("aliases") or [])
+    if 3 <= len(name) <= 4 and name[-1] not in _GENERIC_HINTS and "的" not in name:
+        surname_len = 2 if name[:2] in _COMPOUND_SURNAMES else 1
+        given = name[surname_len:]
+        if len(given) == 2 and given not in _TITLE_SUFFIXES:
+            aliases.append(given)
+    return [alias for alias in dict.fromkeys(aliases) if len(alias) >= 2]
+
+
+class AhoCorasick:
+    """Aho-Corasick多模式匹配自动机：一次线性扫描找出文本中出现的全部模式"""
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Set[Hashable]] = [set()]
+
+    def add(self, pattern: str, value: Hashable):
+        """登记模式串，命中时产出value"""
+        state = 0
+        for char in pattern:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(set())
+            state = nxt
+        self._output[state].add(value)
+
+    def build(self):
+        """按BFS计算失败指针（登记完全部模式后调用一次；根的子节点失败指针恒为根）"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._output[nxt] |= self._output[self._fail[nxt]]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, Hashable]]:
+        """产出 (匹配结束位置, value)"""
+        state = 0
+        for pos, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for value in self._output[state]:
+                yield pos + 1, value
+
+
+class RoleIndex:
+    """角色索引：从文本中找出出现过的角色，并给出紧凑的角色描述行"""
+
+    def __init__(self, roles: List[Dict]):
+        self.roles: Dict[str, Dict] = {role["name"]: role for role in roles if role.get("name")}
+        self._automaton = AhoCorasick()
+        for role in self.roles.values():
+            for alias in role_aliases(role):
+                self._automaton.add(alias, (role["name"], len(alias)))
+        self._automaton.build()
+
+    def find_roles(self, text: str) -> List[str]:
+        """文本中出现的角色名（按首次出现顺序）"""
+        found: Dict[str, None] = {}
+        for _, (name, _) in self._automaton.iter_matches(text):
+            found.setdefault(name)
+        return list(found)
+
+    def iter_mentions(self, text: str) -> Iterator[Tuple[int, int, str]]:
+        """产出文本中每一处角色称呼的 (起始位置, 结束位置, 角色名)"""
+        for end, (name, length) in self._automaton.iter_matches(text):
+            yield end - length, end, name
+
+    def role_line(self, name: str) -> str:
+        """单个角色的紧凑描述：名称|性别|年龄|性格|语音风格"""
+        role = self.roles[name]
+        fields = [name] + [str(role.get(key, "未知")) for key in ("gender", "age", "personality", "voice_style")]
+        return "|".join(fields)
+
+    def prompt_block(self, text: str, context: str = "") -> str:
+        """生成注入提示词的角色清单（只含本段及上下文中出现的角色）"""
+        names = self.find_roles(context + text) if context else self.find_roles(text)
+        if not names:
+            return "本段未出现已知角色（对白说话人可按原文称呼标注）。"
+        lines = "\n".join(self.role_line(name) for name in names)
+        return f"本段出现的角色（名称|性别|年龄|性格|语音风格）：\n{lines}"
+
+
+_index_cache: Dict[Tuple[str, float], RoleIndex] = {}
+_index_lock = threading.Lock()
+
+
+def load_role_index(roles_path: str) -> RoleIndex:
+    """读取 novel_roles.json 构建角色索引（按文件路径+修改时间缓存，只构建一次）"""
+    key = (os.path.abspath(roles_path), os.path.getmtime(roles_path))
+    with _index_lock:
+        index = _index_cache.get(key)
+        if index is None:
+            with open(roles_path, "r", encoding="utf-8") as f:
+                role_data = json.load(f)
+            index = _index_cache[key] = RoleIndex(role_data.get("roles", []))
+        return index
@@ -0,0 +1,211 @@
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Set
+
+from tools_chunker import estimate_tokens, iter_chunks, split_sentences
+from tools_role_index import AhoCorasick, role_aliases
+
+# 说话/动作动词：其前面紧挨着的2~4个字大概率是人名或人物称呼
+SPEECH_VERBS = ("说", "道", "问", "答", "喊", "叫", "吼", "骂", "嚷", "喝", "叹", "笑", "哭", "追问", "补充",
+                "解释", "回答", "强调", "插话", "低声", "大声", "点头", "摇头", "心想", "看着", "望着", "盯着")
+# 常见姓氏：以其开头、右邻字分散的2~3字n-gram视为人名
+COMMON_SURNAMES = set("王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘于蒋蔡余杜叶程"
+                      "苏魏吕丁任沈姚卢姜崔钟谭陆汪范金石廖贾夏韦付方白邹孟熊秦邱江尹薛闫段雷侯龙史陶黎贺顾毛郝"
+                      "龚邵万钱严覃武戴莫孔向汤洪费宫卓乔伍关宁封易葛")
+# 候选名在全书中至少出现的次数（只出现一次的多为误切或路人）
+MIN_MENTIONS = 2
+# 每个新候选名最多摘取的句子数（含其后一句上下文）
+MAX_SENTENCES_PER_CANDIDATE = 8
+
+_VERB_ALT = "|".join(sorted(SPEECH_VERBS, key=len, reverse=True))
+# "朱林问道" "侯大利笑着说"
+_BEFORE_VERB_RE = re.compile(rf"([\u4e00-\u9fff]{{2,4}}?)(?:{_VERB_ALT})")
+# 引语前说明语的开头，如"侯大利咬牙切齿，道：“"
+_ATTRIBUTION_RE = re.compile(r"(?:^|[。！？!?”\n])\s*([\u4e00-\u9fff]{2,4})[^。！？!?”“\n]{0,20}[：:，,]\s*“")
+# 含这些字的多半是代词/虚词/动作，不是人名
+_NON_NAME_CHARS = set("的了着过是在和与及就也都又把被给向对这那么什没不很便却才已将会能要想看听走来去他她它我你们谁"
+                      "说道问答喊叫吼骂笑哭叹点摇望盯轻冷急忙连立马突然于随接继续刚正还再有地后前时候")
+_STOPWORDS = {"大家", "众人", "有人", "对方", "自己", "别人", "旁人", "其他", "所有", "一起", "一声", "一边", "一下", "一个"}
+# 以常见姓氏字开头的常用词（右邻字同样分散，find_surname_names 单靠词边界判断会误收）
+_SURNAME_WORDS = {"关系", "关键", "关上", "曾经", "高度", "高中", "高一", "高二", "高三", "高速", "高手", "高清", "高发",
+                  "何况", "周围", "周边", "周岁", "周末", "方式", "方形", "方向", "方法", "方面", "程序", "程度", "许多",
+                  "严格", "严重", "陈述", "张开", "胡子", "毛发", "石头", "白眼", "白色", "金属", "马上", "黄色", "江湖"}
+# 后面接这些字的多为地名（"江州市"），不是人名
+PLACE_SUFFIXES = set("市县省")
+_CJK_RE = re.compile(r"[\u4e00-\u9fff]+")
+
+
+def _may_be_name(gram: str) -> bool:
+    return bool(_CJK_RE.fullmatch(gram)) and gram not in _STOPWORDS and not _NON_NAME_CHARS.intersection(gram)
+
+
+def find_surname_names(text: str, min_mentions: int = MIN_MENTIONS) -> Dict[str, int]:
+    """
+    全书统计以常见姓氏开头的2~3字n-gram，按右邻字的分布判断词边界：
+    名字后面跟的字很分散（"许海，""许海的""许海家"），名字的一部分后面几乎总是同一个字（"侯大"->"利"）；
+    排除以姓氏字开头的常用词，以及多次后接"市/县/省"的地名
+    :return: {人名: 出现次数}
+    """
+    neighbors: Dict[str, Counter] = defaultdict(Counter)
+    for pos, char in enumerate(text):
+        if char not in COMMON_SURNAMES:
+            continue
+        for n in (2, 3):
+            gram = text[pos:pos + n]
+            if len(gram) == n and _may_be_name(gram):
+                neighbors[gram][text[pos + n:pos + n + 1]] += 1
+
+    def is_word_end(counter: Counter) -> bool:
+        return counter.most_common(1)[0][1] * 3 <= sum(counter.values()) * 2
+
+    names = {}
+    for gram, counter in neighbors.items():
+        total = sum(counter.values())
+        if total < min_mentions or not is_word_end(counter) or gram in _SURNAME_WORDS:
+            continue
+        if sum(counter[suffix] for suffix in PLACE_SUFFIXES) >= 2:
+            continue  # 地名
+        prefix = neighbors.get(gram[:2]) if len(gram) == 3 else None
+        if prefix is not None and is_word_end(prefix):
+            continue  # 两字前缀本身就是完整的名字，三字是"名字+后一个字"
+        names[gram] = total
+    return names
+
+
+def count_name_contexts(text: str) -> Counter:
+    """统计出现在人名位置（说话/动作动词前、引语说明语开头）的2~3字n-gram次数（未过滤、未归并）"""
+    counts: Counter = Counter()
+    for match in _BEFORE_VERB_RE.finditer(text):
+        run = match.group(1)
+        for n in (2, 3):
+            if len(run) >= n:
+                counts[run[-n:]] += 1
+    for match in _ATTRIBUTION_RE.finditer(text):
+        lead = match.group(1)
+        for n in (2, 3):
+            if len(lead) >= n:
+                counts[lead[:n]] += 1
+    return counts
+
+
+def extract_name_candidates(text: str) -> Counter:
+    """
+    本地提取候选人名（不调用大模型）：统计说话/动作动词前、引语说明语开头的2~3字n-gram，
+    去掉含虚词/代词的n-gram，再做子串归并（"侯大利"出现得足够多时不再单独保留"大利"/"侯大"）
+    :return: {候选名: 出现次数}
+    """
+    candidates = Counter({gram: count for gram, count in count_name_contexts(text).items() if _may_be_name(gram)})
+    # 子串归并：三字候选出现次数不少于其两字子串的一半时，两字子串视为它的一部分
+    for gram in [gram for gram in candidates if len(gram) == 3]:
+        for part in (gram[:2], gram[1:]):
+            if part in candidates and candidates[gram] * 2 >= candidates[part]:
+                del candidates[part]
+    for gram in [gram for gram in candidates if len(gram) == 3]:
+        if any(part in candidates for part in (gram[:2], gram[1:])):
+            del candidates[gram]  # 三字候选远少于两字子串：多半是"了朱林"这类带了前后缀的误切
+    return candidates
+
+
+class RolePrefilter:
+    """
+    角色提取的本地预筛：已知角色（档案中的角色及其称呼）和已经发送过的候选名都视为已覆盖，
+    文本块中没有未覆盖的候选名时不必再调用大模型
+
+    - 块内候选：说话/动作动词前、引语说明语开头的n-gram（extract_name_candidates），
+      全书在同样的人名位置出现不少于 MIN_MENTIONS 次（只按字面出现次数时，"一个""关系"这类常用词都能通过）
+    - 全书候选：以常见姓氏开头的人名（find_surname_names），用Aho-Corasick一次扫描找出块内出现的
+    """
+
+    def __init__(self, known_roles: Iterable[Dict] = (), book_text: str = ""):
+        self.book_text = book_text
+        self._covered: Set[str] = set()
+        self._mentions = count_name_contexts(book_text)
+        for role in known_roles:
+            self.mark_covered(role_aliases(role))
+        self._surnames = AhoCorasick()
+        for name in find_surname_names(book_text):
+            self._surnames.add(name, name)
+        self._surnames.build()
+
+    def mark_covered(self, names: Iterable[str]):
+        for name in names:
+            self._covered.add(name)
+
+    def is_covered(self, name: str) -> bool:
+        """候选名本身、或它包含的任一已覆盖称呼（如"侯大利"包含"大利"），或被某个已覆盖称呼包含"""
+        if name in self._covered:
+            return True
+        parts = {name[start:end] for start in range(len(name)) for end in range(start + 2, len(name) + 1)}
+        if parts & self._covered:
+            return True
+        return any(name in covered for covered in self._covered if len(covered) > len(name))
+
+    def _book_mentions(self, name: str) -> int:
+        """候选名在全书人名位置出现的次数（未提供全书文本时不做该项筛选）"""
+        if not self.book_text:
+            return MIN_MENTIONS
+        return self._mentions[name]
+
+    def candidates(self, text: str) -> List[str]:
+        """文本中的全部候选名（块内候选在前，按出现次数从多到少）"""
+        names = [name for name, _ in extract_name_candidates(text).most_common()
+                 if self._book_mentions(name) >= MIN_MENTIONS]
+        names.extend(name for _, name in self._surnames.iter_matches(text))
+        return list(dict.fromkeys(names))
+
+    def new_candidates(self, text: str) -> List[str]:
+        """文本中尚未覆盖的候选名"""
+        return [name for name in self.candidates(text) if not self.is_covered(name)]
+
+
+@dataclass
+class RoleRequest:
+    """一次角色提取请求：由一个或多个文本块中涉及新候选名的句子拼成"""
+    text: str
+    chunk_indices: List[int] = field(default_factory=list)  # 来源文本块下标（从0开始）
+    candidates: List[str] = field(default_factory=list)
+
+    @property
+    def label(self) -> str:
+        first, last = self.chunk_indices[0] + 1, self.chunk_indices[-1] + 1
+        return str(first) if first == last else f"{first}-{last}"
+
+
+def _excerpt(text: str, names: List[str]) -> str:
+    """摘取提到这些候选名的句子（每个名字最多 MAX_SENTENCES_PER_CANDIDATE 句，附带其后一句）"""
+    sentences = [text[start:end] for start, end, _ in split_sentences(text)]
+    picked: Set[int] = set()
+    for name in names:
+        hits = [i for i, sentence in enumerate(sentences) if name in sentence][:MAX_SENTENCES_PER_CANDIDATE // 2]
+        for i in hits:
+            picked.update((i, i + 1))
+    return "".join(sentences[i] for i in sorted(picked) if i < len(sentences)).strip()
+
+
+def plan_role_requests(chunks: List[str], prefilter: RolePrefilter, max_tokens: int) -> List[RoleRequest]:
+    """
+    按顺序预筛文本块：没有新候选名的块跳过；有新候选名的块只摘取相关句子，
+    相邻的摘录装箱到不超过max_tokens的请求里，用更少、更密集的请求覆盖全部新角色
+    """
+    requests: List[RoleRequest] = []
+    current = RoleRequest("")
+    current_tokens = 0
+    for idx, chunk in enumerate(chunks):
+        names = prefilter.new_candidates(chunk)
+        if not names:
+            continue
+        prefilter.mark_covered(names)
+        for piece in iter_chunks(_excerpt(chunk, names), max_tokens=max_tokens):
+            tokens = estimate_tokens(piece)
+            if current.text and current_tokens + tokens > max_tokens:
+                requests.append(current)
+                current, current_tokens = RoleRequest(""), 0
+            current.text = f"{current.text}\n{piece}" if current.text else piece
+            current_tokens += tokens
+            if idx not in current.chunk_indices:
+                current.chunk_indices.append(idx)
+            current.candidates.extend(name for name in names if name in piece and name not in current.candidates)
+    if current.text:
+        requests.append(current)
+    return requests
@@ -0,0 +1,193 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from tools_role_index import RoleIndex
+
+NARRATOR = "旁白"
+MAX_SEGMENT_CHARS = 200  # 与大模型标注的分段要求一致
+PENDING_CONTEXT_LINES = 2  # 交给大模型时待定对白前后保留的行数，更远的部分省略（None表示保留全文）
+
+# 对白引号（允许跨段落；缺右引号时一直延伸到文本末尾）
+_QUOTE_RE = re.compile(r"“([^”]*)(?:”|$)")
+# 句子切分（句末标点可带后引号/括号）
+_SENTENCE_RE = re.compile(r"[^。！？!?…\n]*(?:[。！？!?…]+[’」』）)]*|\n|$)")
+# 引语前的说明语，如"侯大利咬牙切齿，道：" "朱林问道，"
+_SPEECH_VERBS = "道|说|问|答|喊|叫|吼|骂|嚷|喝|叹|笑|哭|追问|补充|解释|回答|强调|插话|低声|大声"
+_PRE_ATTRIBUTION_RE = re.compile(rf"(?:{_SPEECH_VERBS})[^\s，,。！？：:“”]{{0,2}}[：:，,]\s*$")
+# 引语后的说明语，如"……”朱林说。"
+_POST_ATTRIBUTION_RE = re.compile(rf"^[^，,。！？“”]{{0,4}}?(?:{_SPEECH_VERBS})")
+# 说明语中的动作词 -> 情感
+_VERB_EMOTIONS = [
+    (re.compile(r"吼|骂|喝|怒|咬牙"), "angry"),
+    (re.compile(r"笑"), "happy"),
+    (re.compile(r"哭|哽咽|叹"), "sad"),
+    (re.compile(r"惊"), "surprised"),
+]
+
+
+@dataclass
+class AnnotatedSpan:
+    """规则标注的一段：speaker为None表示说话人无法确定，需要交给大模型"""
+    text: str
+    speaker: Optional[str] = None
+    emotion: str = "neutral"
+    speed: float = 1.0
+    span_id: int = 0  # 待定对白在本段中的编号（从1开始）
+
+    @property
+    def resolved(self) -> bool:
+        return self.speaker is not None
+
+    def to_record(self) -> Dict:
+        return {"text": self.text, "speaker": self.speaker, "emotion": self.emotion, "speed": self.speed}
+
+
+def split_sentences(text: str, max_chars: int = MAX_SEGMENT_CHARS) -> List[str]:
+    """按句子切分，并把相邻短句合并到不超过max_chars"""
+    pieces = []
+    current = ""
+    for match in _SENTENCE_RE.finditer(text):
+        sentence = match.group(0).strip()
+        if not sentence:
+            continue
+        if current and len(current) + len(sentence) > max_chars:
+            pieces.append(current)
+            current = ""
+        current += sentence
+        while len(current) > max_chars:  # 没有标点的超长句
+            pieces.append(current[:max_chars])
+            current = current[max_chars:]
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _emotion_from_clause(clause: str) -> str:
+    for pattern, emotion in _VERB_EMOTIONS:
+        if pattern.search(clause):
+            return emotion
+    return "neutral"
+
+
+def _last_clause(narration: str) -> str:
+    """引语前的说明语：上一句句末标点之后的部分"""
+    cut = max(narration.rfind(mark) for mark in "。！？!?”\n")
+    return narration[cut + 1:]
+
+
+def _first_clause(narration: str) -> str:
+    """引语后的说明语：到第一个句末标点为止"""
+    match = re.search(r"[。！？!?“\n]", narration)
+    return narration[:match.start()] if match else narration
+
+
+def _attribute(role_index: RoleIndex, before: str, after: str):
+    """
+    根据引语前后的说明语确定说话人，只接受无歧义的情形：
+    1. 前置说明语以"道/说/问…"+冒号或逗号结尾，且其中恰好只提到一个角色；
+    2. 后置说明语以角色称呼开头，紧跟"道/说/问…"。
+    返回 (说话人, 说明语)，无法确定时说话人为None
+    """
+    clause = _last_clause(before)
+    if _PRE_ATTRIBUTION_RE.search(clause):
+        names = {name for _, _, name in role_index.iter_mentions(clause)}
+        if len(names) == 1:
+            return names.pop(), clause
+
+    clause = _first_clause(after)
+    starts = [(end, name) for start, end, name in role_index.iter_mentions(clause) if start == 0]
+    if starts:
+        end, name = max(starts)  # 取最长的称呼
+        if _POST_ATTRIBUTION_RE.match(clause[end:]):
+            return name, clause
+    return None, ""
+
+
+def _is_dialogue(before: str, content: str) -> bool:
+    """区分对白与书名/专有名词等行内引号：前面是冒号/句末/段首，或引号内本身是完整句子"""
+    prev = before.rstrip()[-1:]
+    return prev in ("", "：", ":", "。", "！", "？", "”", "\n", "，") and bool(content.strip()) \
+        or bool(re.search(r"[。！？!?…]", content))
+
+
+def annotate_by_rules(text: str, role_index: RoleIndex) -> List[AnnotatedSpan]:
+    """
+    本地规则标注：旁白与引号对白分开，说明语无歧义的对白直接标注说话人，
+    其余对白标记为待定（speaker=None，按顺序编号），由调用方交给大模型判断
+
+    Returns:
+        按原文顺序的片段列表（每段不超过 MAX_SEGMENT_CHARS 字）
+    """
+    # 先把全文切成 旁白 / 对白 交替的片段，行内引号并入旁白
+    parts = []  # (是否对白, 文本, 前文, 后文)
+    narration = ""
+    cursor = 0
+    for match in _QUOTE_RE.finditer(text):
+        if match.start() == match.end():
+            continue
+        before = text[cursor:match.start()]
+        content = match.group(1)
+        if not _is_dialogue(narration + before, content):
+            narration += text[cursor:match.end()]
+            cursor = match.end()
+            continue
+        narration += before
+        if narration.strip():
+            parts.append((False, narration, "", ""))
+        parts.append((True, content, text[max(0, match.start() - 80):match.start()], text[match.end():match.end() + 40]))
+        narration = ""
+        cursor = match.end()
+    narration += text[cursor:]
+    if narration.strip():
+        parts.append((False, narration, "", ""))
+
+    spans: List[AnnotatedSpan] = []
+    pending_id = 0
+    for is_dialogue, content, before, after in parts:
+        if not is_dialogue:
+            spans.extend(AnnotatedSpan(sentence, NARRATOR) for sentence in split_sentences(content))
+            continue
+        speaker, clause = _attribute(role_index, before, after)
+        emotion = _emotion_from_clause(clause) if speaker else "neutral"
+        sentences = split_sentences(content)
+        if not sentences:
+            continue
+        if speaker is None:
+            # 待定对白整体编号一次，大模型的判断作用于该对白的全部句子
+            pending_id += 1
+        for sentence in sentences:
+            spans.append(AnnotatedSpan(sentence, speaker, emotion, 1.0, 0 if speaker else pending_id))
+    return spans
+
+
+def mark_pending_spans(spans: List[AnnotatedSpan], context_lines: Optional[int] = PENDING_CONTEXT_LINES) -> str:
+    """
+    把规则标注结果还原为文本，待定对白前加【编号】，供大模型结合上下文判断说话人
+    :param context_lines: 只保留待定对白前后各这么多行，其余连续的部分替换为「……」（None表示保留全文）
+    """
+    lines = []
+    pending = []  # 各行是否为待定对白
+    last_id = 0
+    for span in spans:
+        if span.speaker == NARRATOR:
+            lines.append(span.text)
+        elif span.resolved:
+            lines.append(f"“{span.text}”")
+        elif span.span_id != last_id:
+            lines.append(f"【{span.span_id}】“{span.text}”")
+            last_id = span.span_id
+        else:
+            lines[-1] = lines[-1][:-1] + span.text + "”"
+            continue
+        pending.append(not span.resolved)
+    if context_lines is None:
+        return "\n".join(lines)
+
+    marked = []
+    for i, line in enumerate(lines):
+        if any(pending[max(0, i - context_lines):i + context_lines + 1]):
+            marked.append(line)
+        elif not marked or marked[-1] != "……":
+            marked.append("……")
+    return "\n".join(marked)
@@ -0,0 +1,390 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+from collections.abc import Sequence
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+
+# 片段库：<路径>（.jsonl，每行一个紧凑JSON片段，只追加）+ <路径>.idx（每个片段的结束偏移，小端uint64）
+STORE_SUFFIX = ".jsonl"
+INDEX_SUFFIX = ".idx"
+_INDEX_DTYPE = np.dtype("<u8")
+
+
+def is_segment_store(path: str) -> bool:
+    """按扩展名区分片段库（.jsonl）与旧的JSON数组文件（.json）"""
+    return path.endswith(STORE_SUFFIX)
+
+
+def _index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+
+def _encode(segment: Dict) -> bytes:
+    return (json.dumps(segment, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def _scan_ends(path: str) -> np.ndarray:
+    """扫描数据文件重建索引：每个以换行结尾的完整行是一个片段（末尾的半行不计）"""
+    ends = []
+    offset = 0
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            for line in f:
+                offset += len(line)
+                if line.endswith(b"\n"):
+                    ends.append(offset)
+    return np.asarray(ends, dtype=_INDEX_DTYPE)
+
+
+def _load_ends(path: str) -> np.ndarray:
+    """
+    读取索引并做一致性检查；索引缺失、损坏或与数据文件不符（如写入中途崩溃）时扫描数据文件重建
+    :return: 各片段的结束偏移
+    """
+    index_path = _index_path(path)
+    data_size = os.path.getsize(path) if os.path.exists(path) else 0
+    if os.path.exists(index_path) and os.path.getsize(index_path) % _INDEX_DTYPE.itemsize == 0:
+        ends = np.fromfile(index_path, dtype=_INDEX_DTYPE)
+        if len(ends) == 0:
+            if data_size == 0:
+                return ends
+        elif int(ends[-1]) <= data_size and _ends_with_newline(path, int(ends[-1])):
+            return ends
+    ends = _scan_ends(path)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    ends.tofile(tmp_path)
+    os.replace(tmp_path, index_path)
+    return ends
+
+
+def _ends_with_newline(path: str, end: int) -> bool:
+    with open(path, "rb") as f:
+        f.seek(end - 1)
+        return f.read(1) == b"\n"
+
+
+class SegmentStoreWriter:
+    """
+    片段库的追加写入器（同一时间只允许一个写入者）
+
+    - 每处理完一块就 append 该块的片段，读取方无需等待全书完成
+    - 先写数据再写索引：索引中的片段一定已完整写入；打开时截掉上次崩溃留下的半行
+    """
+
+    def __init__(self, path: str, append: bool = True):
+        self.path = path
+        if not append:
+            for stale in (path, _index_path(path)):
+                if os.path.exists(stale):
+                    os.remove(stale)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        ends = _load_ends(path)
+        self._count = len(ends)
+        self._end = int(ends[-1]) if len(ends) else 0
+        self._data = open(path, "ab")
+        self._data.truncate(self._end)
+        self._index = open(_index_path(path), "ab")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, segments: Iterable[Dict]) -> range:
+        """
+        追加一批片段（通常是一个文本块的标注结果）
+        :return: 这批片段在库中的下标范围
+        """
+        start = self._count
+        ends = []
+        lines = []
+        for segment in segments:
+            line = _encode(segment)
+            self._end += len(line)
+            ends.append(self._end)
+            lines.append(line)
+        if lines:
+            self._data.write(b"".join(lines))
+            self._data.flush()
+            self._index.write(np.asarray(ends, dtype=_INDEX_DTYPE).tobytes())
+            self._index.flush()
+            self._count += len(lines)
+        return range(start, self._count)
+
+    def truncate(self, count: int):
+        """只保留前count个片段（增量更新时丢弃改动位置之后的旧结果，再追加新结果）"""
+        if count >= self._count:
+            return
+        self._data.flush()
+        self._index.flush()
+        self._end = int(_load_ends(self.path)[count - 1]) if count > 0 else 0
+        self._index.truncate(count * _INDEX_DTYPE.itemsize)
+        self._data.truncate(self._end)
+        self._count = count
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+    def abort(self):
+        """处理中途失败时关闭：已追加的片段都是完整的，保留下来供续跑"""
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class SegmentStore(Sequence):
+    """
+    片段库的只读视图：数据文件以内存映射打开，按下标/区间随机读取，不把全书载入内存
+
+    - store[i] 返回一个片段，store[a:b] 返回片段列表，len(store) 为片段数
+    - 写入方仍在追加时，refresh() 可看到新写入的片段
+    - 可被pickle（按路径重新打开），多进程合成时每个进程各自映射、只读取分到的区间
+    """
+
+    def __init__(self, path: str):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"片段库不存在：{path}")
+        self.path = path
+        self._ends = np.empty(0, dtype=_INDEX_DTYPE)
+        self._mmap: Optional[mmap.mmap] = None
+        self.refresh()
+
+    def refresh(self) -> int:
+        """重新读取索引（写入方追加后调用），返回当前片段数"""
+        ends = _load_ends(self.path)
+        if len(ends) != len(self._ends) or self._mmap is None:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if len(ends):
+                with open(self.path, "rb") as f:
+                    self._mmap = mmap.mmap(f.fileno(), int(ends[-1]), access=mmap.ACCESS_READ)
+            self._ends = ends
+        return len(self._ends)
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    def _span(self, idx: int):
+        start = int(self._ends[idx - 1]) if idx > 0 else 0
+        return start, int(self._ends[idx])
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[Dict, List[Dict]]:
+        if isinstance(idx, slice):
+            return list(self.iter_range(*idx.indices(len(self))[:2]))
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"片段下标越界：{idx}")
+        start, end = self._span(idx)
+        return json.loads(self._mmap[start:end])
+
+    def iter_range(self, start: int = 0, end: Optional[int] = None) -> Iterator[Dict]:
+        """按顺序流式读取 [start, end) 区间的片段"""
+        end = len(self) if end is None else min(end, len(self))
+        for idx in range(max(start, 0), end):
+            start_offset, end_offset = self._span(idx)
+            yield json.loads(self._mmap[start_offset:end_offset])
+
+    def __iter__(self) -> Iterator[Dict]:
+        return self.iter_range()
+
+    def view(self, start: int = 0, end: Optional[int] = None) -> "SegmentStoreView":
+        """[start, end) 区间的只读视图：不读取片段，用到时再从内存映射读取（store[a:b] 会整体读成列表）"""
+        start, end, _ = slice(start, end).indices(len(self))
+        return SegmentStoreView(self, start, max(start, end))
+
+    def content_hash(self, start: int = 0, end: Optional[int] = None) -> str:
+        """[start, end) 区间片段的内容哈希（默认全部已提交片段；分块计算，不整体读入内存）"""
+        end = len(self) if end is None else end
+        digest = hashlib.sha256()
+        if self._mmap is not None and end > start:
+            first, last = self._span(start)[0], self._span(end - 1)[1]
+            for offset in range(first, last, 1 << 20):
+                digest.update(self._mmap[offset:min(offset + (1 << 20), last)])
+        return digest.hexdigest()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __reduce__(self):
+        return SegmentStore, (self.path,)
+
+
+class SegmentStoreView(Sequence):
+    """
+    片段库某个区间的只读视图（下标从0开始），只记录区间，按下标/区间从所属片段库读取
+
+    - 可被pickle（片段库按路径重新打开），多进程合成时只传路径和区间，不传片段本身
+    - 切片与片段库一致返回列表，嵌套区间用 view()
+    """
+
+    def __init__(self, store: SegmentStore, start: int, end: int):
+        self.store = store
+        self.start = start
+        self.end = end
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[Dict, List[Dict]]:
+        if isinstance(idx, slice):
+            return list(self.iter_range(*idx.indices(len(self))[:2]))
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"片段下标越界：{idx}")
+        return self.store[self.start + idx]
+
+    def iter_range(self, start: int = 0, end: Optional[int] = None) -> Iterator[Dict]:
+        """按顺序流式读取视图内 [start, end) 区间的片段"""
+        end = len(self) if end is None else min(end, len(self))
+        return self.store.iter_range(self.start + max(start, 0), self.start + end)
+
+    def __iter__(self) -> Iterator[Dict]:
+        return self.iter_range()
+
+    def view(self, start: int = 0, end: Optional[int] = None) -> "SegmentStoreView":
+        start, end, _ = slice(start, end).indices(len(self))
+        return SegmentStoreView(self.store, self.start + start, self.start + max(start, end))
+
+    def content_hash(self) -> str:
+        return self.store.content_hash(self.start, self.end)
+
+    def close(self):
+        self.store.close()
+
+    def __reduce__(self):
+        return SegmentStoreView, (self.store, self.start, self.end)
+
+
+class JsonArrayWriter:
+    """与 SegmentStoreWriter 接口相同的旧格式写入器：收集全部片段，close时一次写出JSON数组（abort时不写，保留原文件）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.segments: List[Dict] = []
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def append(self, segments: Iterable[Dict]) -> range:
+        start = len(self.segments)
+        self.segments.extend(segments)
+        return range(start, len(self.segments))
+
+    def close(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.segments, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def abort(self):
+        """处理中途失败：丢弃已收集的片段，不覆盖已有的结果文件"""
+        self.segments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def open_segment_writer(path: str, append: bool = False) -> Union[SegmentStoreWriter, JsonArrayWriter]:
+    """按扩展名打开标注结果写入器：.jsonl 边处理边追加，.json 结束时写出整个数组"""
+    if is_segment_store(path):
+        return SegmentStoreWriter(path, append=append)
+    return JsonArrayWriter(path)
+
+
+def load_segments(path: str) -> Union[SegmentStore, List[Dict]]:
+    """按扩展名读取标注结果：.jsonl 返回内存映射的 SegmentStore，.json 返回列表"""
+    if is_segment_store(path):
+        return SegmentStore(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"JSON文件不存在：{path}")
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def segment_range(segments: Sequence[Dict], start: int = 0,
+                  end: Optional[int] = None) -> Sequence[Dict]:
+    """取 [start, end) 区间的片段：片段库返回不读取片段的视图，列表直接切片"""
+    if isinstance(segments, (SegmentStore, SegmentStoreView)):
+        return segments.view(start, end)
+    return segments[start:end]
+
+
+def write_segments(path: str, segments: Iterable[Dict]):
+    """整体重写标注结果（两种格式都先写临时文件再替换）"""
+    if not is_segment_store(path):
+        with JsonArrayWriter(path) as writer:
+            writer.append(segments)
+        return
+    tmp_path = f"{path}.{os.getpid()}.tmp{STORE_SUFFIX}"
+    with SegmentStoreWriter(tmp_path, append=False) as writer:
+        writer.append(segments)
+    # 先替换数据再替换索引；两步之间崩溃时，打开时的一致性检查会重建索引
+    os.replace(tmp_path, path)
+    os.replace(_index_path(tmp_path), _index_path(path))
+
+
+def import_json(json_path: str, store_path: str) -> int:
+    """把旧的 novel_processed.json 转为片段库，返回片段数"""
+    segments = load_segments(json_path)
+    write_segments(store_path, segments)
+    return len(segments)
+
+
+def export_json(store_path: str, json_path: str) -> int:
+    """
+    把片段库流式导出为 novel_processed.json（与 json.dump(indent=4) 的输出逐字节一致），返回片段数
+    """
+    count = 0
+    tmp_path = f"{json_path}.{os.getpid()}.tmp"
+    with SegmentStore(store_path) as store, open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for segment in store:
+            f.write(",\n" if count else "\n")
+            lines = json.dumps(segment, ensure_ascii=False, indent=4).split("\n")
+            f.write("\n".join("    " + line for line in lines))
+            count += 1
+        f.write("\n]" if count else "]")
+    os.replace(tmp_path, json_path)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="标注结果格式转换：JSON数组 <-> JSONL片段库")
+    parser.add_argument("command", choices=["import", "export"],
+                        help="import：JSON -> JSONL片段库；export：JSONL片段库 -> JSON")
+    parser.add_argument("source", help="源文件路径")
+    parser.add_argument("target", help="目标文件路径")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        total = import_json(args.source, args.target)
+    else:
+        total = export_json(args.source, args.target)
+    print(f"转换完成：{total} 个片段，已保存至：{args.target}")
@@ -0,0 +1,123 @@
+import json
+import os
+import zlib
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+DEFAULT_REGISTRY_PREFIX = "./speaker_embeddings"
+NARRATOR_NAME = "旁白"
+
+
+def voice_seed_for(name: str, voice: object = None) -> int:
+    """
+    角色的音色种子：voice为ChatTTS内置音色索引（整数）时直接使用，
+    否则由 音色风格+角色名 哈希得到，同一角色每次得到相同种子
+    """
+    if isinstance(voice, int):
+        return voice
+    return zlib.crc32(f"{voice or ''}:{name}".encode("utf-8")) % (2 ** 31)
+
+
+class SpeakerRegistry:
+    """
+    角色说话人向量表
+
+    - <前缀>.npy：float16 的 (角色数, 向量维度) 矩阵，以内存映射方式只读打开
+    - <前缀>.json：角色名顺序、音色种子、音色风格、模型版本
+    每个角色的向量只生成一次，合成时按说话人名称查表，不再逐段随机抽取音色。
+    """
+
+    def __init__(self, path_prefix: str, meta: Dict, embeddings: np.ndarray):
+        self.path_prefix = path_prefix
+        self.names: List[str] = meta["names"]
+        self.seeds: List[int] = meta["seeds"]
+        self.voices: Dict[str, object] = meta.get("voices", {})
+        self.model_version: str = meta.get("model_version", "unknown")
+        self._row = {name: row for row, name in enumerate(self.names)}
+        self._embeddings = embeddings
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._row
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get(self, name: str) -> Optional[np.ndarray]:
+        """查询角色的说话人向量（float32），未登记的角色返回None"""
+        row = self._row.get(name)
+        if row is None:
+            return None
+        return np.asarray(self._embeddings[row], dtype=np.float32)
+
+    def seed_for(self, name: str) -> Optional[int]:
+        row = self._row.get(name)
+        return None if row is None else self.seeds[row]
+
+    @staticmethod
+    def exists(path_prefix: str = DEFAULT_REGISTRY_PREFIX) -> bool:
+        return os.path.exists(f"{path_prefix}.json") and os.path.exists(f"{path_prefix}.npy")
+
+    @classmethod
+    def load(cls, path_prefix: str = DEFAULT_REGISTRY_PREFIX) -> "SpeakerRegistry":
+        with open(f"{path_prefix}.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        embeddings = np.load(f"{path_prefix}.npy", mmap_mode="r")
+        return cls(path_prefix, meta, embeddings)
+
+    @classmethod
+    def build(cls, roles_path: str, sample_speaker: Callable[[int], np.ndarray], model_version: str,
+              path_prefix: str = DEFAULT_REGISTRY_PREFIX) -> "SpeakerRegistry":
+        """
+        由 novel_roles.json 的 roles / chattts_voice_map 生成全部角色的说话人向量并落盘
+        :param roles_path: 角色档案JSON路径
+        :param sample_speaker: 按种子生成说话人向量的函数（TTSBackend.sample_speaker）
+        :param model_version: 生成向量所用的模型版本，换模型后需重建
+        :param path_prefix: 输出文件前缀
+        """
+        with open(roles_path, "r", encoding="utf-8") as f:
+            role_data = json.load(f)
+        voice_map: Dict[str, object] = role_data.get("chattts_voice_map", {})
+
+        # 旁白固定放在第一行，其后是角色档案与音色映射表中出现的全部角色
+        names = [NARRATOR_NAME]
+        for name in [role["name"] for role in role_data.get("roles", [])] + list(voice_map):
+            if name not in names:
+                names.append(name)
+        voices = {name: voice_map.get(name, "neutral") for name in names}
+        seeds = [voice_seed_for(name, voices[name]) for name in names]
+
+        first = np.asarray(sample_speaker(seeds[0]), dtype=np.float32).reshape(-1)
+        os.makedirs(os.path.dirname(os.path.abspath(path_prefix)), exist_ok=True)
+        matrix = np.lib.format.open_memmap(
+            f"{path_prefix}.npy", mode="w+", dtype=np.float16, shape=(len(names), first.size)
+        )
+        matrix[0] = first
+        for row, seed in enumerate(seeds[1:], 1):
+            matrix[row] = np.asarray(sample_speaker(seed), dtype=np.float32).reshape(-1)
+        matrix.flush()
+        del matrix
+
+        meta = {"names": names, "seeds": seeds, "voices": voices,
+                "model_version": model_version, "dim": int(first.size)}
+        with open(f"{path_prefix}.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=4)
+        return cls.load(path_prefix)
+
+    @classmethod
+    def load_or_build(cls, roles_path: Optional[str], sample_speaker: Callable[[int], np.ndarray],
+                      model_version: str, path_prefix: str = DEFAULT_REGISTRY_PREFIX) -> Optional["SpeakerRegistry"]:
+        """
+        已有且仍然有效（模型版本一致、不早于角色档案）时直接加载，否则重建；
+        既没有已存的向量表也没有角色档案时返回None
+        """
+        if cls.exists(path_prefix):
+            registry = cls.load(path_prefix)
+            stale = roles_path and os.path.exists(roles_path) and \
+                os.path.getmtime(roles_path) > os.path.getmtime(f"{path_prefix}.json")
+            if registry.model_version == model_version and not stale:
+                return registry
+        if roles_path and os.path.exists(roles_path):
+            print(f"正在根据角色档案生成说话人向量：{roles_path}")
+            return cls.build(roles_path, sample_speaker, model_version, path_prefix)
+        return None
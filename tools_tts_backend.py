@@ -0,0 +1,159 @@
+import importlib
+import os
+import threading
+import time
+from importlib import metadata
+from typing import Any, Callable, List, Optional
+
+import numpy as np
+
+
+def _package_version(name: str) -> str:
+    """读取已安装包的版本号（不导入包本身，避免触发模型相关的重量级导入）"""
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+class TTSBackend:
+    """
+    TTS后端接口：与 ChatTTS.Chat.infer 的调用方式保持一致
+
+    子类需实现 infer()；model_version 参与片段缓存键，不同后端/版本的缓存互不混用。
+    """
+
+    model_version = "unknown"
+    load_seconds = 0.0
+
+    def infer(self, texts: List[str], **kwargs) -> List[Any]:
+        """合成一批文本，返回与texts一一对应的波形（tensor或ndarray）"""
+        raise NotImplementedError
+
+    def sample_speaker(self, seed: int) -> np.ndarray:
+        """按种子生成一个说话人向量（相同种子得到相同音色）"""
+        raise NotImplementedError
+
+
+class ChatTTSBackend(TTSBackend):
+    """真实的ChatTTS后端（构造时加载模型，首次运行需联网下载）"""
+
+    model_version = f"ChatTTS-{_package_version('ChatTTS')}"
+
+    def __init__(self):
+        import ChatTTS
+
+        start = time.perf_counter()
+        self.chat = ChatTTS.Chat()
+        self.chat.load_models()  # 自动下载并加载模型，首次运行需联网
+        self.load_seconds = time.perf_counter() - start
+
+    def infer(self, texts: List[str], **kwargs) -> List[Any]:
+        params_infer_code = kwargs.get("params_infer_code")
+        if params_infer_code and isinstance(params_infer_code.get("spk_emb"), np.ndarray):
+            import torch
+            params_infer_code = dict(params_infer_code, spk_emb=torch.from_numpy(params_infer_code["spk_emb"]))
+            kwargs["params_infer_code"] = params_infer_code
+        return self.chat.infer(texts, **kwargs)
+
+    def sample_speaker(self, seed: int) -> np.ndarray:
+        import torch
+
+        torch.manual_seed(seed)
+        speaker = self.chat.sample_random_speaker()
+        if hasattr(speaker, "cpu"):
+            speaker = speaker.cpu().numpy()
+        return np.asarray(speaker, dtype=np.float32).reshape(-1)
+
+
+class FakeTTSBackend(TTSBackend):
+    """
+    测试/基准用的假后端：不加载模型，按文本长度返回合成的正弦波
+
+    seconds_per_char 控制输出时长，infer_delay_per_char 模拟推理耗时。
+    """
+
+    model_version = "fake-tts"
+
+    def __init__(self, sample_rate: int = 24000, seconds_per_char: float = 0.2,
+                 infer_delay_per_char: float = 0.0):
+        self.sample_rate = sample_rate
+        self.seconds_per_char = seconds_per_char
+        self.infer_delay_per_char = infer_delay_per_char
+
+    def infer(self, texts: List[str], **kwargs) -> List[np.ndarray]:
+        if self.infer_delay_per_char:
+            time.sleep(self.infer_delay_per_char * sum(len(text) for text in texts))
+        wavs = []
+        for text in texts:
+            samples = max(1, int(len(text) * self.seconds_per_char * self.sample_rate))
+            t = np.arange(samples, dtype=np.float32) / self.sample_rate
+            wavs.append((0.3 * np.sin(2 * np.pi * 220.0 * t))[None, :])
+        return wavs
+
+    def sample_speaker(self, seed: int) -> np.ndarray:
+        return np.random.default_rng(seed).standard_normal(768).astype(np.float32)
+
+
+def _resolve_factory(spec: str) -> Callable[[], TTSBackend]:
+    """解析后端配置：'chattts' / 'fake' / '模块名:可调用对象'"""
+    if spec in ("", "chattts"):
+        return ChatTTSBackend
+    if spec == "fake":
+        return FakeTTSBackend
+    module_name, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+# 可通过环境变量 TTS_BACKEND 切换后端（多进程合成的子进程同样生效）
+_backend_factory: Callable[[], TTSBackend] = _resolve_factory(os.environ.get("TTS_BACKEND", ""))
+_backend: Optional[TTSBackend] = None
+_backend_lock = threading.Lock()
+
+
+def set_tts_backend(backend_or_factory):
+    """
+    替换当前进程的TTS后端
+    :param backend_or_factory: TTSBackend实例（立即生效），或无参工厂（首次使用时才构造）
+    """
+    global _backend, _backend_factory
+    with _backend_lock:
+        if isinstance(backend_or_factory, TTSBackend):
+            _backend = backend_or_factory
+            _backend_factory = type(backend_or_factory)
+        else:
+            _backend = None
+            _backend_factory = backend_or_factory
+
+
+def get_backend_factory() -> Callable[[], TTSBackend]:
+    """当前后端的工厂（传给多进程合成的子进程，各自构造）"""
+    return _backend_factory
+
+
+def get_model_version() -> str:
+    """当前后端的模型版本（不触发模型加载）"""
+    if _backend is not None:
+        return _backend.model_version
+    return getattr(_backend_factory, "model_version", "unknown")
+
+
+def get_tts_backend() -> TTSBackend:
+    """获取当前进程的TTS后端（懒加载，每个进程只加载一次）"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _backend_factory()
+            if _backend.load_seconds:
+                print(f"TTS模型加载完成，耗时 {_backend.load_seconds:.1f} 秒")
+        return _backend
+
+
+def warm_up(text: str = "你好。") -> float:
+    """
+    显式预热：加载模型并合成一句短文本，返回总耗时（秒）
+    适合在服务启动或正式合成前调用，把冷启动开销挪到可控的时间点
+    """
+    start = time.perf_counter()
+    get_tts_backend().infer([text])
+    return time.perf_counter() - start
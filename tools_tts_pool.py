@@ -0,0 +1,119 @@
+import multiprocessing as mp
+import os
+import queue
+from typing import Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+
+def _worker_main(worker_id: int, segments: Sequence[Dict], batch_size: int, cache_dir: Optional[str],
+                 torch_threads: int, backend_factory: Optional[Callable],
+                 speaker_registry_path: Optional[str], task_queue, result_queue):
+    """
+    工作进程：固定torch线程数、加载一次模型，循环领取片段区间并合成
+    结果以 (区间起点, 区间终点, {片段下标: PCM字节}) 放回结果队列
+    """
+    try:
+        import generate_audio_by_chattts as tts
+        from tools_audio_cache import AudioClipCache
+        from tools_tts_backend import get_tts_backend, set_tts_backend
+        from tools_wav_writer import StreamingWavWriter
+
+        try:
+            import torch
+            torch.set_num_threads(torch_threads)
+        except ImportError:  # 假后端不依赖torch
+            pass
+
+        if backend_factory is not None:
+            set_tts_backend(backend_factory)
+        get_tts_backend()  # 每个进程只加载一次模型
+        if speaker_registry_path:
+            tts.use_speaker_registry(None, speaker_registry_path)  # 父进程已生成，这里只做内存映射
+        cache = AudioClipCache(cache_dir) if cache_dir else None
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            start, end = task
+            wavs = tts.synthesize_segments(segments, batch_size, range(start, end), cache)
+            pcms = {idx: StreamingWavWriter.to_pcm16(wav) for idx, wav in wavs.items()}
+            result_queue.put(("ok", start, end, pcms))
+    except Exception as e:
+        result_queue.put(("error", worker_id, None, f"工作进程{worker_id}异常：{str(e)}"))
+
+
+def synthesize_in_pool(segments: Sequence[Dict], num_workers: int, batch_size: int = 8,
+                       range_size: int = 64, cache_dir: Optional[str] = None,
+                       torch_threads: Optional[int] = None,
+                       backend_factory: Optional[Callable] = None,
+                       speaker_registry_path: Optional[str] = None) -> Iterator[Tuple[int, bytes]]:
+    """
+    多进程合成：N个工作进程各自加载模型，从任务队列领取片段区间，
+    由当前进程按原文顺序收集并逐段产出 (片段下标, 16bit PCM字节)
+
+    Args:
+        segments: 片段列表；传入 SegmentStore（或其区间视图）时只把路径和区间传给子进程，各进程自行内存映射、按区间读取
+        num_workers: 工作进程数
+        batch_size: 每次chat.infer合成的片段数
+        range_size: 每个任务包含的片段数
+        cache_dir: 片段音频缓存目录（各进程共享）
+        torch_threads: 每个进程的torch线程数（默认 CPU核数 / 进程数）
+        backend_factory: 子进程构造TTS后端用的工厂（需可被pickle，默认使用真实ChatTTS）
+        speaker_registry_path: 角色说话人向量表前缀（由父进程预先生成）
+    """
+    if torch_threads is None:
+        torch_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    ranges = [(start, min(start + range_size, len(segments)))
+              for start in range(0, len(segments), range_size)]
+
+    ctx = mp.get_context("spawn")  # 每个进程独立加载模型，避免fork后torch线程池死锁
+    task_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    workers = [
+        ctx.Process(
+            target=_worker_main,
+            args=(worker_id, segments, batch_size, cache_dir, torch_threads, backend_factory,
+                  speaker_registry_path, task_queue, result_queue),
+            daemon=True,
+        )
+        for worker_id in range(num_workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    # 控制在途任务数，乱序到达的结果最多缓存约2倍进程数个区间
+    max_in_flight = num_workers * 2
+    next_task = 0
+    in_flight = 0
+    pending: Dict[int, Tuple[int, Dict[int, bytes]]] = {}
+    next_start = 0
+    try:
+        while next_start < len(segments):
+            while next_task < len(ranges) and in_flight < max_in_flight:
+                task_queue.put(ranges[next_task])
+                next_task += 1
+                in_flight += 1
+
+            try:
+                status, start, end, payload = result_queue.get(timeout=5)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError("所有工作进程已退出，合成中断")
+                continue
+            if status == "error":
+                raise RuntimeError(payload)
+            in_flight -= 1
+            pending[start] = (end, payload)
+
+            # 按顺序产出已经连续的区间
+            while next_start in pending:
+                end, pcms = pending.pop(next_start)
+                for idx in sorted(pcms):
+                    yield idx, pcms[idx]
+                next_start = end
+    finally:
+        for _ in workers:
+            task_queue.put(None)
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
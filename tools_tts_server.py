@@ -0,0 +1,567 @@
+import argparse
+import base64
+import http.client
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+import numpy as np
+
+import generate_audio_by_chattts as tts
+from tools_audio_cache import AudioClipCache
+from tools_metrics import metrics
+from tools_segment_store import SegmentStore, load_segments
+from tools_speaker_registry import SpeakerRegistry
+from tools_tts_backend import get_model_version, get_tts_backend, set_tts_backend
+from tools_wav_writer import StreamingWavWriter
+
+SYNTHESIZE_PATH = "/synthesize"
+HEALTH_PATH = "/health"
+# 每批最多合成的片段数
+MAX_BATCH_SIZE = 8
+# 片段在队列中最长等待多久（秒）就必须发车，即使本批未满
+MAX_WAIT_SECONDS = 0.05
+# 单个请求同时在队列中的片段数上限（整本书的任务也按窗口推进，不会挤占其他请求）
+MAX_IN_FLIGHT_PER_REQUEST = 64
+# 队列等待时间直方图分桶（秒）
+_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+# 合成请求中每个片段必须包含的字段
+_SEGMENT_FIELDS = ("text", "speaker", "emotion", "speed")
+
+
+class _Job:
+    __slots__ = ("key", "text", "registry", "future", "enqueued_at")
+
+    def __init__(self, key: str, text: str, registry: Optional[SpeakerRegistry]):
+        self.key = key
+        self.text = text
+        self.registry = registry
+        self.future: Future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class MicroBatcher:
+    """
+    动态微批：把并发请求中推理参数相同（角色向量表/说话人/情感/语速）的片段合入同一次 chat.infer
+
+    - 某组攒满 max_batch_size，或组内最早的片段已等待 max_wait 秒，即发车
+    - 只有一个合成线程使用模型，多个请求共享同一个常驻模型
+    - 同一片段（缓存键相同）正在排队或合成时，后来的请求直接复用其结果
+    - 某批失败时退回逐条合成，只让真正出错的片段失败
+    """
+
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT_SECONDS,
+                 cache: Optional[AudioClipCache] = None):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.cache = cache
+        self.batches = 0
+        self.segments = 0
+        self._groups: Dict[Tuple, List[_Job]] = {}
+        self._inflight: Dict[str, Future] = {}  # 缓存键 -> 正在排队/合成的结果
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="tts-batcher", daemon=True)
+        self._thread.start()
+
+    @property
+    def queued(self) -> int:
+        with self._cond:
+            return sum(len(jobs) for jobs in self._groups.values())
+
+    def submit(self, segment: Dict, registry: Optional[SpeakerRegistry] = None) -> Future:
+        """
+        提交一个片段，返回结果为float32波形的Future
+        :param registry: 该片段所属书的角色向量表（默认使用服务启动时加载的向量表）
+        """
+        key = tts.segment_cache_key(segment, registry)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("合成服务已关闭")
+            future = self._inflight.get(key)
+            if future is not None:
+                metrics.inc("tts_server_dedup_total")
+                return future
+        if self.cache is not None:
+            wav = self.cache.load(key)
+            if wav is not None:
+                future = Future()
+                future.set_result(wav)
+                return future
+        job = _Job(key, segment["text"].strip(), registry)
+        group = (registry, segment["speaker"], segment["emotion"], float(segment["speed"]))
+        with self._cond:
+            existing = self._inflight.get(key)
+            if existing is not None:
+                return existing
+            self._inflight[key] = job.future
+            job.future.add_done_callback(lambda _, key=key: self._forget(key))
+            self._groups.setdefault(group, []).append(job)
+            self._cond.notify()
+        return job.future
+
+    def _forget(self, key: str):
+        with self._cond:
+            self._inflight.pop(key, None)
+
+    def _next_batch(self) -> Optional[Tuple[Tuple, List[_Job]]]:
+        """等待下一批可以发车的片段；关闭且队列为空时返回None"""
+        with self._cond:
+            while True:
+                if not self._groups:
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                # 优先发车等待最久的组（组内片段按到达顺序排列）
+                group, jobs = min(self._groups.items(), key=lambda item: item[1][0].enqueued_at)
+                full = next((item for item in self._groups.items() if len(item[1]) >= self.max_batch_size), None)
+                if full is not None and jobs[0].enqueued_at + self.max_wait > now:
+                    group, jobs = full
+                elif jobs[0].enqueued_at + self.max_wait > now and not self._closed:
+                    self._cond.wait(jobs[0].enqueued_at + self.max_wait - now)
+                    continue
+                batch = jobs[:self.max_batch_size]
+                if len(jobs) > len(batch):
+                    self._groups[group] = jobs[len(batch):]
+                else:
+                    del self._groups[group]
+                return group, batch
+
+    def _run(self):
+        while True:
+            item = self._next_batch()
+            if item is None:
+                return
+            (registry, speaker, emotion, speed), batch = item
+            now = time.monotonic()
+            for job in batch:
+                metrics.observe("tts_server_queue_wait_seconds", now - job.enqueued_at, buckets=_WAIT_BUCKETS)
+            metrics.observe("tts_server_batch_size", len(batch), buckets=_BATCH_SIZE_BUCKETS)
+            self.batches += 1
+            self.segments += len(batch)
+            try:
+                wavs = tts.synthesize_batch([job.text for job in batch], emotion, speed, speaker, registry)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].future.set_exception(e)
+                    continue
+                print(f"⚠️  批量合成失败，改为逐段合成：{str(e)}")
+                wavs = []
+                for job in batch:
+                    try:
+                        wavs.append(tts.synthesize_batch([job.text], emotion, speed, speaker, registry)[0])
+                    except Exception as single_error:
+                        wavs.append(single_error)
+            for job, wav in zip(batch, wavs):
+                if isinstance(wav, Exception):
+                    job.future.set_exception(wav)
+                    continue
+                if self.cache is not None:
+                    self.cache.save(job.key, wav)
+                job.future.set_result(wav)
+
+    def close(self, timeout: Optional[float] = None):
+        """不再接受新片段，合成完已排队的片段后退出"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+
+def _frame(payload: Dict) -> bytes:
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _request_range(body: Dict, segments: Sequence[Dict]) -> Tuple[int, int]:
+    """校验并返回请求的片段区间 [start, end)（end超出时截到片段数）"""
+    try:
+        start = int(body.get("start", 0))
+        end = int(body.get("end", len(segments)))
+    except (TypeError, ValueError):
+        raise ValueError(f"start/end 必须是整数：{body.get('start')!r} / {body.get('end')!r}")
+    if start < 0 or end < start:
+        raise ValueError(f"片段区间无效：[{start}, {end})")
+    return start, min(end, len(segments))
+
+
+def _pending_indices(segments: Sequence[Dict], start: int, end: int) -> List[int]:
+    """逐个校验区间内的片段，返回需要合成（文本非空）的片段下标"""
+    indices = []
+    for idx in range(start, end):
+        segment = segments[idx]
+        if not isinstance(segment, dict) or any(field not in segment for field in _SEGMENT_FIELDS):
+            raise ValueError(f"第{idx + 1}个片段缺少字段（须包含 {'/'.join(_SEGMENT_FIELDS)}）：{segment}")
+        if not isinstance(segment["text"], str):
+            raise ValueError(f"第{idx + 1}个片段的text不是字符串：{segment['text']!r}")
+        try:
+            float(segment["speed"])
+        except (TypeError, ValueError):
+            raise ValueError(f"第{idx + 1}个片段的speed不是数字：{segment['speed']!r}")
+        if segment["text"].strip():
+            indices.append(idx)
+    return indices
+
+
+def _iter_completed(batcher: MicroBatcher, segments: Sequence[Dict], indices: Sequence[int],
+                    registry: Optional[SpeakerRegistry] = None) -> Iterator[Tuple[int, Future]]:
+    """按窗口提交片段，按完成顺序产出 (片段下标, Future)"""
+    pending: Dict[Future, List[int]] = {}
+    position = 0
+    while position < len(indices) or pending:
+        while position < len(indices) and len(pending) < MAX_IN_FLIGHT_PER_REQUEST:
+            idx = indices[position]
+            position += 1
+            pending.setdefault(batcher.submit(segments[idx], registry), []).append(idx)
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            for idx in pending.pop(future):
+                yield idx, future
+
+
+class TTSServer:
+    """
+    常驻合成服务：模型只加载一次，多个客户端（如同时预览章节的编辑）共享同一个热模型
+
+    - POST /synthesize  请求体 {"segments": [片段, ...]} 或 {"path": 标注结果路径, "start": 0, "end": N}，
+      可附带本书的 "roles_path" / "speaker_registry_path"（按该书的角色向量表合成，不同书的请求互不影响；
+      不附带时使用启动时 roles_path 加载的向量表），
+      以NDJSON流式返回：每合成完一个片段返回一行
+      {"index": 下标, "sample_rate": 24000, "pcm16": base64编码的16bit PCM}（失败时为 {"index", "error"}），
+      最后一行 {"done": true, "count": 成功数, "failed": 失败数}；片段按完成顺序返回，客户端按index重排。
+      请求本身有误（区间无效、片段缺字段等）时在合成前返回400；已开始返回后出错时，以一行不带index的
+      {"error": 原因} 结束（没有done行）
+    - GET /health  返回模型版本、队列长度和已合成的批次数
+    - 监听 host:port，或传入 socket_path 时监听Unix套接字
+
+    用法：
+        with TTSServer(port=8765) as server:
+            print(server.url)
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, socket_path: Optional[str] = None,
+                 max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT_SECONDS,
+                 cache_dir: Optional[str] = None, roles_path: Optional[str] = None, backend=None):
+        if backend is not None:
+            set_tts_backend(backend)
+        get_tts_backend()  # 启动时加载模型，之后所有请求共用
+        if roles_path:
+            tts.use_speaker_registry(roles_path)
+        self.socket_path = socket_path
+        self._registries: Dict[Tuple[str, str], Tuple[float, Optional[SpeakerRegistry]]] = {}
+        self._registry_lock = threading.Lock()
+        self.batcher = MicroBatcher(max_batch_size, max_wait, AudioClipCache(cache_dir) if cache_dir else None)
+        handler = self._make_handler()
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self._server = _ThreadingUnixHTTPServer(socket_path, handler)
+        else:
+            self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        if self.socket_path:
+            return f"unix://{os.path.abspath(self.socket_path)}"
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "TTSServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+        self._server.server_close()
+        self.batcher.close(timeout=10)
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def health(self) -> Dict:
+        return {"model_version": get_model_version(), "queued": self.batcher.queued,
+                "batches": self.batcher.batches, "segments": self.batcher.segments}
+
+    def resolve_registry(self, roles_path: Optional[str] = None,
+                         speaker_registry_path: Optional[str] = None) -> Optional[SpeakerRegistry]:
+        """
+        请求指定的角色向量表（按路径缓存，角色档案更新后重新加载/生成）；都未指定时返回None，即使用启动时的向量表
+        :raises ValueError: 既没有已存的向量表也找不到角色档案
+        """
+        if not roles_path and not speaker_registry_path:
+            return None
+        if not speaker_registry_path:
+            speaker_registry_path = os.path.join(os.path.dirname(os.path.abspath(roles_path)), "speaker_embeddings")
+        key = (os.path.abspath(roles_path) if roles_path else "", os.path.abspath(speaker_registry_path))
+        roles_mtime = os.path.getmtime(roles_path) if roles_path and os.path.exists(roles_path) else 0.0
+        with self._registry_lock:
+            cached = self._registries.get(key)
+            if cached is not None and cached[0] == roles_mtime:
+                return cached[1]
+            registry = SpeakerRegistry.load_or_build(
+                roles_path, lambda seed: get_tts_backend().sample_speaker(seed), get_model_version(),
+                speaker_registry_path)
+            if registry is None:
+                raise ValueError(f"找不到角色档案或说话人向量表：{roles_path or speaker_registry_path}")
+            self._registries[key] = (roles_mtime, registry)
+            return registry
+
+    def stream(self, body: Dict) -> Iterator[bytes]:
+        """处理一次合成请求，逐行产出NDJSON响应"""
+        registry = self.resolve_registry(body.get("roles_path"), body.get("speaker_registry_path"))
+        if "segments" in body:
+            segments = body["segments"]
+        else:
+            segments = load_segments(body["path"])
+        try:
+            if not isinstance(segments, Sequence) or isinstance(segments, str):
+                raise ValueError("segments 必须是片段列表")
+            # 先校验整个区间：响应头发出之后就无法再返回400
+            start, end = _request_range(body, segments)
+            indices = _pending_indices(segments, start, end)
+            yield b""  # 校验通过，调用方可以发送响应头
+            count = failed = 0
+            try:
+                for idx, future in _iter_completed(self.batcher, segments, indices, registry):
+                    error = future.exception()
+                    if error is not None:
+                        failed += 1
+                        yield _frame({"index": idx, "error": str(error)})
+                        continue
+                    count += 1
+                    pcm = StreamingWavWriter.to_pcm16(future.result())
+                    yield _frame({"index": idx, "sample_rate": tts.SAMPLE_RATE,
+                                  "pcm16": base64.b64encode(pcm).decode("ascii")})
+            except Exception as e:
+                # 已开始流式返回，只能以一行不带index的错误结束，保证响应完整
+                metrics.inc("tts_server_errors_total")
+                yield _frame({"error": f"合成中断（已返回 {count + failed} 段）：{str(e)}"})
+                return
+            yield _frame({"done": True, "count": count, "failed": failed})
+        finally:
+            if isinstance(segments, SegmentStore):
+                segments.close()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _send_json(self, status: int, payload: Dict):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path != HEALTH_PATH:
+                    self._send_json(404, {"error": f"未知路径：{self.path}"})
+                    return
+                self._send_json(200, server.health())
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path != SYNTHESIZE_PATH:
+                    self._send_json(404, {"error": f"未知路径：{self.path}"})
+                    return
+                try:
+                    body = json.loads(raw)
+                    frames = server.stream(body)
+                    next(frames)  # 请求本身有误（如路径不存在、片段缺字段）时在发送响应头之前报错
+                except Exception as e:
+                    self._send_json(400, {"error": str(e)})
+                    return
+                metrics.inc("tts_server_requests_total")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for frame in frames:
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    frames.close()  # 客户端已断开，剩余片段不再提交
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)  # BaseHTTPRequestHandler 期望 (host, port) 形式的客户端地址
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class TTSServerClient:
+    """
+    合成服务客户端：url 为 http://host:port 或 unix:///path/to.sock
+
+    用法：
+        client = TTSServerClient("http://127.0.0.1:8765")
+        for idx, pcm in client.synthesize(segments):
+            ...
+    """
+
+    def __init__(self, url: str, timeout: Optional[float] = 600):
+        self.url = url
+        self.timeout = timeout
+
+    def _connect(self) -> http.client.HTTPConnection:
+        parsed = urlparse(self.url)
+        if parsed.scheme == "unix":
+            return _UnixHTTPConnection(parsed.path, timeout=self.timeout)
+        return http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=self.timeout)
+
+    def health(self) -> Dict:
+        conn = self._connect()
+        try:
+            conn.request("GET", HEALTH_PATH)
+            return json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+
+    def stream(self, body: Dict) -> Iterator[Dict]:
+        """发送合成请求，逐行产出服务端的NDJSON帧（按完成顺序）"""
+        conn = self._connect()
+        try:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            conn.request("POST", SYNTHESIZE_PATH, body=data, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            if response.status != 200:
+                raise RuntimeError(f"合成服务返回 {response.status}：{response.read().decode('utf-8', 'replace')}")
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            conn.close()
+
+    def synthesize(self, segments: Optional[Sequence[Dict]] = None, path: Optional[str] = None,
+                   start: int = 0, end: Optional[int] = None, ordered: bool = False,
+                   roles_path: Optional[str] = None,
+                   speaker_registry_path: Optional[str] = None) -> Iterator[Tuple[int, bytes]]:
+        """
+        合成片段列表，或服务端可读取的标注结果文件中 [start, end) 的片段
+        :param ordered: True时按下标顺序产出（先完成的片段暂存），False时按完成顺序产出
+        :param roles_path: 本书的角色档案路径（服务端按其角色向量表合成）
+        :param speaker_registry_path: 本书的说话人向量表前缀（与本地合成时相同）
+        :return: 逐个产出 (片段下标, 16bit PCM字节)；合成失败的片段打印后跳过，
+                 服务端中途出错或响应不完整时抛出 RuntimeError
+        """
+        if segments is not None:
+            body = {"segments": list(segments), "start": start}
+        else:
+            body = {"path": path, "start": start}
+        if end is not None:
+            body["end"] = end
+        if roles_path:
+            body["roles_path"] = os.path.abspath(roles_path)
+        if speaker_registry_path:
+            body["speaker_registry_path"] = os.path.abspath(speaker_registry_path)
+        pending: Dict[int, bytes] = {}
+        expected: List[int] = []
+        if ordered and segments is not None:
+            stop = len(segments) if end is None else min(end, len(segments))
+            expected = [idx for idx in range(start, stop) if segments[idx]["text"].strip()]
+        cursor = 0
+        finished = False
+        for frame in self.stream(body):
+            if frame.get("done"):
+                finished = True
+                break
+            if "index" not in frame:
+                raise RuntimeError(f"合成服务中途出错：{frame.get('error', frame)}")
+            if "error" in frame:
+                print(f"⚠️  第{frame['index']+1}段合成失败：{frame['error']}")
+                if not ordered:
+                    continue
+                pcm = None
+            else:
+                pcm = base64.b64decode(frame["pcm16"])
+                if not ordered:
+                    yield frame["index"], pcm
+                    continue
+            pending[frame["index"]] = pcm
+            while cursor < len(expected) and expected[cursor] in pending:
+                pcm = pending.pop(expected[cursor])
+                if pcm is not None:
+                    yield expected[cursor], pcm
+                cursor += 1
+        if not finished:
+            raise RuntimeError("合成服务的响应不完整（连接中断）")
+        for idx in sorted(pending):  # 未提供片段列表时无法预知顺序，结束后统一排序产出
+            if pending[idx] is not None:
+                yield idx, pending[idx]
+
+
+def pcm16_to_numpy(pcm: bytes) -> np.ndarray:
+    """16bit PCM字节 -> float32波形"""
+    return np.frombuffer(pcm, dtype="<i2").astype(np.float32) / 32767.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="常驻ChatTTS合成服务（动态微批，多客户端共享一个热模型）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="监听Unix套接字路径（指定后忽略host/port）")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE, help="每批最多合成的片段数")
+    parser.add_argument("--max-wait", type=float, default=MAX_WAIT_SECONDS, help="片段最长排队时间（秒）")
+    parser.add_argument("--roles", default="novel_roles.json",
+                        help="默认角色档案路径（请求未附带本书角色档案时使用）")
+    parser.add_argument("--no-cache", action="store_true", help="不使用片段音频缓存")
+    args = parser.parse_args()
+
+    server = TTSServer(args.host, args.port, socket_path=args.socket, max_batch_size=args.batch_size,
+                       max_wait=args.max_wait, cache_dir=None if args.no_cache else ".audio_cache",
+                       roles_path=args.roles if os.path.exists(args.roles) else None)
+    print(f"🎙️  合成服务已启动：{server.url}（模型 {get_model_version()}，Ctrl+C 退出）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n正在关闭合成服务...")
+    finally:
+        server.stop()
+        report_path = metrics.export("tts_server")
+        if report_path:
+            print(f"运行指标已保存至：{report_path}")
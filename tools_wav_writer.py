@@ -0,0 +1,95 @@
+import os
+import struct
+import wave
+
+import numpy as np
+
+# wave模块写出的PCM文件头固定44字节（RIFF + fmt + data块头）
+_HEADER_BYTES = 44
+
+
+class StreamingWavWriter:
+    """
+    流式WAV写入器：逐段追加16bit PCM，结束时回填文件头
+
+    每段float32波形只做一次向量化转换后直接写盘，内存占用与总时长无关。
+    resume_frames>0 时打开上次中断留下的文件，只保留前 resume_frames 帧并从其后继续追加（断点续写）。
+    """
+
+    def __init__(self, path: str, sample_rate: int = 24000, channels: int = 1, resume_frames: int = 0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frames_written = 0
+        self._wav = None
+        self._raw = None
+        if resume_frames > 0:
+            self._raw = open(path, "r+b")
+            self._raw.truncate(_HEADER_BYTES + resume_frames * 2 * channels)
+            self._raw.seek(0, os.SEEK_END)
+            self.frames_written = resume_frames
+            return
+        self._wav = wave.open(path, "wb")
+        self._wav.setnchannels(channels)
+        self._wav.setsampwidth(2)  # 16bit PCM
+        self._wav.setframerate(sample_rate)
+
+    @staticmethod
+    def resumable_frames(path: str, sample_rate: int = 24000, channels: int = 1) -> int:
+        """
+        已有文件中可续写的帧数（中断时文件头尚未回填，按文件大小计算）
+        :return: 文件不存在或格式/参数不一致时返回0
+        """
+        if not os.path.exists(path) or os.path.getsize(path) < _HEADER_BYTES:
+            return 0
+        with open(path, "rb") as f:
+            header = f.read(_HEADER_BYTES)
+        riff, _, wave_id, fmt_id, fmt_size, audio_format, file_channels, file_rate, _, _, bits, data_id, _ = \
+            struct.unpack("<4sI4s4sIHHIIHH4sI", header)
+        if (riff, wave_id, fmt_id, data_id) != (b"RIFF", b"WAVE", b"fmt ", b"data") or fmt_size != 16 \
+                or (audio_format, file_channels, file_rate, bits) != (1, channels, sample_rate, 16):
+            return 0
+        return (os.path.getsize(path) - _HEADER_BYTES) // (2 * channels)
+
+    @staticmethod
+    def to_pcm16(wav: np.ndarray) -> bytes:
+        """float32波形([-1, 1]) -> 小端16bit PCM字节"""
+        samples = np.clip(np.asarray(wav, dtype=np.float32).reshape(-1), -1.0, 1.0)
+        return (samples * 32767.0).astype("<i2").tobytes()
+
+    def write(self, wav: np.ndarray):
+        """追加一段float32波形"""
+        self.write_pcm(self.to_pcm16(wav))
+
+    def write_pcm(self, pcm: bytes):
+        """追加已转换好的16bit PCM字节"""
+        # writeframesraw不回写文件头，避免每段都seek；close时统一修正
+        if self._raw is not None:
+            self._raw.write(pcm)
+        else:
+            self._wav.writeframesraw(pcm)
+        self.frames_written += len(pcm) // (2 * self.channels)
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.frames_written / self.sample_rate
+
+    def close(self):
+        """关闭文件并回填RIFF/data长度"""
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+        if self._raw is not None:
+            data_bytes = self.frames_written * 2 * self.channels
+            self._raw.seek(4)
+            self._raw.write(struct.pack("<I", _HEADER_BYTES - 8 + data_bytes))
+            self._raw.seek(_HEADER_BYTES - 4)
+            self._raw.write(struct.pack("<I", data_bytes))
+            self._raw.close()
+            self._raw = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
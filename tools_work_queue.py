@@ -0,0 +1,311 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from tools_metrics import metrics
+
+# 租约时长（秒）：持有者须在到期前续约，否则任务重新排队由其他节点领取
+DEFAULT_LEASE_SECONDS = 300.0
+# 单个任务最多尝试的次数（出错或租约过期都计一次）
+DEFAULT_MAX_ATTEMPTS = 3
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+@dataclass
+class Task:
+    """领取到的任务"""
+    id: int
+    job: str
+    stage: int
+    kind: str
+    name: str
+    payload: Dict
+    attempts: int
+
+
+class WorkQueue:
+    """
+    基于SQLite文件的共享任务队列（多台机器挂载同一目录即可使用，不依赖外部服务）
+
+    - 任务属于某个作业（一本书），按 stage 分阶段：同一作业中更早阶段的任务全部完成后，后面的任务才可领取
+    - claim() 在写事务中领取任务并加租约；执行期间用 LeaseKeeper 定期续约，租约过期的任务重新排队
+    - (作业, 任务名) 唯一，重复添加会被忽略：任务执行到一半崩溃后重跑，不会重复生成后续任务
+    - 使用回滚日志（非WAL）模式：WAL依赖共享内存，只适用于单机；数据库所在的共享文件系统须支持POSIX文件锁
+    """
+
+    def __init__(self, path: str, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=DELETE")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job TEXT PRIMARY KEY,
+                config TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job TEXT NOT NULL,
+                stage INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires REAL,
+                result TEXT,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                UNIQUE (job, name)
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status, stage);
+            CREATE INDEX IF NOT EXISTS idx_tasks_job ON tasks(job, stage, status);
+            """
+        )
+
+    def _transaction(self):
+        return _Transaction(self._conn, self._lock)
+
+    # ---------- 添加 ----------
+    def add_job(self, job: str, config: Dict, tasks: Iterable[Tuple[int, str, str, Dict]]) -> bool:
+        """
+        添加作业及其初始任务
+        :param tasks: (阶段, 任务类型, 任务名, 参数) 序列
+        :return: 作业已存在时返回False（不做任何修改）
+        """
+        with self._transaction() as conn:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO jobs (job, config, created_at) VALUES (?, ?, ?)",
+                (job, json.dumps(config, ensure_ascii=False), time.time()),
+            ).rowcount
+            if inserted:
+                self._insert_tasks(conn, job, tasks)
+        return bool(inserted)
+
+    def add_tasks(self, job: str, tasks: Iterable[Tuple[int, str, str, Dict]]) -> int:
+        """向已有作业追加任务（同名任务已存在时忽略），返回实际新增的任务数"""
+        with self._transaction() as conn:
+            return self._insert_tasks(conn, job, tasks)
+
+    @staticmethod
+    def _insert_tasks(conn: sqlite3.Connection, job: str, tasks: Iterable[Tuple[int, str, str, Dict]]) -> int:
+        now = time.time()
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO tasks (job, stage, kind, name, payload, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(job, stage, kind, name, json.dumps(payload, ensure_ascii=False), now)
+             for stage, kind, name, payload in tasks],
+        )
+        return cursor.rowcount
+
+    # ---------- 领取与租约 ----------
+    _RUNNABLE = """
+        FROM tasks t
+        WHERE (t.status = 'pending' OR (t.status = 'leased' AND t.lease_expires < :now))
+          AND NOT EXISTS (SELECT 1 FROM tasks p
+                          WHERE p.job = t.job AND p.stage < t.stage AND p.status != 'done')
+    """
+
+    def claim(self, owner: str, kinds: Optional[Sequence[str]] = None) -> Optional[Task]:
+        """
+        领取一个可执行的任务（更早阶段、更早添加的优先）并加租约；没有可领取的任务时返回None
+        :param owner: 领取者标识（建议 主机名:进程号）
+        :param kinds: 只领取这些类型的任务（如只有GPU的节点才领取合成任务），None表示不限
+        """
+        now = time.time()
+        kind_filter = ""
+        params: Dict[str, Any] = {"now": now}
+        if kinds:
+            kind_filter = " AND t.kind IN (%s)" % ",".join(f":kind{i}" for i in range(len(kinds)))
+            params.update({f"kind{i}": kind for i, kind in enumerate(kinds)})
+        with self._transaction() as conn:
+            # 租约过期且已用完重试次数的任务不再重新排队
+            expired = conn.execute(
+                "UPDATE tasks SET status = 'failed', error = '租约多次过期', lease_owner = NULL, updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts),
+            ).rowcount
+            if expired:
+                metrics.inc("work_queue_lease_failures_total", expired)
+            row = conn.execute(
+                f"SELECT t.id, t.job, t.stage, t.kind, t.name, t.payload, t.attempts, t.status "
+                f"{self._RUNNABLE}{kind_filter} ORDER BY t.stage, t.id LIMIT 1",
+                params,
+            ).fetchone()
+            if row is None:
+                return None
+            if row[7] == LEASED:
+                metrics.inc("work_queue_lease_expired_total", kind=row[3])
+            conn.execute(
+                "UPDATE tasks SET status = 'leased', attempts = attempts + 1, lease_owner = ?, "
+                "lease_expires = ?, updated_at = ? WHERE id = ?",
+                (owner, now + self.lease_seconds, now, row[0]),
+            )
+        metrics.inc("work_queue_claims_total", kind=row[3])
+        return Task(row[0], row[1], row[2], row[3], row[4], json.loads(row[5]), row[6] + 1)
+
+    def heartbeat(self, task: Task, owner: str) -> bool:
+        """续约；返回False表示租约已过期并被他人领取（当前执行结果应作废）"""
+        now = time.time()
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE tasks SET lease_expires = ?, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                (now + self.lease_seconds, now, task.id, owner),
+            ).rowcount == 1
+
+    def complete(self, task: Task, owner: str, result: Any = None) -> bool:
+        """提交结果；租约已不属于owner时返回False，结果不写入"""
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE tasks SET status = 'done', result = ?, error = NULL, lease_owner = NULL, "
+                "lease_expires = NULL, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                (json.dumps(result, ensure_ascii=False), time.time(), task.id, owner),
+            ).rowcount
+        metrics.inc("work_queue_tasks_total", kind=task.kind, status=DONE if updated else "lease_lost")
+        return updated == 1
+
+    def fail(self, task: Task, owner: str, error: str) -> str:
+        """报告失败：未用完重试次数时重新排队，否则标记为失败；返回任务的新状态"""
+        status = FAILED if task.attempts >= self.max_attempts else PENDING
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = ?, error = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = 'leased'",
+                (status, error, time.time(), task.id, owner),
+            )
+        metrics.inc("work_queue_tasks_total", kind=task.kind, status=status)
+        return status
+
+    def retry_failed(self, job: Optional[str] = None) -> int:
+        """把失败的任务重新排队（重试次数清零），返回任务数"""
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0, error = NULL, updated_at = ? "
+                "WHERE status = 'failed' AND (? IS NULL OR job = ?)",
+                (time.time(), job, job),
+            ).rowcount
+
+    # ---------- 查询 ----------
+    def job_config(self, job: str) -> Dict:
+        with self._lock:
+            row = self._conn.execute("SELECT config FROM jobs WHERE job = ?", (job,)).fetchone()
+        if row is None:
+            raise KeyError(f"作业不存在：{job}")
+        return json.loads(row[0])
+
+    def results(self, job: str, kind: str) -> List[Any]:
+        """某作业某类型全部已完成任务的结果（按添加顺序）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT result FROM tasks WHERE job = ? AND kind = ? AND status = 'done' ORDER BY id",
+                (job, kind),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def has_work(self, kinds: Optional[Sequence[str]] = None) -> bool:
+        """是否还有可领取或正在执行的任务（被失败任务阻塞的后续阶段不算）"""
+        params: Dict[str, Any] = {"now": time.time()}
+        kind_filter = ""
+        if kinds:
+            kind_filter = " AND t.kind IN (%s)" % ",".join(f":kind{i}" for i in range(len(kinds)))
+            params.update({f"kind{i}": kind for i, kind in enumerate(kinds)})
+        with self._lock:
+            leased = self._conn.execute(
+                "SELECT 1 FROM tasks WHERE status = 'leased' AND lease_expires >= ? LIMIT 1", (params["now"],)
+            ).fetchone()
+            runnable = self._conn.execute(f"SELECT 1 {self._RUNNABLE}{kind_filter} LIMIT 1", params).fetchone()
+        return leased is not None or runnable is not None
+
+    def status(self) -> Dict[str, Dict[str, Dict[str, int]]]:
+        """各作业各类型任务的状态计数：{作业: {任务类型: {状态: 数量}}}"""
+        summary: Dict[str, Dict[str, Dict[str, int]]] = {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT job, kind, status, COUNT(*) FROM tasks GROUP BY job, kind, status ORDER BY job, MIN(stage)"
+            ).fetchall()
+        for job, kind, status, count in rows:
+            summary.setdefault(job, {}).setdefault(kind, {})[status] = count
+        return summary
+
+    def errors(self, job: Optional[str] = None) -> List[Tuple[str, str, str]]:
+        """失败任务的 (作业, 任务名, 错误信息)"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT job, name, error FROM tasks WHERE status = 'failed' AND (? IS NULL OR job = ?) ORDER BY id",
+                (job, job),
+            ).fetchall()
+
+    def close(self):
+        self._conn.close()
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE 写事务：领取/续约/提交在多个节点之间互斥"""
+
+    def __init__(self, conn: sqlite3.Connection, lock: threading.Lock):
+        self._conn = conn
+        self._lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        self._lock.acquire()
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self._lock.release()
+            raise
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self._conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self._lock.release()
+
+
+class LeaseKeeper:
+    """
+    任务执行期间在后台线程中定期续约（默认每 1/3 租约时长一次）
+
+    用法：
+        with LeaseKeeper(queue, task, owner) as keeper:
+            result = run(task)
+        if keeper.lost: ...  # 执行期间租约丢失，结果作废
+    """
+
+    def __init__(self, queue: WorkQueue, task: Task, owner: str, interval: Optional[float] = None):
+        self.queue = queue
+        self.task = task
+        self.owner = owner
+        self.interval = interval if interval is not None else queue.lease_seconds / 3
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if not self.queue.heartbeat(self.task, self.owner):
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:  # 共享盘短暂不可用时下次再试，租约时长内恢复即可
+                print(f"⚠️  任务 {self.task.name} 续约失败：{str(e)}")
+
+    def __enter__(self) -> "LeaseKeeper":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import time
+from typing import Dict, List
+
+from generate_role_by_llm import (MAX_CONCURRENCY, PROMPT_OVERHEAD_TOKENS, QWEN_API_KEY, RPM_LIMIT, TPM_LIMIT,
+                                  USE_NAME_PREFILTER, extract_roles_with_bisection, generate_chattts_voice_map,
+                                  is_moderation_error, merge_roles, plan_requests)
+from generate_text_by_llm import CHUNK_MAX_TOKENS, annotate_pack, iter_annotation_packs, read_novel_from_txt
+from tools_chunker import estimate_tokens, iter_chunks
+from tools_concurrent import RateLimiter, dispatch_in_order
+from tools_incremental import ChunkState, chunk_fingerprint, write_json_atomic
+from tools_segment_store import SegmentStoreWriter, is_segment_store, load_segments, write_segments
+
+
+def _load_json(path: str, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _run_stage(name: str, func, indices: List[int], chunks: List[str], limiter: RateLimiter,
+               workers: int, unit: str = "块") -> Dict[int, List[Dict]]:
+    """并发处理指定的块（或块组），返回 {下标: 结果}；触发内容审核的结果为空列表，其他错误直接抛出"""
+    results = dispatch_in_order(
+        func,
+        indices,
+        max_workers=workers,
+        limiter=limiter,
+        cost_fn=lambda i: estimate_tokens(chunks[i]) + PROMPT_OVERHEAD_TOKENS,
+        on_done=lambda r: print(f"  {name}：第 {indices[r.index] + 1} {unit}完成"),
+        should_abort=lambda e: not is_moderation_error(str(e)),
+    )
+    outputs = {}
+    for chunk_idx, result in zip(indices, results):
+        if result.ok:
+            outputs[chunk_idx] = result.value
+        elif is_moderation_error(str(result.error)):
+            print(f"    ⚠️  第{chunk_idx + 1}{unit}触发内容安全审核，已跳过")
+            outputs[chunk_idx] = []
+        else:
+            raise result.error
+    return outputs
+
+
+def update_novel(novel_path: str, roles_path: str, processed_path: str, state_path: str = None,
+                 api_key: str = QWEN_API_KEY, chunk_tokens: int = CHUNK_MAX_TOKENS,
+                 workers: int = MAX_CONCURRENCY, use_rules: bool = True,
+                 use_prefilter: bool = USE_NAME_PREFILTER) -> Dict:
+    """
+    增量更新：只对新增/改动的文本块做角色提取和标注（连载追加章节时只花新章节的调用量）
+
+    1. 按 chunk_tokens 切块并计算每块指纹，与状态文件比对；
+    2. 新块提取角色，经 merge_roles 合并进已有角色档案；
+    3. 新块用更新后的档案标注，未变的块直接复用上次的片段，按块顺序写回标注结果。
+
+    Args:
+        novel_path: 小说TXT路径（完整文本，含已处理过的章节）
+        roles_path: 角色档案JSON路径（不存在时新建）
+        processed_path: 标注结果路径（.json数组或.jsonl片段库，不存在时新建）
+        state_path: 状态文件路径，默认为 <processed_path>.state.json
+        api_key: 通义千问API Key
+        chunk_tokens: 每块的token预算（修改后所有块指纹都会变化，相当于全量重跑）
+        workers: 同时在途的API请求数
+        use_rules: 标注时先用本地规则，只把说话人不确定的对白交给大模型
+        use_prefilter: 角色提取前本地预筛，已有档案中的角色不再请求，只为新候选人名摘句请求
+
+    Returns:
+        统计信息：总块数、新处理块数、新增角色数、标注片段数
+    """
+    start_time = time.perf_counter()
+    state = ChunkState(state_path or f"{processed_path}.state.json")
+    previous_fingerprints = [item["fingerprint"] for item in state.chunks]
+    known = state.known_records(load_segments(processed_path) if os.path.exists(processed_path) else None)
+    if state.chunks and not known:
+        print("⚠️  状态文件与标注结果不一致，将全部重新处理")
+
+    novel_text = read_novel_from_txt(novel_path)
+    chunks = list(iter_chunks(novel_text, max_tokens=chunk_tokens))
+    fingerprints = [chunk_fingerprint(chunk) for chunk in chunks]
+    new_indices = [i for i, fingerprint in enumerate(fingerprints) if fingerprint not in known]
+    print(f"共 {len(chunks)} 块，其中 {len(new_indices)} 块为新增或改动")
+    stats = {"chunks": len(chunks), "new_chunks": len(new_indices), "new_roles": 0}
+
+    limiter = RateLimiter(rpm=RPM_LIMIT, tpm=TPM_LIMIT)
+    if new_indices:
+        # 1. 新块提取角色，合并进已有档案
+        print("Step 1: 提取新块中的角色...")
+        role_data = _load_json(roles_path, {"roles": []})
+        existing_roles = role_data.get("roles", [])
+        existing_names = {role["name"] for role in existing_roles}
+        role_requests = plan_requests([chunks[i] for i in new_indices], novel_text, existing_roles, use_prefilter)
+        for request in role_requests:
+            request.chunk_indices = [new_indices[j] for j in request.chunk_indices]  # 换回全书中的块下标
+        request_indices = list(range(len(role_requests)))
+        new_role_chunks = _run_stage(
+            "角色提取",
+            lambda j: extract_roles_with_bisection(role_requests[j].text, api_key, role_requests[j].label),
+            request_indices, [request.text for request in role_requests], limiter, workers,
+        )
+        # 复制一份已有角色：merge_roles 会原地补全字段，保留原数据用于判断档案是否有变化
+        merged_roles = merge_roles([[dict(role) for role in existing_roles]]
+                                   + [new_role_chunks[j] for j in request_indices])
+        added = [role["name"] for role in merged_roles if role["name"] not in existing_names]
+        stats["new_roles"] = len(added)
+        updated = {
+            "roles": merged_roles,
+            "chattts_voice_map": generate_chattts_voice_map(merged_roles),
+            "total_roles": len(merged_roles),
+        }
+        if updated != role_data:
+            write_json_atomic(roles_path, updated)
+        print(f"角色档案已更新：新增 {len(added)} 个角色{('（' + '、'.join(added) + '）') if added else ''}")
+
+        # 2. 用更新后的档案标注新块（上文取原文中的前一块，与全量处理一致）；
+        #    连续的新块按组合并待定对白的请求
+        print("Step 2: 标注新块...")
+        runs: List[List[int]] = []
+        for i in new_indices:
+            if runs and runs[-1][-1] == i - 1:
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        packs = []  # (首块下标, [(文本块, 上文)])
+        for run in runs:
+            first = run[0]
+            for pack in iter_annotation_packs([chunks[i] for i in run], roles_path, use_rules=use_rules,
+                                              context=chunks[first - 1] if first else ""):
+                packs.append((first, pack))
+                first += len(pack)
+        annotated_packs = _run_stage(
+            "标注",
+            lambda p: annotate_pack(packs[p][1], api_key, roles_path, use_rules=use_rules,
+                                    labels=[str(packs[p][0] + j + 1) for j in range(len(packs[p][1]))]),
+            list(range(len(packs))), ["".join(chunk for chunk, _ in pack) for _, pack in packs],
+            limiter, workers, unit="组",
+        )
+        for p, (first, pack) in enumerate(packs):
+            per_chunk = annotated_packs[p] or [[] for _ in pack]
+            known.update({fingerprints[first + j]: segments for j, segments in enumerate(per_chunk)})
+
+    # 3. 按块顺序拼回标注结果，与状态文件一起写出
+    per_chunk = [known[fingerprint] for fingerprint in fingerprints]
+    all_segments = [segment for segments in per_chunk for segment in segments]
+    if is_segment_store(processed_path) and known and os.path.exists(processed_path):
+        # 片段库：保留未改动的前缀，只截掉并追加其后的部分（连载追加章节时只写新章节）
+        keep = 0
+        while (keep < min(len(previous_fingerprints), len(fingerprints))
+               and previous_fingerprints[keep] == fingerprints[keep]):
+            keep += 1
+        with SegmentStoreWriter(processed_path) as writer:
+            writer.truncate(sum(len(segments) for segments in per_chunk[:keep]))
+            writer.append(segment for segments in per_chunk[keep:] for segment in segments)
+    elif new_indices or not os.path.exists(processed_path):
+        write_segments(processed_path, all_segments)
+    state.replace(fingerprints, [len(segments) for segments in per_chunk])
+    state.save()
+    stats["segments"] = len(all_segments)
+    print(f"增量更新完成：{len(all_segments)} 个片段，耗时 {time.perf_counter() - start_time:.1f} 秒")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="连载小说增量更新：只处理新增/改动的章节")
+    parser.add_argument("--novel", default="novel_sample.txt", help="小说TXT文件路径（完整文本）")
+    parser.add_argument("--roles", default="novel_roles.json", help="角色档案JSON路径")
+    parser.add_argument("--processed", default="novel_processed.json", help="标注结果路径（.json 或 .jsonl片段库）")
+    parser.add_argument("--state", default=None, help="状态文件路径（默认 <processed>.state.json）")
+    parser.add_argument("--api-key", default=os.environ.get("DASHSCOPE_API_KEY", QWEN_API_KEY))
+    parser.add_argument("--workers", type=int, default=MAX_CONCURRENCY, help="同时在途的API请求数")
+    parser.add_argument("--llm-only", action="store_true", help="不用本地规则预标注，整段交给大模型")
+    parser.add_argument("--no-prefilter", action="store_true", help="角色提取不做本地预筛，每个新块都请求大模型")
+    args = parser.parse_args()
+
+    try:
+        update_novel(args.novel, args.roles, args.processed, state_path=args.state,
+                     api_key=args.api_key, workers=args.workers, use_rules=not args.llm_only,
+                     use_prefilter=not args.no_prefilter)
+    except Exception as e:
+        print(f"增量更新失败：{str(e)}")